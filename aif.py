@@ -1,49 +1,145 @@
-import dimcli
+'''
+aif.py calculates the Author Impact Factor (AIF) of researchers, applying the
+method described in
+
+Pan, RK. & Fortunato, S. (2014) Author Impact Factor: tracking the dynamics of
+individual scientific impact. Scientific Reports 4: 4880.
+https://doi.org/10.1038/srep04880
+
+The AIF of a researcher in year t is the number of citations received in year
+t by the publications the researcher published in the DELTA years [t-DELTA, t-1],
+divided by the number of publications the researcher published in those years.
+
+Citations are counted per citing link, so a publication that cites two of a
+researcher's publications counts as two citations.
+
+The publications of every researcher in RESEARCHER_IDS are fetched in batched
+queries, along with every publication citing them. The counts of publications
+per year and of citations per (publication year, citing year) are then held
+as dense arrays over researchers and years, and the AIF for every year and
+every window in DELTAS is calculated at once with cumulative sums.
+
+The output is a CSV file called "aif.csv" with one row per researcher, year
+and window.
+'''
 from dotenv import load_dotenv
 import numpy as np
 import pandas as pd
 
-import json
 import os
 
+from author_self_citation import researcher_query, split_researchers
+from backends import connect, disconnect
+from chunk_store import ChunkStore
+from cohorts import fetch_citing
+from id_index import IdIndex
+from instrumentation import stage
+from query_planner import QueryPlanner
+
 load_dotenv()
 
 # Set variables
-RESEARCHER_ID: list[str] = ['ur.01024019836']
-DELTA: int = 5
+RESEARCHER_IDS: list[str] = ['ur.01024019836']
+DELTAS: list[int] = [2, 3, 5]
+
+
+def citation_links(authorship: pd.DataFrame, publications: pd.DataFrame, citing: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Get one row per researcher and citing link, with the year the cited
+    publication was published (pub_year) and the year it was cited (cite_year).
+    '''
+    # A publication is returned once per batch of researchers, and by both
+    # halves of a split query, so each is kept once per researcher
+    publications = publications.drop_duplicates('id')
+    authorship = authorship.drop_duplicates(['id', 'researcher_id'])
+    links = (
+        citing
+        .filter(['id', 'year', 'reference_ids'])
+        .rename(columns={'id': 'citing_id', 'year': 'cite_year'})
+        .explode('reference_ids')
+        .rename(columns={'reference_ids': 'id'})
+    )
+    links = pd.merge(links, publications[['id', 'year']].rename(columns={'year': 'pub_year'}), on='id', how='inner')
+    return pd.merge(authorship[['id', 'researcher_id']], links, on='id', how='inner')
+
+
+def author_impact_factor(authorship: pd.DataFrame, publications: pd.DataFrame, links: pd.DataFrame,
+                         researcher_ids: list, deltas: list) -> pd.DataFrame:
+    '''Calculate the AIF of every researcher in every year for every window in deltas.'''
+    publications = publications.drop_duplicates('id').dropna(subset=['year'])
+    authorship = authorship.drop_duplicates(['id', 'researcher_id'])
+    by_researcher = pd.merge(authorship[['id', 'researcher_id']], publications[['id', 'year']], on='id', how='inner')
+    links = links.dropna(subset=['pub_year', 'cite_year'])
+
+    years = pd.concat([by_researcher['year'], links['cite_year']]).astype(int)
+    first_year, last_year = years.min(), years.max()
+    n_years = last_year - first_year + 1
+    researcher_index = pd.Index(researcher_ids)
+
+    # Publications per researcher and year: N[r, p]
+    r = researcher_index.get_indexer(by_researcher['researcher_id'])
+    p = by_researcher['year'].astype(int).to_numpy() - first_year
+    publication_counts = np.bincount(r * n_years + p, minlength=len(researcher_ids) * n_years)
+    publication_counts = publication_counts.reshape(len(researcher_ids), n_years)
+
+    # Citations per researcher, publication year and citing year: C[r, p, t]
+    r = researcher_index.get_indexer(links['researcher_id'])
+    p = links['pub_year'].astype(int).to_numpy() - first_year
+    t = links['cite_year'].astype(int).to_numpy() - first_year
+    citation_counts = np.bincount((r * n_years + p) * n_years + t, minlength=len(researcher_ids) * n_years**2)
+    citation_counts = citation_counts.reshape(len(researcher_ids), n_years, n_years)
 
-# Log into Dimensions
-API_KEY = os.getenv('API_KEY')
-dimcli.login(key=API_KEY, endpoint='https://app.dimensions.ai/api/dsl/v2')
-dsl = dimcli.Dsl()
+    # Cumulative sums over the publication year, with a leading zero so that the
+    # sum over publication years [lo, hi) is cumsum[hi] - cumsum[lo]
+    publications_cumsum = np.pad(publication_counts.cumsum(axis=1), ((0, 0), (1, 0)))
+    citations_cumsum = np.pad(citation_counts.cumsum(axis=1), ((0, 0), (1, 0), (0, 0)))
 
-# Retrieve the publications for a disambiguated researcher in Dimensions
-publications = dimcli.query(f"""search publications where researchers.id = {json.dumps(RESEARCHER_ID)} 
-                             return publications[id+year+reference_ids+times_cited]""").as_dataframe()
+    t = np.arange(n_years)
+    frames = []
+    for delta in deltas:
+        lo = np.clip(t - delta, 0, None)
+        window_publications = publications_cumsum[:, t] - publications_cumsum[:, lo]
+        window_citations = citations_cumsum[:, t, t] - citations_cumsum[:, lo, t]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aif = np.where(window_publications > 0, window_citations / window_publications, np.nan)
+        frames.append(pd.DataFrame({
+            'researcher_id': np.repeat(researcher_ids, n_years),
+            'year': np.tile(t + first_year, len(researcher_ids)),
+            'delta': delta,
+            'publications': window_publications.ravel(),
+            'citations': window_citations.ravel(),
+            'aif': aif.ravel(),
+        }))
+    return pd.concat(frames, ignore_index=True)
 
-references = publications.filter(['reference_ids']).explode('reference_ids')
-references = references[references['reference_ids'].notnull()]
 
-split: int = int(np.ceil(references.shape[0]/390))
-references_split: list = np.array_split(references, split)
+if __name__ == '__main__':
+    DATA_DIR: str = os.path.join(os.getcwd(), 'data')
+    os.makedirs(DATA_DIR, exist_ok=True)
 
-# Get the publication id and year of publication for all publications citing publications by a researcher
-citations = pd.DataFrame()
+    # Connect to the Dimensions API or a local export
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
+    planner = QueryPlanner()
 
-for i in range(len(references_split)):
-    # TODO Make sure that duplicates are not dropped in order to fully count the number of citations of each publication
-    pubs = references_split[i]['id']#.drop_duplicates()
-    results = dimcli.query_iterative(f"""search publications where reference_ids in {json.dumps(list(pubs))}
-                            return publications[id+year]
-                            """).as_dataframe()
-    citations = pd.concat([citations, results])
+    # Retrieve the publications for disambiguated researchers in Dimensions
+    with stage('publications'):
+        store = planner.harvest(
+            ChunkStore(os.path.join(DATA_DIR, 'harvests', 'aif_publications')), dsl,
+            researcher_query('id+year+researchers'), RESEARCHER_IDS,
+            to_frames=lambda results: split_researchers(results, set(RESEARCHER_IDS)))
+        publications = store.read(table='publications')
+        authorship = store.read(table='authorship')
 
-dimcli.logout()
+    # Get the publication id and year of publication for all publications citing
+    # publications by the researchers, keeping every citing link
+    with stage('citing'):
+        citing = fetch_citing(dsl, publications['id'], fields='id+year+reference_ids', planner=planner)
 
-# Calculate the number of publications published in each year
-publications_per_year = publications.groupby('year').count().reset_index()
+    disconnect(dsl)
 
-# Calculate the number of citations in each year
-citations_per_year = citations.groupby('year').count().reset_index()
+    with stage('aif'):
+        links = citation_links(authorship, publications, citing)
+        df_aif = author_impact_factor(authorship, publications, links, RESEARCHER_IDS, DELTAS)
 
-# Calculate the ratio of the number of publications in year t to the number of citations in [t-DELTA, t-1]
\ No newline at end of file
+    df_aif.to_csv('aif.csv', index=False)
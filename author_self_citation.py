@@ -1,97 +1,165 @@
-import dimcli
+'''
+author_self_citation.py calculates how often researchers cite their own work.
+
+The input is a CSV file called "publications.csv" with a column called
+"researcher_id" containing the Dimensions ids of the researchers.
+
+Publications are fetched for many researchers at once with researchers.id in
+[...] queries and split between the researchers locally, and the self
+citation counts for every researcher are calculated together with grouped
+operations over a single table of references, so a department-wide run needs
+a handful of queries and one pass over the data.
+
+The output is a CSV file called "self_citation.csv" with one row per
+researcher.
+'''
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 
-import json
 import os
 
-# Housekeeping
-DATA_DIR: str = os.path.join(os.getcwd(), 'data')
-if not os.path.isdir(DATA_DIR):
-    os.mkdir(DATA_DIR)
-    print('Created folder : ', DATA_DIR)
-else:
-    print('Data folder already exists.')
-
-# Set the Dimensions id of the researcher
-publications = pd.read_csv('publications.csv')
-
-researcher_ids = publications['researcher_id'].drop_duplicates().tolist()
-
-# Log into Dimensions API
-load_dotenv()
-API_KEY = os.getenv('API_KEY')
-dimcli.login(key=API_KEY, endpoint='https://app.dimensions.ai/api/dsl/v2')
-dsl = dimcli.Dsl()
-
-df_self_citation = pd.DataFrame()
-
-for i in range(len(researcher_ids)):
-    researcher: str = researcher_ids[i]
-    results = dsl.query_iterative(f"""search publications where researchers.id = {json.dumps(researcher)}
-                             return publications[id+year+reference_ids+times_cited+authors]""")
-    publications = results.as_dataframe()
-    affiliations = results.as_dataframe_authors_affiliations()
-    
+from backends import connect, disconnect
+from chunk_store import ChunkStore
+from id_index import IdIndex
+from instrumentation import stage
+from query_planner import IDS, QueryPlanner
+
+
+def researcher_query(fields: str) -> str:
+    '''Query template for the publications of a list of researchers, for QueryPlanner.'''
+    return f'search publications where researchers.id in {IDS} return publications[{fields}]'
+
+
+def split_researchers(results, researcher_ids: set) -> dict:
+    '''
+    Split the publications returned by a query into a table of publications
+    and a table linking each publication to the requested researchers who
+    authored it.
+    '''
+    publications = results.as_dataframe().filter(['id', 'year', 'reference_ids', 'times_cited'])
+    authorship = get_authorship(results.json.get('publications', []), researcher_ids)
+    return {'publications': publications, 'authorship': authorship}
+
+
+def get_authorship(records: list, researcher_ids: set) -> pd.DataFrame:
+    '''Link DSL publication records to those of their researchers that are in researcher_ids.'''
+    authorship = [
+        {'id': publication['id'],
+         'researcher_id': researcher['id'],
+         'first_name': researcher.get('first_name'),
+         'last_name': researcher.get('last_name')}
+        for publication in records
+        for researcher in publication.get('researchers', [])
+        if researcher.get('id') in researcher_ids
+    ]
+    return pd.DataFrame(authorship, columns=['id', 'researcher_id', 'first_name', 'last_name'])
+
+
+def self_citation_metrics(publications: pd.DataFrame, authorship: pd.DataFrame, researcher_ids: list,
+                          cited_authorship: pd.DataFrame | None = None) -> pd.DataFrame:
+    '''
+    Calculate the self citation metrics for every researcher at once.
+
+    A reference is a self citation if the researcher is an author of the
+    cited publication in cited_authorship, by default the authorship of the
+    researchers' own publications.
+    '''
+    publications = publications.drop_duplicates('id')
+    authorship = authorship.drop_duplicates(['id', 'researcher_id'])
+    cited_authorship = authorship if cited_authorship is None else cited_authorship.drop_duplicates(['id', 'researcher_id'])
+
+    # Get the name of each researcher
+    names = (
+        authorship
+        .drop_duplicates('researcher_id')
+        .assign(name = lambda df: df['first_name'].fillna('') + ' ' + df['last_name'].fillna(''))
+        .set_index('researcher_id')['name']
+    )
+
     # Summarise the publication data
-    # Count number of publications
-    n_publications = publications.id.count()
-    # Total number of citations
-    citations = publications.times_cited.sum()
-    # Get the author's name
-    temp = affiliations[affiliations['researcher_id'] == researcher_ids[i]].iloc[i]
-    name = temp.first_name + ' ' + temp.last_name
-    
-    # Get the references for each paper by the researcher
+    # Count number of publications and total number of citations
+    by_researcher = pd.merge(authorship[['id', 'researcher_id']], publications[['id', 'times_cited']], on='id', how='left')
+    n_publications = by_researcher.groupby('researcher_id')['id'].count()
+    citations = by_researcher.groupby('researcher_id')['times_cited'].sum()
+
+    # Get the references for each paper by each researcher
     references = (
         publications
-        .filter([
-            'id', 
-            'reference_ids'
-        ])
+        .filter(['id', 'reference_ids'])
         .explode('reference_ids')
-        .set_index('id')
-        .reset_index()
+        .dropna()
+    )
+    references = pd.merge(authorship[['id', 'researcher_id']], references, on='id', how='inner')
+
+    # Limit the references to publications that have been authored by the same researcher
+    self_cites = pd.merge(
+        references,
+        cited_authorship[['id', 'researcher_id']].rename(columns={'id': 'reference_ids'}),
+        on=['researcher_id', 'reference_ids'],
+        how='inner'
     )
-    
-    # Limit the references to publications that have been authored by the researcher
-    references = references[references['reference_ids'].isin(publications['id'])]
-    
-    self_cites = references.groupby('reference_ids').count().reset_index()
-    self_cites = (
-        self_cites
-        .rename(columns={
-            'id': 'self_cites',
-            'reference_ids': 'id'
-        })
+    self_cites = self_cites.groupby('researcher_id')['reference_ids']
+
+    df_self_citation = pd.DataFrame({
+        'researcher': names,
+        'total_publications': n_publications,
+        # Number of self cited papers
+        'self_cited_publications': self_cites.nunique(),
+        'total_citations': citations,
+        # Number of self citations
+        'total_self_citations': self_cites.count(),
+    }).reindex(researcher_ids)
+    counts = ['total_publications', 'self_cited_publications', 'total_citations', 'total_self_citations']
+    df_self_citation[counts] = df_self_citation[counts].fillna(0).astype(int)
+
+    # Proportion of papers self cited and self citations as a proportion of citations
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df_self_citation['percent_self_cited'] = round(100 * (df_self_citation['self_cited_publications'] / df_self_citation['total_publications']), 1)
+        df_self_citation['percent_self_citations'] = round(100 * (df_self_citation['total_self_citations'] / df_self_citation['total_citations']), 1)
+
+    return (
+        df_self_citation
+        .rename_axis('researcher_id')
+        .reset_index()
+        .filter(['researcher_id', 'researcher', 'total_publications', 'self_cited_publications', 'percent_self_cited',
+                 'total_citations', 'total_self_citations', 'percent_self_citations'])
     )
-    
-    # Summarise the self citations
-    # Number of self cited papers
-    n_self_cited = self_cites.id.nunique()
-    
-    # Number of self citations
-    total_self_cites = self_cites.self_cites.sum()
-    
-    # Proportion of papers self_cited
-    p_self_cited = round(100 * (n_self_cited / n_publications), 1)
-    
-    # Self citations as a porportion of citations
-    p_self_citations = round(100 * (total_self_cites / citations), 1)
-    
-    # Create data frame for export
-    df_self_temp = pd.DataFrame({
-        'researcher': [name],
-        'total_publications': [n_publications],
-        'self_cited_publications': [n_self_cited],
-        'percent_self_cited': [p_self_cited],
-        'total_citations': [citations],
-        'total_self_citations': [total_self_cites],
-        'percent_self_citations': [p_self_citations]
-    })
-    
-    df_self_citation= pd.concat([df_self_citation, df_self_temp])
-
-dimcli.logout()
-
-df_self_citation.to_csv('self_citation.csv', index=False)
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    # Housekeeping
+    DATA_DIR: str = os.path.join(os.getcwd(), 'data')
+    if not os.path.isdir(DATA_DIR):
+        os.mkdir(DATA_DIR)
+        print('Created folder : ', DATA_DIR)
+    else:
+        print('Data folder already exists.')
+
+    # Set the Dimensions ids of the researchers
+    publications = pd.read_csv('publications.csv')
+
+    researcher_ids = publications['researcher_id'].drop_duplicates().tolist()
+
+    # Connect to the Dimensions API or a local export
+    load_dotenv()
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
+
+    # Get the publications for many researchers in each query
+    with stage('publications'):
+        store = QueryPlanner().harvest(
+            ChunkStore(os.path.join(DATA_DIR, 'harvests', 'self_citation')), dsl,
+            researcher_query('id+year+reference_ids+times_cited+researchers'), researcher_ids,
+            to_frames=lambda results: split_researchers(results, set(researcher_ids)))
+
+    disconnect(dsl)
+
+    with stage('self_citation'):
+        df_self_citation = self_citation_metrics(
+            store.read(table='publications'),
+            store.read(table='authorship'),
+            researcher_ids
+        )
+
+    df_self_citation.to_csv('self_citation.csv', index=False)
@@ -0,0 +1,53 @@
+'''
+backends.py connects the scripts to a source of Dimensions data:
+
+    dsl = connect(listeners=[index.record_result])
+    ...
+    disconnect(dsl)
+
+The DIMENSIONS_BACKEND environment variable chooses the source:
+
+- dsl (the default) logs into the Dimensions API with API_KEY and returns a
+  rate-limited, cached dimcli.Dsl (see dsl_executor.py and dsl_cache.py).
+  If DIMENSIONS_QUOTA or DIMENSIONS_JOB is set, as for the jobs started by
+  scheduler.py, the rate limit is a QuotaBudget shared with every other
+  process (see quota.py), weighted by DIMENSIONS_JOB_WEIGHT.
+- local returns a LocalDsl answering the same queries from the bulk export in
+  DIMENSIONS_EXPORT (see local_dsl.py), so every script runs offline over a
+  full snapshot without any quota.
+
+Both are used in the same way by the rest of the code, and call the listeners
+with every result they return from the source.
+'''
+import dimcli
+
+import os
+
+from dsl_cache import CachedDsl
+from dsl_executor import DSL_ENDPOINT, RateLimitedDsl
+from local_dsl import LocalDsl
+from quota import QUOTA_PATH, QuotaBudget
+
+BACKENDS: tuple = ('dsl', 'local')
+
+
+def connect(listeners: list = (), backend: str | None = None):
+    '''Connect to the Dimensions API, or open a local export, as chosen by DIMENSIONS_BACKEND.'''
+    backend = backend or os.getenv('DIMENSIONS_BACKEND', 'dsl')
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown DIMENSIONS_BACKEND {backend!r}, expected one of {", ".join(BACKENDS)}')
+    if backend == 'local':
+        return LocalDsl(listeners=listeners)
+    dimcli.login(key=os.getenv('API_KEY'), endpoint=os.getenv('DIMENSIONS_ENDPOINT', DSL_ENDPOINT))
+    bucket = None
+    if os.getenv('DIMENSIONS_QUOTA') or os.getenv('DIMENSIONS_JOB'):
+        bucket = QuotaBudget(os.getenv('DIMENSIONS_QUOTA', QUOTA_PATH), job=os.getenv('DIMENSIONS_JOB'),
+                             weight=float(os.getenv('DIMENSIONS_JOB_WEIGHT', 1)))
+    return CachedDsl(RateLimitedDsl(dimcli.Dsl(), bucket=bucket), listeners=listeners)
+
+
+def disconnect(dsl):
+    '''Log out of the Dimensions API and report on the query cache.'''
+    if isinstance(dsl, CachedDsl):
+        dimcli.logout()
+        print(dsl.cache)
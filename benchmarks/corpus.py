@@ -0,0 +1,133 @@
+'''
+Synthetic bibliographic corpus for benchmarking the scripts offline.
+
+synthetic_corpus() generates publications in the shape returned by the
+Dimensions API, with control over the number of publications, the
+distribution of reference list lengths, the share of publications with a DOI
+and the share of publications that have been retracted. Publications are
+generated in date order and only cite earlier publications, with citations
+skewed towards a minority of highly cited publications.
+
+A share of the publications is given to a focus institution and a focus set
+of researchers, so that the scripts' own settings (GRIDID and YEAR in
+feet_of_clay.py, RESEARCHER_IDS in aif.py) select a part of the corpus that
+grows with its size.
+'''
+import numpy as np
+import pandas as pd
+
+from dataclasses import dataclass
+
+from benchmarks.funding_matcher import FUNDERS
+from funding_matcher import TALENT_PROGRAMS
+
+FIRST_YEAR: int = 2000
+
+
+@dataclass
+class Corpus:
+    publications: list
+    retractions: pd.DataFrame
+    grid_id: str
+    year: int
+    researcher_ids: list
+
+    def __len__(self) -> int:
+        return len(self.publications)
+
+
+def reference_counts(rng, n: int, mean: float, dispersion: float) -> np.ndarray:
+    '''
+    Draw reference list lengths from a negative binomial distribution, which
+    has the long right tail of real reference lists. A lower dispersion gives
+    a longer tail.
+    '''
+    if mean <= 0:
+        return np.zeros(n, dtype=int)
+    return rng.negative_binomial(dispersion, dispersion / (dispersion + mean), size=n)
+
+
+def synthetic_corpus(n: int, mean_references: float = 30, dispersion: float = 2.0, doi_coverage: float = 0.9,
+                     retraction_rate: float = 0.002, grid_id: str = 'grid.6268.a', year: int = 2025,
+                     researcher_ids: list | None = None, focus_share: float = 0.05, funding_coverage: float = 0.5,
+                     talent_rate: float = 0.05, seed: int = 0) -> Corpus:
+    '''Generate a corpus of n publications.'''
+    rng = np.random.default_rng(seed)
+    researcher_ids = list(researcher_ids or [])
+
+    ids = np.array([f'pub.{1000000000 + i}' for i in range(n)], dtype=object)
+    days = np.sort(rng.integers(0, (year - FIRST_YEAR + 1) * 365, size=n))
+    dates = pd.Timestamp(FIRST_YEAR, 1, 1) + pd.to_timedelta(days, unit='D')
+    years = dates.year.to_numpy()
+    date_strings = dates.strftime('%Y-%m-%d').tolist()
+    has_doi = rng.random(n) < doi_coverage
+
+    # Citations go to earlier publications, a few of which attract most of them.
+    # Each reference is drawn by inverting the cumulative popularity of the
+    # publications before the citing publication.
+    counts = np.minimum(reference_counts(rng, n, mean_references, dispersion), np.arange(n))
+    cumulative = np.cumsum(rng.pareto(1.5, size=n) + 1)
+    citing = np.repeat(np.arange(n), counts)
+    cited = np.searchsorted(cumulative, rng.random(len(citing)) * cumulative[citing - 1], side='right')
+    edges = np.unique(citing.astype(np.int64) * n + np.minimum(cited, citing - 1))
+    citing, cited = edges // n, edges % n
+    times_cited = np.bincount(cited, minlength=n)
+    references = np.split(ids[cited], np.cumsum(np.bincount(citing, minlength=n))[:-1])
+
+    # Researchers and institutions
+    pool = np.array([f'ur.{10000000000 + i}' for i in range(max(n // 10, 10))])
+    orgs = np.array([f'grid.{i}.{chr(97 + i % 26)}' for i in range(max(n // 100, 10))])
+    focus = (years == year) & (rng.random(n) < focus_share * (year - FIRST_YEAR + 1))
+    focus |= rng.random(n) < focus_share
+    n_authors = rng.integers(1, 7, size=n)
+    author_ids = np.split(pool[rng.integers(0, len(pool), size=n_authors.sum())], np.cumsum(n_authors)[:-1])
+    author_orgs = np.split(orgs[rng.integers(0, len(orgs), size=n_authors.sum())], np.cumsum(n_authors)[:-1])
+    aliases = [alias for names in TALENT_PROGRAMS.values() for alias in names]
+
+    publications = []
+    for i in range(n):
+        authors = list(dict.fromkeys(author_ids[i].tolist()))
+        if researcher_ids and rng.random() < focus_share:
+            authors[0] = str(rng.choice(researcher_ids))
+        org_ids = author_orgs[i][:len(authors)].tolist()
+        if focus[i]:
+            org_ids[0] = grid_id
+        record = {
+            'id': ids[i],
+            'title': f'Synthetic publication {i}',
+            'year': int(years[i]),
+            'date': date_strings[i],
+            'date_inserted': date_strings[i],
+            'times_cited': int(times_cited[i]),
+            'publisher': 'Synthetic Press',
+            'source_title': {'id': f'jour.{i % 500}', 'title': f'Journal {i % 500}'},
+            'reference_ids': references[i].tolist(),
+            'research_orgs': sorted(set(org_ids)),
+            'researchers': [{'id': a, 'first_name': 'First' + a[-4:], 'last_name': 'Last' + a[-4:]} for a in authors],
+            'authors': [{'first_name': 'First' + a[-4:], 'last_name': 'Last' + a[-4:], 'researcher_id': a,
+                         'raw_affiliation': [f'Institution {o}'],
+                         'affiliations': [{'id': o, 'name': f'Institution {o}', 'raw_affiliation': f'Institution {o}'}]}
+                        for a, o in zip(authors, org_ids)],
+        }
+        if has_doi[i]:
+            record['doi'] = f'10.5555/synthetic.{i}'
+        if rng.random() < funding_coverage:
+            parts = [str(part) for part in rng.choice(FUNDERS, size=rng.integers(1, 4), replace=False)]
+            if rng.random() < talent_rate:
+                parts.insert(rng.integers(0, len(parts) + 1), 'the ' + str(rng.choice(aliases)))
+            record['funding_section'] = 'This work was supported by ' + ', '.join(parts) + ', and startup funds.'
+            record['funders'] = [{'id': f'grant.{j}', 'name': part} for j, part in enumerate(parts)]
+        publications.append(record)
+
+    # Retracted publications are listed in the Retraction Watch format
+    retracted = np.flatnonzero(has_doi & (rng.random(n) < retraction_rate))
+    retraction_dates = dates[retracted] + pd.to_timedelta(rng.integers(30, 1500, size=len(retracted)), unit='D')
+    retractions = pd.DataFrame({
+        'Record ID': np.arange(1, len(retracted) + 1),
+        'RetractionDate': retraction_dates.strftime('%-m/%-d/%Y 0:00'),
+        'RetractionDOI': [f'10.5555/retraction.{i}' for i in retracted],
+        'OriginalPaperDOI': [f'10.5555/synthetic.{i}' for i in retracted],
+        'RetractionNature': 'Retraction',
+        'Reason': '+Error in Data;',
+    })
+    return Corpus(publications, retractions, grid_id, year, researcher_ids)
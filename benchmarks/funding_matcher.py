@@ -0,0 +1,73 @@
+'''
+Benchmark of funding_matcher.match_funding() against the row-by-row loop it
+replaced in talent_program_checker.py.
+
+Run from the root of the repository with
+
+    python -m benchmarks.funding_matcher
+
+The loop is only timed up to LOOP_LIMIT publications because its repeated
+calls to pd.concat make it quadratic.
+'''
+import numpy as np
+import pandas as pd
+
+import re
+import time
+
+from funding_matcher import TALENT_PROGRAMS, match_funding
+
+SIZES: list[int] = [1000, 10000, 100000, 1000000]
+LOOP_LIMIT: int = 10000
+
+FUNDERS: list[str] = [
+    'the National Natural Science Foundation of China (Grant No. 51872123)',
+    'the Fundamental Research Funds for the Central Universities',
+    'the National Key R&D Program of China (2018YFA0703700)',
+    'the Engineering and Physical Sciences Research Council (EP/R000000/1)',
+    'the Jiangsu Shuangchuang Talents Program',
+]
+
+
+def synthetic_funding(n: int, p_program: float = 0.1, seed: int = 0) -> pd.DataFrame:
+    '''Generate n funding statements, a fraction of which name talent programs.'''
+    rng = np.random.default_rng(seed)
+    aliases = [alias for names in TALENT_PROGRAMS.values() for alias in names]
+    statements = []
+    for i in range(n):
+        parts = list(rng.choice(FUNDERS, size=rng.integers(1, 4), replace=False))
+        if rng.random() < p_program:
+            parts.insert(rng.integers(0, len(parts) + 1), 'the ' + rng.choice(aliases))
+        statements.append('This work was supported by ' + ', '.join(parts) + ', and startup funds.')
+    return pd.DataFrame({'id': [f'pub.{i:010d}' for i in range(n)], 'funding_section': statements})
+
+
+def legacy_loop(df_publications: pd.DataFrame) -> pd.DataFrame:
+    '''The original matching loop from talent_program_checker.py.'''
+    talents_programs = df_publications[df_publications['funding_section'].str.contains('talents program', case=False)]
+    talent_plans = pd.DataFrame()
+    df_temp = pd.DataFrame()
+    for i in range(talents_programs.shape[0]):
+        match = re.search(r',([^,]*Talents Program),', talents_programs['funding_section'].iloc[i])
+        if match:
+            result = match.group(1).strip()
+            df_temp = pd.DataFrame({'talent_plan': result}, index=[0])
+            df_temp['pub_id'] = talents_programs['id'].iloc[i]
+        talent_plans = pd.concat([talent_plans, df_temp])
+    return talent_plans
+
+
+def timed(fn, *args) -> tuple:
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    print(f'{"publications":>12} {"loop (s)":>10} {"matcher (s)":>12} {"speedup":>8} {"matches":>8} {"pubs/sec":>12}')
+    for n in SIZES:
+        df = synthetic_funding(n)
+        loop_time = timed(legacy_loop, df)[0] if n <= LOOP_LIMIT else float('nan')
+        matcher_time, matches = timed(match_funding, df)
+        print(f'{n:>12} {loop_time:>10.3f} {matcher_time:>12.3f} {loop_time / matcher_time:>8.1f} '
+              f'{len(matches):>8} {n / matcher_time:>12,.0f}')
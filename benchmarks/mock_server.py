@@ -0,0 +1,116 @@
+'''
+Local stand-in for the Dimensions API, serving a synthetic corpus.
+
+MockDimensions answers
+
+    POST /api/auth.json          with a token, for dimcli.login()
+    POST /api/dsl/v2             with the results of a DSL query, evaluated
+                                 by dsl_subset.PublicationIndex
+    GET  /retractionwatch        with the Retraction Watch CSV of the corpus
+
+and counts the queries, records and bytes it serves. Point the scripts at it
+by setting the DIMENSIONS_ENDPOINT and RETRACTION_WATCH_URL environment
+variables. To run it on its own:
+
+    python -m benchmarks.mock_server --size 10000 --port 8000
+'''
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+from benchmarks.corpus import Corpus, synthetic_corpus
+from dsl_subset import DslSyntaxError, PublicationIndex
+
+
+class MockDimensions(ThreadingHTTPServer):
+    '''HTTP server answering DSL queries from a synthetic corpus.'''
+
+    daemon_threads = True
+
+    def __init__(self, corpus: Corpus, port: int = 0, latency: float = 0.0):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.corpus = corpus
+        self.index = PublicationIndex(corpus.publications)
+        self.retractions_csv = corpus.retractions.to_csv(index=False).encode('ISO-8859-1')
+        self.latency = latency
+        self._lock = threading.Lock()
+        # Build the indexes of the fields the scripts filter on before timing starts
+        for path in ['id', 'doi', 'reference_ids', 'researchers.id', 'research_orgs', 'year']:
+            self.index._index(path)
+        self.reset()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.records = 0
+            self.bytes = 0
+            self.errors = 0
+
+    def count(self, records: int, size: int, error: bool = False):
+        with self._lock:
+            self.queries += 1
+            self.records += records
+            self.bytes += size
+            self.errors += error
+
+    def start(self) -> 'MockDimensions':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/api/auth'):
+            return self._send(200, json.dumps({'token': 'benchmark'}).encode())
+        if not self.path.startswith('/api/dsl'):
+            return self._send(404, b'{}')
+        if body.decode().strip() == 'describe version':
+            # Sent by dimcli when logging in
+            return self._send(200, json.dumps({'release': 'mock', 'version': '2.0'}).encode())
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            data = self.server.index.search(body.decode())
+        except DslSyntaxError as error:
+            # The API reports query errors in the body of a 200 response
+            payload = json.dumps({'errors': {'query': {'header': str(error)}}}).encode()
+            self.server.count(0, len(payload), error=True)
+            return self._send(200, payload)
+        payload = json.dumps(data).encode()
+        self.server.count(len(data['publications']), len(payload))
+        self._send(200, payload)
+
+    def do_GET(self):
+        if self.path.startswith('/retractionwatch'):
+            return self._send(200, self.server.retractions_csv, 'text/csv')
+        self._send(404, b'')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic corpus as a mock Dimensions API.')
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each DSL request')
+    args = parser.parse_args()
+
+    server = MockDimensions(synthetic_corpus(args.size), port=args.port, latency=args.latency)
+    print(f'Serving {args.size} publications at {server.url}/api/dsl/v2')
+    server.serve_forever()
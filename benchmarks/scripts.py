@@ -0,0 +1,202 @@
+'''
+Benchmark of the analysis scripts against a local mock of the Dimensions API.
+
+For each corpus size, a synthetic corpus is generated and served by
+benchmarks.mock_server, and each script is run in a fresh working directory
+(so that its query cache and harvests start empty) with the inputs it expects
+written from the corpus. Run from the root of the repository with
+
+    python -m benchmarks.scripts
+    python -m benchmarks.scripts --sizes 1000 10000 --scripts feet_of_clay aif --output before.json
+
+For every script and size the suite reports the wall time, the number of DSL
+queries and records served, the peak resident memory of the script and the
+records served per second. Saving the results with --output and comparing
+them with --compare shows the effect of a change between versions.
+
+With --backend local, the corpus is also written as a bulk export (as
+--export-format parquet or jsonl files) and the scripts read it through
+local_dsl.py instead of querying the mock API, which then only serves the
+Retraction Watch data. The queries and records reported are those served by
+the mock API, so are zero for local runs.
+
+The request quota is lifted to --rate requests per minute (by default
+effectively unlimited), so that the timings measure the scripts rather than
+the rate limiter.
+'''
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import synthetic_corpus
+from benchmarks.mock_server import MockDimensions
+
+REPO_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES: list[int] = [1000, 10000, 100000]
+SCRIPTS: list[str] = ['feet_of_clay', 'co_citation_percentile_rank', 'author_self_citation', 'aif',
+                      'talent_program_checker', 'integrity_report']
+
+# Settings of the scripts that select part of the corpus. These match the
+# module constants of feet_of_clay.py, aif.py and integrity_report.py.
+GRIDID: str = 'grid.6268.a'
+YEAR: int = 2025
+RESEARCHER_IDS: list[str] = ['ur.01024019836']
+
+# Files a bulk export is split into, so that it can be scanned in parallel
+EXPORT_PARTS: int = 4
+
+# Runs a script as __main__ and records its peak memory when it exits. The
+# resource usage reported by os.wait4 is not used for memory, because on Linux
+# ru_maxrss includes the memory of this process from before the script was
+# started, whereas VmHWM is reset when a new program is executed.
+LAUNCHER: str = '''
+import atexit, runpy, sys
+def peak_rss():
+    with open('/proc/self/status') as status, open('peak_rss_kb', 'w') as f:
+        f.write(next(line.split()[1] for line in status if line.startswith('VmHWM')))
+atexit.register(peak_rss)
+sys.argv = [sys.argv[1]]
+sys.path.insert(0, {repo!r})
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def write_inputs(corpus, script: str, path: str, seed: int = 0):
+    '''Write the input files a script reads, sized in proportion to the corpus.'''
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(path, 'data'), exist_ok=True)
+    n = len(corpus)
+    if script == 'co_citation_percentile_rank':
+        dois = [p['doi'] for p in corpus.publications[:n // 2] if 'doi' in p]
+        dois = rng.choice(dois, size=min(len(dois), max(10, n // 100)), replace=False)
+        pd.DataFrame({'doi': dois}).to_csv(os.path.join(path, 'data', 'publications.csv'), index=False)
+    elif script == 'author_self_citation':
+        researchers = sorted({r['id'] for p in corpus.publications for r in p['researchers']})
+        researchers = rng.choice(researchers, size=min(len(researchers), max(5, n // 500)), replace=False)
+        pd.DataFrame({'researcher_id': researchers}).to_csv(os.path.join(path, 'publications.csv'), index=False)
+    elif script == 'talent_program_checker':
+        ids = [p['id'] for p in corpus.publications]
+        ids = rng.choice(ids, size=max(100, n // 10), replace=False)
+        pd.DataFrame({'publication_id': ids}).to_csv(
+            os.path.join(path, 'data', 'aggregated_publications.csv'), index=False)
+
+
+def write_export(corpus, path: str, export_format: str = 'parquet', parts: int = EXPORT_PARTS):
+    '''Write the corpus as a bulk export of Parquet or gzipped JSON lines files.'''
+    os.makedirs(path, exist_ok=True)
+    size = -(-len(corpus.publications) // parts)
+    for part in range(parts):
+        records = corpus.publications[part * size:(part + 1) * size]
+        if export_format == 'parquet':
+            pq.write_table(pa.Table.from_struct_array(pa.array(records)),
+                           os.path.join(path, f'publications-{part:03d}.parquet'))
+        else:
+            with gzip.open(os.path.join(path, f'publications-{part:03d}.jsonl.gz'), 'wt') as f:
+                f.writelines(json.dumps(record) + '\n' for record in records)
+
+
+def run_script(server: MockDimensions, script: str, path: str, rate: int, export: str | None = None) -> dict:
+    '''Run a script against the mock server, or a bulk export if one is given, and measure it.'''
+    env = dict(os.environ,
+               API_KEY='benchmark',
+               DIMENSIONS_ENDPOINT=server.url + '/api/dsl/v2',
+               DIMENSIONS_RATE_PER_MINUTE=str(rate),
+               RETRACTION_WATCH_URL=server.url + '/retractionwatch')
+    if export:
+        env.update(DIMENSIONS_BACKEND='local', DIMENSIONS_EXPORT=export)
+    server.reset()
+    with open(os.path.join(path, 'output.log'), 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-c', LAUNCHER.format(repo=REPO_DIR),
+                                    os.path.join(REPO_DIR, script + '.py')],
+                                   cwd=path, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # os.wait4 gives the resource usage of this process alone
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        with open(os.path.join(path, 'output.log')) as log:
+            print(f'{script} failed:\n' + ''.join(log.readlines()[-20:]))
+    peak_rss = None
+    if os.path.exists(os.path.join(path, 'peak_rss_kb')):
+        with open(os.path.join(path, 'peak_rss_kb')) as f:
+            peak_rss = round(int(f.read()) / 1024, 1)
+    return {
+        'script': script,
+        'status': process.returncode,
+        'wall_s': round(wall, 3),
+        'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+        'queries': server.queries,
+        'records': server.records,
+        'mb_served': round(server.bytes / 1e6, 2),
+        # Not known if the script was killed, e.g. for running out of memory
+        'peak_rss_mb': peak_rss,
+        'records_per_s': round(server.records / wall, 1) if wall else None,
+    }
+
+
+def run(sizes: list, scripts: list, rate: int, latency: float, keep: bool, backend: str = 'dsl',
+        export_format: str = 'parquet') -> pd.DataFrame:
+    rows = []
+    for size in sizes:
+        corpus = synthetic_corpus(size, grid_id=GRIDID, year=YEAR, researcher_ids=RESEARCHER_IDS)
+        server = MockDimensions(corpus, latency=latency).start()
+        export = None
+        if backend == 'local':
+            export = tempfile.mkdtemp(prefix=f'export_{size}_')
+            write_export(corpus, export, export_format)
+        for script in scripts:
+            path = tempfile.mkdtemp(prefix=f'{script}_{size}_')
+            write_inputs(corpus, script, path)
+            result = run_script(server, script, path, rate, export)
+            rows.append(dict(size=size, **result))
+            print(f"{size} {script}: {result['wall_s']}s, {result['queries']} queries, "
+                  f"{result['peak_rss_mb']}MB peak RSS")
+            if keep:
+                print('Working directory kept in', path)
+            else:
+                shutil.rmtree(path)
+        server.shutdown()
+        server.server_close()
+        if export:
+            shutil.rmtree(export)
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against a mock Dimensions API.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--scripts', nargs='+', default=SCRIPTS, choices=SCRIPTS)
+    parser.add_argument('--rate', type=int, default=1000000, help='requests per minute allowed by the rate limiter')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each DSL request')
+    parser.add_argument('--backend', choices=['dsl', 'local'], default='dsl',
+                        help='query the mock API, or read the corpus as a local bulk export')
+    parser.add_argument('--export-format', choices=['parquet', 'jsonl'], default='parquet')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory of each run')
+    parser.add_argument('--output', help='save the results to a JSON file')
+    parser.add_argument('--compare', help='compare the results with a JSON file saved by an earlier run')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.scripts, args.rate, args.latency, args.keep, args.backend, args.export_format)
+    print()
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_json(args.output, orient='records', indent=2)
+    if args.compare:
+        baseline = pd.read_json(args.compare).set_index(['size', 'script'])
+        current = results.set_index(['size', 'script'])
+        metrics = ['wall_s', 'queries', 'peak_rss_mb', 'records_per_s']
+        ratio = (current[metrics] / baseline[metrics]).round(2).dropna(how='all')
+        print('\nRatio to', args.compare)
+        print(ratio.to_string())
@@ -0,0 +1,175 @@
+'''
+chunk_store.py streams the results of chunked Dimensions DSL queries to a
+partitioned Parquet dataset on disk as they arrive.
+
+Each completed chunk is written to its own Parquet file and recorded in a
+manifest, so an interrupted harvest resumes from the chunks that have not yet
+been completed rather than starting again, and the results never need to be
+accumulated in memory with repeated calls to pd.concat. Downstream steps read
+the dataset back one partition at a time with iter_frames(), or all at once
+with read().
+
+Usage:
+
+    store = ChunkStore(os.path.join(DATA_DIR, 'harvests', 'cited_publications_2025'))
+    store.harvest(dsl, queries)
+    for df in store.iter_frames(columns=['id', 'doi']):
+        ...
+
+The manifest records a fingerprint of the queries, so if the queries for a
+store change (e.g. because the input data has changed) the store is emptied
+and the harvest starts again.
+
+The manifest also records when each chunk was fetched and when the harvest
+was completed. Results go stale as the query cache's do (see dsl_cache.py),
+so when a store is harvested again, any chunk older than the lifetime of its
+query in the cache is fetched again, even if the harvest was completed, and
+only fresh chunks are kept.
+'''
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from dsl_cache import query_ttl
+from dsl_executor import MAX_WORKERS, iter_queries
+from instrumentation import tracer
+
+DEFAULT_TABLE: str = 'data'
+
+
+def fingerprint(queries: list) -> str:
+    return hashlib.sha256(json.dumps(list(queries)).encode('utf-8')).hexdigest()
+
+
+def write_parquet(df: pd.DataFrame, path: str):
+    '''Atomically write a data frame to a Parquet file.'''
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        # Missing values in columns of lists come back from dimcli as float NaN
+        df[col] = df[col].astype(object).where(df[col].notna(), None)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+class ChunkStore:
+    '''Checkpointed, partitioned Parquet dataset of chunked query results.'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'fingerprint': None, 'n_chunks': 0, 'completed': {}}
+
+    def reset(self, queries: list):
+        '''Remove every partition and start a new manifest for a list of queries.'''
+        for entry in os.listdir(self.path):
+            if os.path.isdir(os.path.join(self.path, entry)):
+                shutil.rmtree(os.path.join(self.path, entry))
+        self.manifest = {'fingerprint': fingerprint(queries), 'n_chunks': len(queries), 'completed': {}}
+        self._save_manifest()
+
+    def prepare(self, queries: list, **details):
+        '''
+        Reset the store if its queries have changed, and record details of how
+        the queries were planned in the manifest.
+        '''
+        if self.manifest['fingerprint'] != fingerprint(queries):
+            self.reset(queries)
+        if details:
+            self.manifest.update(details)
+            self._save_manifest()
+
+    def _save_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def expired(self, index: int, ttl: float | None, now: float) -> bool:
+        '''Check whether a completed chunk is older than the lifetime of its query.'''
+        # Chunks harvested before fetch times were recorded count as stale
+        return ttl is not None and self.manifest.get('fetched', {}).get(str(index), 0) + ttl < now
+
+    def write_chunk(self, index: int, frames: dict):
+        '''Write the tables for a completed chunk and record it in the manifest.'''
+        # Drop the files of an earlier fetch of the chunk, which a table left empty would not replace
+        for path in glob.glob(os.path.join(self.path, '*', f'part-{index:05d}.parquet')):
+            os.remove(path)
+        rows = {}
+        for table, df in frames.items():
+            os.makedirs(os.path.join(self.path, table), exist_ok=True)
+            if not df.empty:
+                write_parquet(df, os.path.join(self.path, table, f'part-{index:05d}.parquet'))
+            rows[table] = len(df)
+        self.manifest['completed'][str(index)] = rows
+        self.manifest.setdefault('fetched', {})[str(index)] = time.time()
+        self._save_manifest()
+
+    def harvest(self, dsl, queries: list, to_frames=None, iterative: bool = True,
+                max_workers: int = MAX_WORKERS) -> 'ChunkStore':
+        '''
+        Send the queries that have not already been completed and write each
+        result to the store as it arrives.
+
+        to_frames converts a query result to a dict of table name to data
+        frame, and defaults to {'data': results.as_dataframe()}.
+        '''
+        if to_frames is None:
+            to_frames = lambda results: {DEFAULT_TABLE: results.as_dataframe()}
+        self.prepare(queries)
+        now = time.time()
+        ttls = [query_ttl(q) for q in queries]
+        missing = [i for i in range(len(queries)) if str(i) not in self.manifest['completed']]
+        stale = [i for i in range(len(queries))
+                 if str(i) in self.manifest['completed'] and self.expired(i, ttls[i], now)]
+        pending = sorted(missing + stale)
+        if len(missing) < len(queries):
+            print(f'Resuming harvest in {self.path}: {len(queries) - len(missing)} of {len(queries)} chunks '
+                  f'already completed' + (f', {len(stale)} of them stale and fetched again' if stale else ''))
+        if pending:
+            self.manifest.pop('completed_at', None)
+        for i, results in iter_queries(dsl, [queries[i] for i in pending], iterative, max_workers):
+            start = time.perf_counter()
+            frames = to_frames(results)
+            converted = time.perf_counter()
+            self.write_chunk(pending[i], frames)
+            tracer.event('chunk', path=self.path, index=pending[i], convert=converted - start,
+                         write=time.perf_counter() - converted)
+        if 'completed_at' not in self.manifest:
+            self.manifest['completed_at'] = time.time()
+            self._save_manifest()
+        return self
+
+    def files(self, table: str = DEFAULT_TABLE) -> list:
+        return sorted(glob.glob(os.path.join(self.path, table, 'part-*.parquet')))
+
+    def iter_frames(self, columns: list | None = None, table: str = DEFAULT_TABLE):
+        '''Lazily read the store one partition at a time.'''
+        for path in self.files(table):
+            if columns is None:
+                yield pd.read_parquet(path)
+                continue
+            # Columns that were entirely missing from a chunk are not in its file
+            present = [col for col in columns if col in pq.read_schema(path).names]
+            yield pd.read_parquet(path, columns=present).reindex(columns=columns)
+
+    def read(self, columns: list | None = None, table: str = DEFAULT_TABLE) -> pd.DataFrame:
+        '''Read every partition of a table into a single data frame.'''
+        frames = list(self.iter_frames(columns, table))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def __len__(self) -> int:
+        return sum(rows.get(DEFAULT_TABLE, 0) for rows in self.manifest['completed'].values())
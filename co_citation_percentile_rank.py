@@ -25,8 +25,12 @@ To achieve its purpose, the code follows these steps:
 analyzed.
 - It connects to the Dimensions API, which is a database of scholarly 
 publications and citation data.
-- It retrieves the citation data for the input publications from the Dimensions API.
-- For each input publication, it finds the publications that cite it.
+- It resolves the DOIs of the input publications to Dimensions ids, using a 
+local index of DOIs and ids and only querying the Dimensions API for DOIs it has 
+not seen before.
+- It finds the publications that cite the input publications, batching many 
+input publications into each query, and assigns each citing publication to the 
+co-citation cohort of every input publication it cites.
 - It retrieves the citation data for the co-cited publications from the Dimensions API.
 - It calculates various metrics for the co-cited publications, such as the 
 number of citations, the citation rate, and the percentile rank based on the 
@@ -40,92 +44,97 @@ the citation rate (rate) for each co-cited publication. This is done by
 dividing the number of citations (times_cited) by the number of days since the 
 publication date (days) and then multiplying by 365 to get an annualized rate.
 
-Another key step is the calculation of the percentile rank (percentrank) for 
-each co-cited publication within the group of publications co-cited with the 
-same input publication. This is done using the rank() function from pandas, 
-which assigns a rank to each value in a group based on the specified method 
-(in this case, 'max' for the maximum value).
+Another key step is the calculation of the percentile rank (percentrank) of
+each input publication within the group of publications co-cited with it: the
+share of the group with a citation rate no higher than its own. Only the ranks
+of the input publications are needed, so rather than ranking every member of
+every group, the members at or below each input publication's rate are counted
+(see rank_engine.py). The output also gives the size of each group
+(cohort_size) and quantiles of the citation rates in it.
+
+co_citation_service.py serves the same ranks over HTTP from a long-running
+process with warm caches, for looking up a few DOIs at a time.
 '''
 from dotenv import load_dotenv
 
-import dimcli
-import numpy as np
 import pandas as pd
 
-import json
 import os
 
-# Housekeeping
-DATA_DIR: str = os.path.join(os.getcwd(), 'data')
-if not os.path.isdir(DATA_DIR):
-    os.mkdir(DATA_DIR)
-    print('Created folder : ', DATA_DIR)
-else:
-    print('Data folder already exists.')
-
-# Load a csv file containing the dois of publications to search for
-# The column containing DOIs should be called doi
-df_publications = pd.read_csv(os.path.join(DATA_DIR, 'publications.csv'))
-
-# Log into Dimensions API
-load_dotenv()
-API_KEY = os.getenv('API_KEY')
-dimcli.login(key=API_KEY, endpoint='https://app.dimensions.ai/api/dsl/v2')
-dsl = dimcli.Dsl()
-
-# Get the data for our publications
-split: int = int(np.ceil(df_publications.shape[0]/400))
-df_publications_split: list = np.array_split(df_publications, split)
-df_target_pubs = pd.DataFrame()
-for i in range(len(df_publications_split)): 
-    pubs = df_publications_split[i]['doi'].drop_duplicates().dropna()
-    results = dsl.query_iterative(f"""search publications where doi in {json.dumps(list(pubs))}
-                                      return publications[id+times_cited+date]""").as_dataframe()
-    df_target_pubs = pd.concat([df_target_pubs, results])
-
-# Get the co-citation cohort for our publications
-split: int = int(np.ceil(df_target_pubs.shape[0]/400))  
-df_target_pubs_split: list = np.array_split(df_target_pubs, split)
-df_co_cites = pd.DataFrame()
-for index, row in df_target_pubs.iterrows():
-    co_cites = dsl.query(f"""search publications where reference_ids = "{row['id']}"
-                             return publications[reference_ids] limit 1000""").as_dataframe()
-    co_cites['target_id'] = np.repeat(row['id'], len(co_cites))
-    df_co_cites = pd.concat([df_co_cites, co_cites])
-
-df_co_cites = df_co_cites.explode('reference_ids').drop_duplicates()  # This may be redundant for this evolution
-
-# Get the data for the co-citation cohort
-split: int = int(np.ceil(df_co_cites.shape[0]/400))
-df_co_cites_split = np.array_split(df_co_cites, split)
-df_final_data = pd.DataFrame()
-for i in range(len(df_co_cites_split)):
-    pubs = df_co_cites_split[i]['reference_ids'].drop_duplicates()
-    final_data = dsl.query_iterative(f"""search publications where id in {json.dumps(list(pubs))}
-                                         return publications[id+times_cited+date]""").as_dataframe()
-    df_final_data = pd.concat([df_final_data, final_data])
-
-dimcli.logout()
-
-df_final_data = pd.merge(
-    df_co_cites,
-    df_final_data,
-    left_on='reference_ids',
-    right_on='id',
-    how='left'
-).drop(columns=['id'])
-
-# Calculations
-df_final_data = df_final_data[df_final_data['date'].notnull()]
-df_final_data = df_final_data.sort_values('times_cited', ascending=False)
-df_final_data['times_cited'] = df_final_data['times_cited'].astype(int)
-df_final_data['date'] = pd.to_datetime(df_final_data['date'])
-df_final_data['days'] = pd.to_datetime('now') - df_final_data['date']
-df_final_data['days'] = df_final_data['days'].dt.days
-df_final_data['rate'] = round((df_final_data['times_cited']/df_final_data['days']) * 365, 2)
-df_final_data['percentrank'] = df_final_data.groupby(['target_id'])['rate'].rank(pct=True, method='max')
-df_final_data['percentrank'] = (df_final_data['percentrank'].round(2)) * 100
-df_final_data['percentrank'] = df_final_data['percentrank'].astype(int)
-df_output = df_final_data[df_final_data['reference_ids'] == df_final_data['target_id']].drop_duplicates()
-
-df_output.to_csv('co_citation_percentile_rank.csv', index=False)
\ No newline at end of file
+from backends import connect, disconnect
+from chunk_store import ChunkStore
+from cohort_snapshot import CohortSnapshot
+from cohorts import COHORT_DATA_QUERY, fetch_cohorts, percentile_ranks
+from id_index import IdIndex
+from instrumentation import stage
+from query_planner import QueryPlanner
+
+# Keep the cohorts in a snapshot between runs and only fetch what has changed
+# since the last run (see cohort_snapshot.py). Set CO_CITATION_INCREMENTAL=1 or
+# change this to True to turn it on.
+INCREMENTAL: bool = os.getenv('CO_CITATION_INCREMENTAL', '0') == '1'
+
+# Count each target's rank exactly, or set CO_CITATION_RANK_METHOD=digest to
+# estimate it from a t-digest of its cohort in bounded memory (see rank_engine.py)
+RANK_METHOD: str = os.getenv('CO_CITATION_RANK_METHOD', 'exact')
+
+# Query template for QueryPlanner
+DOI_QUERY: str = 'search publications where doi in {ids} return publications[id+doi+year+date]'
+
+
+def resolve_dois(dsl, index: IdIndex, planner: QueryPlanner, dois) -> pd.DataFrame:
+    '''
+    Get the Dimensions ids of publications from their DOIs, only querying the
+    API for DOIs that are not already in the local index.
+    '''
+    unresolved: list = index.unresolved_dois(dois)
+    if unresolved:
+        planner.fetch(dsl, DOI_QUERY, unresolved)
+    return index.lookup_dois(dois)
+
+
+if __name__ == '__main__':
+    # Housekeeping
+    DATA_DIR: str = os.path.join(os.getcwd(), 'data')
+    if not os.path.isdir(DATA_DIR):
+        os.mkdir(DATA_DIR)
+        print('Created folder : ', DATA_DIR)
+    else:
+        print('Data folder already exists.')
+
+    # Load a csv file containing the dois of publications to search for
+    # The column containing DOIs should be called doi
+    df_publications = pd.read_csv(os.path.join(DATA_DIR, 'publications.csv'))
+
+    # Connect to the Dimensions API or a local export
+    load_dotenv()
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
+    planner = QueryPlanner()
+
+    # Get the Dimensions ids for our publications
+    with stage('resolve_dois'):
+        df_target_pubs = resolve_dois(dsl, index, planner, df_publications['doi'])
+
+    if INCREMENTAL:
+        # Refresh the cohorts and ranks that have changed since the last run
+        snapshot = CohortSnapshot(os.path.join(DATA_DIR, 'co_citation_snapshot'))
+        df_output = snapshot.refresh(dsl, df_target_pubs['id'], planner, method=RANK_METHOD)
+    else:
+        # Get the co-citation cohort for our publications
+        with stage('cohorts'):
+            df_co_cites = fetch_cohorts(dsl, df_target_pubs['id'], planner)
+
+        # Get the data for the co-citation cohort
+        with stage('cohort_data'):
+            store = planner.harvest(ChunkStore(os.path.join(DATA_DIR, 'harvests', 'co_citation_cohort_data')), dsl,
+                                    COHORT_DATA_QUERY, df_co_cites['reference_ids'])
+            df_final_data = store.read(columns=['id', 'times_cited', 'date'])
+
+    disconnect(dsl)
+
+    if not INCREMENTAL:
+        with stage('rank'):
+            df_output = percentile_ranks(df_co_cites, df_final_data, method=RANK_METHOD)
+
+    df_output.to_csv('co_citation_percentile_rank.csv', index=False)
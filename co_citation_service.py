@@ -0,0 +1,271 @@
+'''
+co_citation_service.py serves co-citation percentile ranks over HTTP from a
+long-running process, for looking up a few DOIs at a time in the way the
+JYUcite web calculator is used.
+
+Start it with
+
+    python co_citation_service.py --port 8050
+
+and request the ranks of one or more DOIs with
+
+    curl 'http://localhost:8050/rank?doi=10.1234/abcd&doi=10.1234/efgh'
+
+which returns the same columns as co_citation_percentile_rank.csv, with the
+DOI of each target publication, as JSON. GET /stats reports the size and hit
+rate of each cache.
+
+The service logs into the Dimensions API once and keeps the session, the
+resolved DOIs, the co-citation cohorts and the times_cited and date of the
+co-cited publications in memory, evicting the least recently used entries
+when a cache is full. A lookup of a DOI whose cohort is already in memory
+sends no queries at all. Cohorts and citation counts expire after the same
+time as the query results they came from in the query cache (see
+dsl_cache.py), so the ranks of a service left running do not go stale.
+
+Requests that arrive together are coalesced. Each cache is filled by a
+BatchLoader, which collects the keys missing from the cache over a short
+window and fetches them in one batch of queries. A key already being fetched
+for another request is not fetched again, so concurrent requests for the same
+DOI, or for DOIs whose cohorts overlap, share the same upstream queries.
+'''
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+
+import argparse
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from backends import connect, disconnect
+from co_citation_percentile_rank import DOI_QUERY
+from cohorts import COHORT_DATA_QUERY, citing_query, fetch_cohorts, percentile_ranks
+from dsl_cache import query_ttl
+from id_index import IdIndex, normalize_dois
+from query_planner import QueryPlanner
+
+# Number of entries kept in each cache
+DOI_CACHE_SIZE: int = 100000
+COHORT_CACHE_SIZE: int = 2000
+PUBLICATION_CACHE_SIZE: int = 1000000
+
+# Seconds to wait for other requests before fetching a batch
+BATCH_WINDOW: float = 0.05
+
+MISSING = object()
+
+
+class LRUCache:
+    '''
+    Thread-safe mapping that evicts the least recently used entries, and
+    entries older than ttl seconds if a ttl is given.
+    '''
+
+    def __init__(self, max_entries: int, ttl: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self), 'max_entries': self.max_entries, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': round(self.hits / lookups, 3) if lookups else None}
+
+
+class BatchLoader:
+    '''
+    Loads values for keys through an LRUCache, fetching the keys missing from
+    the cache in batches shared between concurrent callers.
+
+    fetch_many takes a list of keys and returns a dict of key to value. Keys
+    it does not return are given the value None, which is not cached.
+    '''
+
+    def __init__(self, fetch_many, cache: LRUCache, window: float = BATCH_WINDOW):
+        self.fetch_many = fetch_many
+        self.cache = cache
+        self.window = window
+        self._pending = {}
+        self._inflight = {}
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def load_many(self, keys) -> dict:
+        futures = {}
+        with self._lock:
+            for key in keys:
+                if key in futures:
+                    continue
+                value = self.cache.get(key, MISSING)
+                if value is not MISSING:
+                    futures[key] = value
+                    continue
+                if key not in self._inflight:
+                    self._inflight[key] = self._pending[key] = Future()
+                futures[key] = self._inflight[key]
+            if self._pending and not self._scheduled:
+                self._scheduled = True
+                threading.Timer(self.window, self._flush).start()
+        return {key: value.result() if isinstance(value, Future) else value for key, value in futures.items()}
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending, self._scheduled = self._pending, {}, False
+        try:
+            values = self.fetch_many(list(pending))
+        except Exception as error:
+            for future in pending.values():
+                future.set_exception(error)
+        else:
+            for key, future in pending.items():
+                value = values.get(key)
+                if value is not None:
+                    self.cache.put(key, value)
+                future.set_result(value)
+        finally:
+            with self._lock:
+                for key in pending:
+                    self._inflight.pop(key, None)
+
+
+class CoCitationService:
+    '''Co-citation percentile ranks from warm, coalescing caches.'''
+
+    def __init__(self, dsl, index: IdIndex, planner: QueryPlanner):
+        self.dsl = dsl
+        self.index = index
+        self.planner = planner
+        self.dois = BatchLoader(self._fetch_ids, LRUCache(DOI_CACHE_SIZE, query_ttl(DOI_QUERY)))
+        self.cohorts = BatchLoader(self._fetch_cohorts, LRUCache(COHORT_CACHE_SIZE, query_ttl(citing_query())))
+        self.publications = BatchLoader(self._fetch_publications,
+                                        LRUCache(PUBLICATION_CACHE_SIZE, query_ttl(COHORT_DATA_QUERY)))
+
+    def _fetch_ids(self, dois: list) -> dict:
+        unresolved = self.index.unresolved_dois(dois)
+        if unresolved:
+            self.planner.fetch(self.dsl, DOI_QUERY, unresolved)
+        return {doi: self.index.by_doi.get(doi) for doi in dois}
+
+    def _fetch_cohorts(self, target_ids: list) -> dict:
+        df_co_cites = fetch_cohorts(self.dsl, target_ids, self.planner)
+        cohorts = {target_id: group.to_numpy()
+                   for target_id, group in df_co_cites.groupby('target_id')['reference_ids']}
+        # A publication that has never been cited has an empty cohort
+        return {target_id: cohorts.get(target_id, np.array([], dtype=object)) for target_id in target_ids}
+
+    def _fetch_publications(self, pub_ids: list) -> dict:
+        return {record['id']: (record.get('times_cited'), record.get('date'))
+                for results in self.planner.fetch(self.dsl, COHORT_DATA_QUERY, pub_ids)
+                for record in results.json.get('publications', [])}
+
+    def rank(self, dois: list) -> pd.DataFrame:
+        '''Get the co-citation percentile rank of publications from their DOIs.'''
+        dois = normalize_dois(pd.Series(dois, dtype=object)).dropna().unique().tolist()
+        target_ids = {doi: pub_id for doi, pub_id in self.dois.load_many(dois).items() if pub_id}
+        cohorts = self.cohorts.load_many(target_ids.values())
+        # Object arrays, so that the columns can be merged even when no DOI was found
+        df_co_cites = pd.DataFrame({
+            'reference_ids': np.concatenate([cohort for cohort in cohorts.values()] or [np.array([], dtype=object)]),
+            'target_id': np.repeat(np.array(list(cohorts), dtype=object), [len(cohort) for cohort in cohorts.values()]),
+        })
+        publications = self.publications.load_many(df_co_cites['reference_ids'].unique())
+        df_cohort_data = pd.DataFrame(
+            [(pub_id,) + values for pub_id, values in publications.items() if values is not None],
+            columns=['id', 'times_cited', 'date'])
+        df_output = percentile_ranks(df_co_cites, df_cohort_data)
+        df_output.insert(0, 'doi', df_output['target_id'].map({pub_id: doi for doi, pub_id in target_ids.items()}))
+        return df_output
+
+    def stats(self) -> dict:
+        return {name: loader.cache.stats() for name, loader in
+                [('dois', self.dois), ('cohorts', self.cohorts), ('publications', self.publications)]}
+
+
+class CoCitationServer(ThreadingHTTPServer):
+    '''HTTP server for a CoCitationService.'''
+
+    daemon_threads = True
+
+    def __init__(self, service: CoCitationService, host: str = '127.0.0.1', port: int = 8050):
+        super().__init__((host, port), CoCitationHandler)
+        self.service = service
+
+
+class CoCitationHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status: int, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self._send(200, self.server.service.stats())
+        if url.path != '/rank':
+            return self._send(404, {'error': 'Not found'})
+        dois = parse_qs(url.query).get('doi', [])
+        if not dois:
+            return self._send(400, {'error': 'Give one or more DOIs with ?doi='})
+        try:
+            df_output = self.server.service.rank(dois)
+        except Exception as error:
+            return self._send(502, {'error': str(error)})
+        self._send(200, {'results': df_output.to_dict('records'),
+                         'not_found': sorted(set(normalize_dois(pd.Series(dois, dtype=object)).dropna())
+                                             - set(df_output['doi']))})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve co-citation percentile ranks over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    args = parser.parse_args()
+
+    load_dotenv()
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
+
+    server = CoCitationServer(CoCitationService(dsl, index, QueryPlanner()), args.host, args.port)
+    print(f'Serving co-citation percentile ranks at http://{args.host}:{args.port}/rank?doi=')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        disconnect(dsl)
@@ -0,0 +1,143 @@
+'''
+cohort_snapshot.py keeps the co-citation cohorts of co_citation_percentile_rank.py
+between runs, so that refreshing a report only fetches what has changed.
+
+A snapshot is a folder, by default data/co_citation_snapshot, holding
+
+    citing.parquet        the id and reference_ids of every publication citing a target
+    publications.parquet  the id, times_cited and date of every cohort member, and
+                          the date times_cited was fetched
+    ranks.parquet         the percentile rank of every target at the last refresh
+    manifest.json         the date of the last refresh and the targets it covered
+
+refresh() brings the snapshot up to date for a list of target publications:
+
+- Targets that are not in the snapshot have all their citing publications
+  fetched, as in a full run.
+- For targets already in the snapshot, only citing publications added to
+  Dimensions since the last refresh are fetched, with a date_inserted filter.
+- The times_cited of the targets themselves is fetched on every refresh, so
+  their ranks are current. The times_cited and date of other cohort members
+  are only fetched for members that are new to the snapshot, or whose
+  times_cited was fetched more than MAX_AGE days ago.
+- A target's cohort has changed if it is new, has new citing publications or
+  has members other than targets whose times_cited was fetched again, and
+  the number of changed cohorts is reported.
+- Every target is ranked again, as its own times_cited has been fetched
+  again, which only counts rates already in memory. The citation rate of
+  each member is its times_cited per year up to the date it was fetched, so
+  members fetched at different times are compared fairly.
+
+Citing publications whose reference lists are corrected after they were added
+to Dimensions are not picked up until the snapshot is rebuilt, by deleting the
+folder.
+'''
+import pandas as pd
+
+from datetime import date
+import json
+import os
+
+from chunk_store import write_parquet
+from cohorts import COHORT_DATA_QUERY, assign_cohorts, fetch_citing, percentile_ranks
+from instrumentation import stage
+from query_planner import QueryPlanner, unique_ids
+from rank_engine import QUANTILES, quantile_column
+
+SNAPSHOT_DIR: str = os.path.join(os.getcwd(), 'data', 'co_citation_snapshot')
+
+# Days before the times_cited of a cohort member other than a target is fetched again
+MAX_AGE: int = 365
+
+TABLES: dict = {
+    'citing': ['id', 'reference_ids'],
+    'publications': ['id', 'times_cited', 'date', 'fetched'],
+    'ranks': ['reference_ids', 'target_id', 'times_cited', 'date', 'days', 'rate', 'percentrank', 'cohort_size']
+             + [quantile_column(q) for q in QUANTILES] + ['as_of'],
+}
+
+
+class CohortSnapshot:
+    '''Co-citation cohorts and ranks kept between runs for incremental refreshes.'''
+
+    def __init__(self, path: str = SNAPSHOT_DIR):
+        self.path = path
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {'as_of': None, 'targets': []}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        for table, columns in TABLES.items():
+            table_path = os.path.join(path, f'{table}.parquet')
+            setattr(self, table, pd.read_parquet(table_path) if os.path.exists(table_path)
+                    else pd.DataFrame(columns=columns))
+
+    def save(self):
+        for table in TABLES:
+            write_parquet(getattr(self, table), os.path.join(self.path, f'{table}.parquet'))
+        # The manifest is written last, so an interrupted save is refreshed again
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def refresh(self, dsl, target_ids, planner: QueryPlanner | None = None, today: str | None = None,
+                method: str = 'exact') -> pd.DataFrame:
+        '''
+        Update the snapshot for a list of target publication ids and return
+        their percentile ranks, counted by percentile_ranks() with the given
+        method.
+        '''
+        planner = planner if planner is not None else QueryPlanner()
+        today = pd.Timestamp(today or date.today()).normalize()
+        target_ids = unique_ids(target_ids)
+        known = set(self.manifest['targets'])
+        new_targets = [target_id for target_id in target_ids if target_id not in known]
+        old_targets = [target_id for target_id in target_ids if target_id in known]
+
+        with stage('cohorts'):
+            frames = []
+            if new_targets:
+                frames.append(fetch_citing(dsl, new_targets, planner=planner))
+            if old_targets:
+                frames.append(fetch_citing(dsl, old_targets, planner=planner, since=self.manifest['as_of']))
+            # There is nothing to fetch when refreshing an empty list of targets
+            new_citing = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=TABLES['citing'])
+            new_citing = new_citing.filter(TABLES['citing']).drop_duplicates('id')
+            new_citing = new_citing[~new_citing['id'].isin(self.citing['id'])]
+            self.citing = pd.concat([self.citing, new_citing], ignore_index=True)
+            changed = set(new_targets) | set(assign_cohorts(new_citing, target_ids)['target_id'])
+            df_co_cites = assign_cohorts(self.citing, target_ids)
+
+        with stage('cohort_data'):
+            fetched = df_co_cites['reference_ids'].map(self.publications.set_index('id')['fetched'])
+            age = (today - pd.to_datetime(fetched)).dt.days
+            stale = age.isna() | (age > MAX_AGE)
+            is_target = df_co_cites['reference_ids'].isin(set(target_ids))
+            # A cohort has changed if a member other than a target was fetched again
+            changed |= set(df_co_cites.loc[stale & ~is_target, 'target_id'])
+            requested = unique_ids(df_co_cites.loc[stale | is_target, 'reference_ids'])
+            results = planner.fetch(dsl, COHORT_DATA_QUERY, requested)
+            records = pd.DataFrame([record for result in results for record in result.json.get('publications', [])],
+                                   columns=['id', 'times_cited', 'date'])
+            # Members the API no longer returns are recorded too, so they are not requested on every refresh
+            fresh = pd.merge(pd.DataFrame({'id': pd.Series(requested, dtype=object)}),
+                             records.drop_duplicates('id').astype({'id': object}), on='id', how='left')
+            fresh['fetched'] = today.strftime('%Y-%m-%d')
+            self.publications = pd.concat([self.publications[~self.publications['id'].isin(fresh['id'])], fresh],
+                                          ignore_index=True)
+
+        with stage('rank'):
+            # Every target is ranked again, as its own times_cited has been fetched again.
+            # Counting the ranks is local and cheap next to fetching the cohorts.
+            df_ranks = percentile_ranks(df_co_cites, self.publications, observed='fetched', method=method)
+            df_ranks['as_of'] = today.strftime('%Y-%m-%d')
+            self.ranks = pd.concat([self.ranks[~self.ranks['target_id'].isin(target_ids)], df_ranks],
+                                   ignore_index=True)
+
+        print(f'{len(changed)} of {len(target_ids)} cohorts changed, fetching {new_citing.shape[0]} new citing '
+              f'publications and the times_cited of {fresh.shape[0]} cohort members and targets, '
+              f'and ranked all {df_ranks.shape[0]} targets with a cohort again')
+        self.manifest = {'as_of': today.strftime('%Y-%m-%d'), 'targets': sorted(known | set(target_ids))}
+        self.save()
+        return self.ranks[self.ranks['target_id'].isin(target_ids)]
@@ -0,0 +1,133 @@
+'''
+cohorts.py retrieves the co-citation cohorts of a set of target publications
+from the Dimensions API.
+
+The co-citation cohort of a target publication is every publication cited
+alongside it, i.e. the reference lists of all the publications that cite the
+target. Rather than sending one query per target, many targets are batched
+into a single reference_ids in [...] query, and the citing publications
+returned are assigned to the targets they cite locally. The targets are packed
+into queries by a QueryPlanner, which sizes the batches from the number of
+citing publications previously returned per target. Every query is paged to
+completion, and a batch whose citing publications exceed the 50,000 record
+limit of an iterative query is split in half and re-sent, so cohorts are never
+silently truncated.
+
+fetch_citing() does the batched retrieval of citing publications on its own,
+for analyses that need other fields of the citing publications.
+
+percentile_ranks() ranks each target publication by citation rate among the
+publications in its cohort, counting only what is needed for the rank of the
+target rather than ranking every member (see rank_engine.py).
+'''
+import numpy as np
+import pandas as pd
+
+from query_planner import IDS, QueryPlanner
+from rank_engine import CHUNK_ROWS, QUANTILES, RankEngine
+
+# Query template for the times_cited and date of cohort members, for QueryPlanner
+COHORT_DATA_QUERY: str = 'search publications where id in {ids} return publications[id+times_cited+date]'
+
+
+def citing_query(fields: str = 'id+reference_ids', since: str | None = None) -> str:
+    '''
+    Query template for the publications citing a list of targets, for
+    QueryPlanner, optionally only those added to Dimensions since a date.
+    '''
+    inserted = f' and date_inserted >= "{since}"' if since else ''
+    return f"""search publications where reference_ids in {IDS}{inserted}
+               return publications[{fields}]"""
+
+
+def assign_cohorts(citing: pd.DataFrame, target_ids) -> pd.DataFrame:
+    '''
+    Build the co-citation cohorts for a set of targets from the id and
+    reference_ids of the publications citing them.
+
+    Returns one row per target_id and co-cited publication (reference_ids),
+    including the target itself.
+    '''
+    if citing.empty:
+        return pd.DataFrame(columns=['reference_ids', 'target_id'])
+    edges = (
+        citing
+        .filter(['id', 'reference_ids'])
+        .explode('reference_ids')
+        .dropna()
+    )
+    # Each citing publication belongs to the cohort of every target it cites
+    membership = (
+        edges[edges['reference_ids'].isin(set(target_ids))]
+        .rename(columns={'reference_ids': 'target_id'})
+    )
+    cohorts = pd.merge(membership, edges, on='id', how='inner')
+    return cohorts.filter(['reference_ids', 'target_id']).drop_duplicates()
+
+
+def fetch_citing(dsl, target_ids, fields: str = 'id+reference_ids',
+                 planner: QueryPlanner | None = None, since: str | None = None) -> pd.DataFrame:
+    '''
+    Get every publication citing any of the target publications in batched
+    queries, with one row per citing publication. If since is given as a
+    YYYY-MM-DD date, only publications added to Dimensions on or after that
+    date are returned.
+    '''
+    planner = planner if planner is not None else QueryPlanner()
+    frames = [result.as_dataframe() for result in planner.fetch(dsl, citing_query(fields, since), target_ids)
+              if result.json.get('publications')]
+    if not frames:
+        return pd.DataFrame(columns=fields.split('+'))
+    # A publication citing targets in several batches is returned by each of them
+    return pd.concat(frames, ignore_index=True).drop_duplicates('id')
+
+
+def fetch_cohorts(dsl, target_ids, planner: QueryPlanner | None = None) -> pd.DataFrame:
+    '''Get the co-citation cohorts of the target publications in batched queries.'''
+    return assign_cohorts(fetch_citing(dsl, target_ids, planner=planner), target_ids)
+
+
+def percentile_ranks(df_co_cites: pd.DataFrame, df_cohort_data: pd.DataFrame,
+                     as_of: pd.Timestamp | None = None, observed: str | None = None,
+                     method: str = 'exact', quantiles: tuple = QUANTILES) -> pd.DataFrame:
+    '''
+    Rank each target publication by citation rate within its co-citation
+    cohort.
+
+    df_co_cites has one row per target_id and co-cited publication
+    (reference_ids), as returned by cohorts.fetch_cohorts(), and
+    df_cohort_data the id, times_cited and date of the co-cited publications.
+    Citation rates are calculated at the as_of date, by default now, or if
+    observed names a column of df_cohort_data, at the date in that column on
+    which each publication's times_cited was retrieved.
+
+    Returns one row per target, with its rate, percentrank, the number of
+    ranked members of its cohort (cohort_size) and quantiles of their rates.
+    Ranks are counted by a RankEngine (see rank_engine.py), exactly or, with
+    method='digest', estimated from a t-digest of each cohort.
+    '''
+    # Citation rates are calculated once per publication, not once per cohort it is in
+    df_data = df_cohort_data[df_cohort_data['date'].notnull()].drop_duplicates('id').reset_index(drop=True)
+    df_data['date'] = pd.to_datetime(df_data['date'])
+    if observed is not None:
+        as_of = pd.to_datetime(df_data.pop(observed))
+    df_data['days'] = ((pd.to_datetime('now') if as_of is None else as_of) - df_data['date']).dt.days
+    df_data['rate'] = round((df_data['times_cited'] / df_data['days']) * 365, 2)
+
+    # Targets are ranked if they are in their own cohort and have a citation rate
+    own = df_co_cites['reference_ids'].to_numpy() == df_co_cites['target_id'].to_numpy()
+    targets = pd.unique(df_co_cites.loc[own, 'target_id'])
+    df_targets = pd.merge(pd.DataFrame({'reference_ids': targets, 'target_id': targets}),
+                          df_data.rename(columns={'id': 'reference_ids'}), on='reference_ids', how='inner')
+
+    engine = RankEngine(df_targets['target_id'], df_targets['rate'], quantiles, method)
+    members = pd.Index(df_data['id'].to_numpy(dtype=object))
+    rates = df_data['rate'].to_numpy(dtype=float)
+    for start in range(0, len(df_co_cites), CHUNK_ROWS):
+        chunk = df_co_cites.iloc[start:start + CHUNK_ROWS]
+        positions = members.get_indexer(chunk['reference_ids'])
+        engine.add(chunk['target_id'].to_numpy(), np.where(positions >= 0, rates[positions], np.nan))
+
+    df_output = pd.merge(df_targets, engine.result(), on='target_id', how='inner')
+    df_output['times_cited'] = df_output['times_cited'].astype(int)
+    return df_output.sort_values('times_cited', ascending=False, kind='stable').reset_index(drop=True)
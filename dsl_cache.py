@@ -0,0 +1,249 @@
+'''
+dsl_cache.py provides a persistent on-disk cache for Dimensions DSL query
+results that is shared by all the scripts in this repository.
+
+Results are stored in a SQLite database keyed on the normalized text of the
+DSL query and the set of fields it returns, so re-running a report over the
+same institution or list of DOIs costs close to zero API calls.
+
+Cached results expire according to what they contain. Reference lists, DOIs
+and publication dates never change once a publication exists, but fields such
+as times_cited go stale, and searches that filter on reference_ids (i.e. who
+cites a publication) pick up new citing papers over time. The lifetime of a
+cached result is the shortest lifetime of any field it returns or filters on.
+
+The cache is bounded in size: when it grows beyond max_bytes the least
+recently used results are evicted.
+
+Usage:
+
+    dimcli.login(key=API_KEY, endpoint='https://app.dimensions.ai/api/dsl/v2')
+    dsl = CachedDsl(dimcli.Dsl())
+    results = dsl.query_iterative('search publications where ... return publications[id+doi]')
+    print(dsl.cache)
+'''
+import dimcli
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from instrumentation import tracer
+
+DAY: int = 86400
+
+CACHE_PATH: str = os.path.join(os.getcwd(), 'data', 'dsl_cache.sqlite')
+
+# Lifetime in seconds of a cached result by the fields it returns. None means
+# the value never changes once a publication exists.
+RETURN_TTL: dict = {
+    'id': None,
+    'doi': None,
+    'year': None,
+    'date': None,
+    'title': None,
+    'source_title': None,
+    'publisher': None,
+    'reference_ids': None,
+    'times_cited': 7 * DAY,
+    'recent_citations': 7 * DAY,
+    'field_citation_ratio': 7 * DAY,
+    'relative_citation_ratio': 7 * DAY,
+    'altmetric': 7 * DAY,
+}
+
+# Lifetime in seconds of a cached result by the fields it filters on. Searches
+# on a fixed list of identifiers always match the same publications, but
+# searches by citation, researcher or institution match new publications as
+# they are indexed.
+FILTER_TTL: dict = {
+    'id': None,
+    'doi': None,
+    'reference_ids': 7 * DAY,
+    'researchers.id': 7 * DAY,
+    'research_orgs': 7 * DAY,
+}
+
+# Lifetime of anything not listed above, e.g. authors and affiliations which
+# change as researchers are disambiguated
+DEFAULT_TTL: int = 30 * DAY
+
+
+def normalize_query(q: str) -> str:
+    '''Collapse whitespace in a DSL query outside of quoted strings.'''
+    parts = re.split(r'("(?:[^"\\]|\\.)*")', q.strip())
+    return ''.join(part if part.startswith('"') else re.sub(r'\s+', ' ', part) for part in parts).strip()
+
+
+def returned_fields(q: str) -> list:
+    '''Get the sorted list of fields returned by a DSL query.'''
+    match = re.search(r'return\s+\w+\s*\[([^\]]*)\]', q)
+    if not match:
+        return []
+    return sorted(field.strip() for field in match.group(1).split('+') if field.strip())
+
+
+def filtered_fields(q: str) -> list:
+    '''Get the sorted list of fields a DSL query filters on.'''
+    match = re.search(r'\bwhere\b(.*?)(?:\breturn\b|$)', q, flags=re.S)
+    if not match:
+        return []
+    # Drop quoted values so that they cannot be mistaken for field names
+    clause = re.sub(r'"(?:[^"\\]|\\.)*"', '""', match.group(1))
+    fields = re.findall(r'([a-z_][\w.]*)\s*(?:=|!=|>=|<=|>|<|~|\bin\b|\bis\b)', clause)
+    return sorted(set(field for field in fields if field not in ('and', 'or', 'not')))
+
+
+def query_ttl(q: str) -> float | None:
+    '''Get the number of seconds a result for a DSL query stays fresh.'''
+    ttls = [RETURN_TTL.get(field, DEFAULT_TTL) for field in returned_fields(q)]
+    ttls += [FILTER_TTL.get(field, DEFAULT_TTL) for field in filtered_fields(q)]
+    ttls = [ttl for ttl in ttls if ttl is not None]
+    return min(ttls) if ttls else None
+
+
+def cache_key(q: str, mode: str = 'query') -> str:
+    '''Build the cache key for a DSL query from its normalized text and returned fields.'''
+    text = normalize_query(q)
+    # The order of returned fields does not change the result
+    text = re.sub(r'(return\s+\w+\s*)\[[^\]]*\]', lambda m: m.group(1).rstrip() + '[]', text)
+    payload = json.dumps([mode, text, returned_fields(q)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class QueryCache:
+    '''
+    SQLite-backed store of DSL results with per-field TTLs, size-bounded
+    LRU eviction and hit/miss counters.
+    '''
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = 2 * 1024**3):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS results (
+                                key TEXT PRIMARY KEY,
+                                query TEXT,
+                                payload BLOB,
+                                size INTEGER,
+                                created REAL,
+                                accessed REAL,
+                                expires REAL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+        self._db.commit()
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def get(self, key: str) -> dict | None:
+        '''Get the JSON data cached under a key, or None if it is missing or stale.'''
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT payload, size, expires FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            payload, size, expires = row
+            if expires is not None and expires < now:
+                self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                self._db.commit()
+                self._size -= size
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(payload))
+
+    def put(self, key: str, q: str, data: dict, ttl: float | None):
+        '''Store JSON data under a key and evict least recently used results if over budget.'''
+        payload = zlib.compress(json.dumps(data).encode('utf-8'))
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            old = self._db.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, normalize_query(q), payload, len(payload), now, now, expires))
+            self._size += len(payload)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            row = self._db.execute('SELECT key, size FROM results ORDER BY accessed LIMIT 1').fetchone()
+            if row is None:
+                break
+            self._db.execute('DELETE FROM results WHERE key = ?', (row[0],))
+            self._size -= row[1]
+            self.evictions += 1
+
+    def clear(self):
+        '''Remove every cached result.'''
+        with self._lock:
+            self._db.execute('DELETE FROM results')
+            self._db.commit()
+            self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __str__(self) -> str:
+        total = self.hits + self.misses
+        rate = round(100 * self.hits / total, 1) if total else 0.0
+        return (f'DSL cache {self.path}: {self.hits} hits, {self.misses} misses ({rate}% hit rate), '
+                f'{self.evictions} evicted, {round(self._size / 1024**2, 1)} MB stored')
+
+
+class CachedDsl:
+    '''
+    Drop-in wrapper for dimcli.Dsl that answers query() and query_iterative()
+    from a QueryCache where it can and stores every new result.
+
+    listeners are called with the query text and JSON data of every result,
+    whether fetched from the API or the cache, e.g. to fill in an IdIndex, so
+    that an index deleted or behind the cache is filled in again.
+    '''
+
+    def __init__(self, dsl, cache: QueryCache | None = None, listeners: list = ()):
+        self.dsl = dsl
+        self.cache = cache if cache is not None else QueryCache()
+        self.listeners = list(listeners)
+
+    def query(self, q: str, **kwargs):
+        return self._cached(q, 'query', self.dsl.query, **kwargs)
+
+    def query_iterative(self, q: str, **kwargs):
+        return self._cached(q, 'iterative', self.dsl.query_iterative, **kwargs)
+
+    def _cached(self, q: str, mode: str, fetch, **kwargs):
+        key = cache_key(q, mode)
+        start = time.perf_counter()
+        data = self.cache.get(key)
+        if data is not None:
+            source = re.search(r'return\s+(\w+)', q)
+            tracer.query(q, cached=True, latency=time.perf_counter() - start,
+                         records=len(data.get(source.group(1), [])) if source else 0)
+            self._notify(q, data)
+            return dimcli.DslDataset(data)
+        results = fetch(q, **kwargs)
+        # Errors, failed logins and raw HTTP responses are never cached
+        if isinstance(results, dimcli.DslDataset) and not results.json.get('errors'):
+            self.cache.put(key, q, results.json, query_ttl(q))
+            self._notify(q, results.json)
+        return results
+
+    def _notify(self, q: str, data: dict):
+        for listener in self.listeners:
+            listener(q, data)
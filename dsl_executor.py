@@ -0,0 +1,202 @@
+'''
+dsl_executor.py sends chunked Dimensions DSL queries concurrently while
+keeping under the per-minute request quota of a Dimensions subscription.
+
+RateLimitedDsl wraps a logged-in dimcli.Dsl so that every HTTP request it
+makes, including each page of an iterative query, first takes a token from a
+shared token bucket. Requests that fail with HTTP 429 or a 5xx error are
+retried with jittered exponential backoff. A query the API rejects, e.g. for
+its syntax or size, raises a DslError.
+
+run_queries() sends a list of queries from a thread pool and returns the
+results in the same order as the queries, so the scripts can replace their
+sequential np.array_split loops with
+
+    queries = [f"""search publications where id in {json.dumps(list(chunk))}
+                   return publications[id+doi]""" for chunk in chunks]
+    results = run_queries(dsl, queries)
+
+Wall time is then bounded by the quota rather than the latency of each
+round trip. iter_pages() yields the pages of a large query one at a time,
+for callers that reduce each page before fetching the next.
+'''
+import dimcli
+import requests
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import random
+import re
+import threading
+import time
+
+from instrumentation import tracer
+
+# The Dimensions API endpoint, which can be overridden with the
+# DIMENSIONS_ENDPOINT environment variable, e.g. to use a local mock server
+DSL_ENDPOINT: str = 'https://app.dimensions.ai/api/dsl/v2'
+
+# The Dimensions API allows 30 requests per minute for most subscriptions
+RATE_PER_MINUTE: int = int(os.getenv('DIMENSIONS_RATE_PER_MINUTE', 30))
+MAX_WORKERS: int = 4
+MAX_RETRIES: int = 5
+
+# The API returns at most 1000 records per request and 50,000 per query
+PAGE_SIZE: int = 1000
+MAX_RECORDS: int = 50000
+
+RETURN_SOURCE = re.compile(r'return\s+(\w+)')
+
+
+class DslError(requests.HTTPError):
+    '''A query rejected by the Dimensions API, e.g. for its syntax or its size.'''
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket that releases rate_per_minute tokens per minute
+    with at most burst tokens available at once.
+    '''
+
+    def __init__(self, rate_per_minute: float = RATE_PER_MINUTE, burst: int = 1):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        '''Block until a token is available and return the time spent waiting.'''
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def sleep(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+def backoff(attempt: int, base: float = 2.0, cap: float = 60.0) -> float:
+    '''Full-jitter exponential backoff delay in seconds for a retry attempt.'''
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class RateLimitedDsl:
+    '''
+    Wrapper for dimcli.Dsl that rate limits and retries every request.
+
+    Several RateLimitedDsl objects (or threads sharing one) can draw from the
+    same TokenBucket to keep a whole process under the quota.
+    '''
+
+    def __init__(self, dsl, bucket: TokenBucket | None = None, max_retries: int = MAX_RETRIES):
+        self.dsl = dsl
+        self.bucket = bucket if bucket is not None else TokenBucket()
+        self.max_retries = max_retries
+
+    def query(self, q: str, **kwargs):
+        '''Send a single DSL query and return a dimcli.DslDataset.'''
+        attempt, throttle, waited = 0, 0.0, 0.0
+        while True:
+            throttle += self.bucket.acquire()
+            try:
+                start = time.perf_counter()
+                response = requests.post(self.dsl._url, data=q.encode(), headers=self.dsl._headers,
+                                         verify=self.dsl.verify_ssl)
+                latency = time.perf_counter() - start
+            except requests.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                waited += sleep(backoff(attempt))
+                attempt += 1
+                continue
+            if response.status_code == 403 and attempt < self.max_retries:
+                # The login token has expired
+                self.dsl._refresh_login()
+                attempt += 1
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt >= self.max_retries:
+                    response.raise_for_status()
+                retry_after = response.headers.get('Retry-After', '')
+                delay = float(retry_after) if retry_after.isdigit() else backoff(attempt)
+                waited += sleep(delay)
+                attempt += 1
+                continue
+            if response.status_code not in (200, 400):
+                response.raise_for_status()
+            start = time.perf_counter()
+            data = response.json()
+            decode = time.perf_counter() - start
+            results = dimcli.DslDataset(data)
+            source = RETURN_SOURCE.search(q)
+            tracer.query(q, status=response.status_code, latency=latency, decode=decode, throttle=throttle,
+                         backoff=waited, retries=attempt, bytes=len(response.content),
+                         records=len(data.get(source.group(1), [])) if source else 0)
+            if results.json.get('errors'):
+                raise DslError(f'DSL error {results.json["errors"]} in {q[:200]!r}', response=response)
+            return results
+
+    def query_iterative(self, q: str, limit: int = PAGE_SIZE, **kwargs):
+        '''Page through a DSL query until every matching record has been returned.'''
+        source = RETURN_SOURCE.search(q).group(1)
+        records, warnings, total = [], [], None
+        for page in iter_pages(self, q, limit):
+            warnings += page.json.get('_warnings', [])
+            records += page.json.get(source, [])
+            total = page.json.get('_stats', {}).get('total_count', len(records))
+        data = {'_stats': {'total_count': total if total is not None else len(records)}, source: records}
+        if warnings:
+            data['_warnings'] = warnings
+        return dimcli.DslDataset(data)
+
+
+def iter_pages(dsl, q: str, limit: int = PAGE_SIZE):
+    '''
+    Page through a DSL query and yield each page as a dimcli.DslDataset, so
+    that the records of a large result can be processed and dropped one page
+    at a time. A source without the limits of the API (see local_dsl.py) is
+    sent the query once and returns a single page.
+    '''
+    if getattr(dsl, 'unlimited', False):
+        yield dsl.query_iterative(q)
+        return
+    source = RETURN_SOURCE.search(q).group(1)
+    skip = 0
+    while skip < MAX_RECORDS:
+        page = dsl.query(f'{q} limit {min(limit, MAX_RECORDS - skip)} skip {skip}')
+        yield page
+        batch = page.json.get(source, [])
+        skip += len(batch)
+        if len(batch) < limit or skip >= page.json.get('_stats', {}).get('total_count', skip):
+            break
+
+
+def iter_queries(dsl, queries: list, iterative: bool = True, max_workers: int = MAX_WORKERS):
+    '''
+    Send DSL queries concurrently and yield (index, results) pairs as each
+    query completes.
+    '''
+    fetch = dsl.query_iterative if iterative else dsl.query
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(fetch, q): i for i, q in enumerate(queries)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def run_queries(dsl, queries: list, iterative: bool = True, max_workers: int = MAX_WORKERS) -> list:
+    '''Send DSL queries concurrently and return the results in input order.'''
+    results = [None] * len(queries)
+    for i, result in iter_queries(dsl, queries, iterative, max_workers):
+        results[i] = result
+    return results
@@ -0,0 +1,198 @@
+'''
+dsl_subset.py parses and evaluates the subset of the Dimensions DSL that the
+scripts in this repository send, against publication records held locally.
+
+The supported queries have the form
+
+    search publications where <condition> and <condition> ...
+        return publications[field+field+...] limit <n> skip <n>
+
+where each condition is a field compared with = (or >, >=, <, <=) to a value,
+or tested with in against a list of values, e.g.
+
+    research_orgs = "grid.6268.a"
+    year = "2025"
+    researchers.id in ["ur.01024019836"]
+    reference_ids in ["pub.1000000001", "pub.1000000002"]
+
+Fields of nested records are addressed with a dot, as in the DSL. A field
+holding a list matches if any of its values match.
+
+PublicationIndex keeps an inverted index of each filtered field, built the
+first time the field is used, so that id in [...] and reference_ids in [...]
+queries over a large set of records are answered without scanning them.
+'''
+import numpy as np
+
+from dataclasses import dataclass, field
+import json
+import operator
+import re
+
+OPERATORS: tuple = ('>=', '<=', '=', '>', '<', 'in')
+RANGE_OPERATORS: dict = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+QUERY_PATTERN = re.compile(
+    r'''^\s*search\s+(?P<source>\w+)
+        (?:\s+where\s+(?P<where>.*?))?
+        \s+return\s+(?P<result>\w+)(?:\s*\[(?P<fields>[^\]]*)\])?
+        (?:\s+limit\s+(?P<limit>\d+))?
+        (?:\s+skip\s+(?P<skip>\d+))?\s*$''',
+    flags=re.S | re.X
+)
+CONDITION_PATTERN = re.compile(r'\s*(?P<field>[\w.]+)\s*(?P<op>>=|<=|=|>|<|\bin\b)\s*', flags=re.S)
+
+
+class DslSyntaxError(ValueError):
+    '''Raised for a query outside the supported subset of the DSL.'''
+
+
+@dataclass
+class Condition:
+    field: str
+    op: str
+    values: list
+
+
+@dataclass
+class Query:
+    source: str
+    conditions: list = field(default_factory=list)
+    fields: list | None = None
+    limit: int | None = None
+    skip: int = 0
+
+
+def _value(text: str, position: int) -> tuple:
+    '''Decode a JSON value (string, number or list) from text, returning it and the position after it.'''
+    try:
+        return json.JSONDecoder().raw_decode(text, position)
+    except json.JSONDecodeError:
+        # Unquoted values, e.g. year = 2025
+        match = re.compile(r'[^\s\]]+').match(text, position)
+        if not match:
+            raise DslSyntaxError(f'Expected a value at: {text[position:]!r}')
+        return match.group(0), match.end()
+
+
+def parse_conditions(where: str) -> list:
+    conditions, position = [], 0
+    while True:
+        match = CONDITION_PATTERN.match(where, position)
+        if not match:
+            raise DslSyntaxError(f'Unsupported condition: {where[position:]!r}')
+        value, position = _value(where, match.end())
+        values = value if isinstance(value, list) else [value]
+        if match.group('op') == 'in' and not isinstance(value, list):
+            raise DslSyntaxError(f'Expected a list after in: {where[match.end():]!r}')
+        conditions.append(Condition(match.group('field'), match.group('op'), values))
+        rest = where[position:].strip()
+        if not rest:
+            return conditions
+        if not rest.startswith('and '):
+            raise DslSyntaxError(f'Only conditions joined with and are supported: {rest!r}')
+        position = len(where) - len(rest) + 4
+
+
+def parse(q: str) -> Query:
+    '''Parse a query in the supported subset of the DSL.'''
+    match = QUERY_PATTERN.match(q)
+    if not match:
+        raise DslSyntaxError(f'Unsupported query: {q!r}')
+    if match.group('result') != match.group('source'):
+        raise DslSyntaxError('Only the source being searched can be returned')
+    fields = match.group('fields')
+    return Query(
+        source=match.group('source'),
+        conditions=parse_conditions(match.group('where')) if match.group('where') else [],
+        fields=[f.strip() for f in fields.split('+') if f.strip()] if fields else None,
+        limit=int(match.group('limit')) if match.group('limit') else None,
+        skip=int(match.group('skip') or 0),
+    )
+
+
+def field_values(record: dict, path: str) -> list:
+    '''Get every value of a (possibly nested) field of a record as a flat list.'''
+    values = [record]
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            value = value.get(key) if isinstance(value, dict) else None
+            if isinstance(value, list):
+                found += value
+            elif value is not None:
+                found.append(value)
+        values = found
+    # Nested records match on their id, e.g. research_orgs = "grid.6268.a"
+    return [value.get('id') if isinstance(value, dict) else value for value in values]
+
+
+def _key(value) -> str:
+    return str(value).lower()
+
+
+def matcher(condition: Condition):
+    '''Build a function testing whether a single record meets a condition.'''
+    if condition.op in ('=', 'in'):
+        wanted = {_key(value) for value in condition.values}
+        return lambda record: any(_key(value) in wanted for value in field_values(record, condition.field))
+    # Range conditions compare numbers, e.g. year, or ISO dates, e.g. date_inserted
+    compare = RANGE_OPERATORS[condition.op]
+    cast = str if isinstance(condition.values[0], str) else float
+    bound = cast(condition.values[0])
+    return lambda record: any(compare(cast(value), bound) for value in field_values(record, condition.field))
+
+
+def project(record: dict, fields: list | None) -> dict:
+    if not fields:
+        return record
+    return {f: record[f] for f in fields if f in record}
+
+
+class PublicationIndex:
+    '''Records of one source with lazily built inverted indexes of their fields.'''
+
+    def __init__(self, records: list, source: str = 'publications'):
+        self.records = records
+        self.source = source
+        self._indexes = {}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _index(self, path: str) -> dict:
+        if path not in self._indexes:
+            index = {}
+            for position, record in enumerate(self.records):
+                for value in field_values(record, path):
+                    index.setdefault(_key(value), []).append(position)
+            self._indexes[path] = {key: np.unique(positions) for key, positions in index.items()}
+        return self._indexes[path]
+
+    def _matches(self, condition: Condition) -> np.ndarray:
+        if condition.op in ('=', 'in'):
+            index = self._index(condition.field)
+            found = [index[_key(value)] for value in condition.values if _key(value) in index]
+            return np.unique(np.concatenate(found)) if found else np.array([], dtype=np.int64)
+        test = matcher(condition)
+        return np.array([position for position, record in enumerate(self.records) if test(record)], dtype=np.int64)
+
+    def search(self, query: Query | str) -> dict:
+        '''
+        Evaluate a query, returning the data the API would return: the records
+        on the requested page, projected onto the requested fields, and the
+        total number of matching records in _stats.
+        '''
+        if isinstance(query, str):
+            query = parse(query)
+        if query.source != self.source:
+            raise DslSyntaxError(f'Only {self.source} can be searched')
+        positions = np.arange(len(self.records))
+        for condition in query.conditions:
+            positions = np.intersect1d(positions, self._matches(condition), assume_unique=True)
+        limit = query.limit if query.limit is not None else 20
+        page = positions[query.skip:query.skip + limit]
+        return {
+            '_stats': {'total_count': int(len(positions))},
+            self.source: [project(self.records[position], query.fields) for position in page],
+        }
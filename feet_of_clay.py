@@ -1,12 +1,17 @@
-import dimcli
 from dotenv import load_dotenv
-import numpy as np
 import pandas as pd
 
-import json
 import os
 import sys
 
+from backends import connect, disconnect
+from dsl_executor import iter_pages
+from id_index import IdIndex, normalize_dois, resolve_references
+from instrumentation import stage
+from query_planner import QueryPlanner
+from reference_table import ReferenceTable
+from retractions import RetractionStore
+
 load_dotenv()
 
 # Set search parameters
@@ -15,87 +20,78 @@ EMAIL: str = os.getenv('EMAIL')
 GRIDID: str = 'grid.6268.a'
 YEAR: int = 2025
 
-# Housekeeping
 DATA_DIR: str = os.path.join(os.getcwd(), 'data')
-if not os.path.isdir(DATA_DIR):
-    os.mkdir(DATA_DIR)
-    print('Created folder : ', DATA_DIR)
-else:
-    print('Data folder already exists.')
-
-# Log into Dimensions API
-API_KEY = os.getenv('API_KEY')
-dimcli.login(key=API_KEY, endpoint='https://app.dimensions.ai/api/dsl/v2')
-dsl = dimcli.Dsl()
-
-# Get the data for all publications from an institution published in a given year
-results = dsl.query_iterative(f"""search publications where research_orgs = "{GRIDID}"
-                                    and year = "{YEAR}"
-                                    return publications[id+doi+date+authors+title+source_title+publisher+reference_ids]"""
-                                    )
-
-df_publications = results.as_dataframe()
-df_publications = (
-    df_publications
-    .rename(columns={'id': 'pub_id', 'source_title.title': 'source_title'})
-    .filter(['pub_id', 'doi', 'date', 'publisher', 'title', 'source_title', 'reference_ids'])
-)
-
-df_affiliations = results.as_dataframe_authors_affiliations()
-df_affiliations = (
-    df_affiliations
-    .assign(full_name = lambda df: df[['first_name', 'last_name']].apply(' '.join, axis=1))
-    .filter(['pub_id', 'aff_id', 'aff_name', 'aff_raw_affiliation', 'researcher_id', 'full_name'])
-)
-df_affiliations = df_affiliations[df_affiliations['aff_id'] == GRIDID]
-
-# Access the Retraction Watch/Crossref database
-'''
-This is best done via the URL to ensure the database is up to date, but you could
-download the file to the current working directory and load it as a csv file using 
-
-retractions = pd.read_csv('retractions.csv', encoding='ISO-8859-1')
-
-You MUST make sure the encoding variable is set or Pandas will report an error
-'''
-url = 'https://api.labs.crossref.org/data/retractionwatch?' + EMAIL
-retractions = pd.read_csv(url, encoding='ISO-8859-1')
-
-retractions.columns = (
-    retractions.columns
-    .str.replace('(?<=[a-z])(?=[A-Z])', '_', regex=True)
-    .str.replace(' ', '_')
-    .str.lower()
-)
-
-retractions = retractions.drop(columns=['retraction_pub_med_id', 'notes', 'paywalled', 
-                                        'original_paper_pub_med_id', 'urls', 'article_type', 'country',
-                                        'publisher', 'journal', 'subject', 'institution', 'author',
-                                        'original_paper_date', 'title'])
-
-retractions = (
-    retractions
-    .assign(retraction_date = lambda df: df['retraction_date'].str.split(' ').str[0])
-)
-retractions['retraction_date'] = pd.to_datetime(retractions['retraction_date'])
-
-# Identify research from an institution that is listed in the Retraction Watch/Crossref database
-retracted_research = df_publications[df_publications['doi'].isin(retractions['original_paper_doi'])]
-retracted_research = (
-    retracted_research
-    .drop(columns=['reference_ids'])
-)
-retracted_research = pd.merge(
-    retracted_research,
-    retractions,
-    left_on='doi',
-    right_on='original_paper_doi',
-    how='left'
-)
 
-if retracted_research.empty or retracted_research['doi'].isnull().all():
-    pass
-else:
+# Query template for the authors of the flagged publications, for QueryPlanner
+AFFILIATIONS_QUERY: str = 'search publications where id in {ids} return publications[id+authors]'
+AFFILIATION_COLUMNS: list = ['pub_id', 'aff_id', 'aff_name', 'aff_raw_affiliation', 'researcher_id', 'full_name']
+
+
+def get_publications(dsl, grid_id: str, year: int) -> tuple:
+    '''
+    Get the data and references for all publications from an institution
+    published in a given year.
+
+    The authors, by far the largest part of each record, are not requested
+    here, but only for the few publications that are flagged, with
+    get_affiliations(). The publications are fetched a page at a time, and
+    the reference lists of each page are encoded and its records dropped
+    before the next page is fetched, so the records of the whole harvest
+    are never held at once.
+    '''
+    frames, tables = [], []
+    for page in iter_pages(dsl, f"""search publications where research_orgs = "{grid_id}"
+                                   and year = "{year}"
+                                   return publications[id+doi+date+title+source_title+publisher+reference_ids]"""):
+        tables.append(get_references(page.json.get('publications', [])))
+        frames.append(page.as_dataframe().drop(columns='reference_ids', errors='ignore'))
+    return publications_frame(pd.concat(frames, ignore_index=True)), ReferenceTable.concat(tables)
+
+
+def publications_frame(df_publications: pd.DataFrame) -> pd.DataFrame:
+    '''Select and rename the publication data used in the checks from a DSL results data frame.'''
+    df_publications = (
+        df_publications
+        .rename(columns={'id': 'pub_id', 'source_title.title': 'source_title'})
+        .reindex(columns=['pub_id', 'doi', 'date', 'publisher', 'title', 'source_title'])
+    )
+    # DOIs are compared in the normalized form used by the local index
+    df_publications['doi'] = normalize_dois(df_publications['doi'])
+    return df_publications
+
+
+def get_affiliations(dsl, pub_ids, grid_id: str, planner: QueryPlanner | None = None) -> pd.DataFrame:
+    '''
+    Get the authors affiliated with an institution for a set of its
+    publications, fetching the authors of only those publications.
+    '''
+    planner = planner if planner is not None else QueryPlanner()
+    frames = [results.as_dataframe_authors_affiliations() for results in planner.fetch(dsl, AFFILIATIONS_QUERY, pub_ids)
+              if results.json.get('publications')]
+    if not frames:
+        return pd.DataFrame(columns=AFFILIATION_COLUMNS)
+    df_affiliations = (
+        pd.concat(frames, ignore_index=True)
+        .assign(full_name = lambda df: df[['first_name', 'last_name']].apply(' '.join, axis=1))
+        .filter(AFFILIATION_COLUMNS)
+    )
+    return df_affiliations[df_affiliations['aff_id'] == grid_id]
+
+
+def get_retracted_research(df_publications: pd.DataFrame, df_affiliations: pd.DataFrame,
+                           retractions: RetractionStore) -> pd.DataFrame:
+    '''Identify research from an institution that is listed in the Retraction Watch/Crossref database.'''
+    retracted_research = pd.merge(
+        df_publications,
+        retractions.lookup(df_publications['doi']),
+        left_on='doi',
+        right_on='original_paper_doi',
+        how='inner'
+    )
+
+    if retracted_research.empty or retracted_research['doi'].isnull().all():
+        return retracted_research
+
     retracted_research = (
     retracted_research
     .rename(columns={'reason': 'retraction_reason', 
@@ -111,109 +107,193 @@ else:
     how='left'
     )
     
-    retracted_research.to_csv(os.path.join(DATA_DIR, ''.join(['retracted_research_', str(YEAR), '.csv'])), index=False, encoding = 'utf-8')
-
-# Get the list of references cited by an institution's outputs
-df_references = df_publications.filter(['pub_id', 'reference_ids']).explode('reference_ids')
-df_references = df_references[df_references['reference_ids'].notnull()]
-
-'''
-Publications aren't going to suddenly cite new publications after they have 
-been published, so we only need to get this data once and store it in the 
-working directory. We can then reload the list of cited references and check
-that against the updated Retraction Watch/Crossref database.
-
-An exception to this rule is the current year of publication, where new
-outputs from an institution will have to be checked and new references added
-to the list.
- 
- To re-collect the data for a particular year of publication, delete the 
- relevant cited_publications_*.csv file from the current working directory 
- prior to running this code.
-'''
-if not os.path.exists(os.path.join(DATA_DIR, ''.join(['cited_publications_', str(YEAR), '.csv']))):
-    
-    split: int = int(np.ceil(df_references.shape[0]/390))
-    df_references_split: list = np.array_split(df_references, split)
-    
-    df_cited_publications = pd.DataFrame()
-
-    for i in range(len(df_references_split)):
-        pubs = df_references_split[i]['reference_ids'].drop_duplicates()
-        results = dsl.query_iterative(f"""search publications
-               where id in {json.dumps(list(pubs))}
-               return publications[id+doi]
-               """).as_dataframe()
-        df_cited_publications = pd.concat([df_cited_publications, results])
-        
-    df_cited_publications.to_csv(os.path.join(DATA_DIR, ''.join(['cited_publications_', str(YEAR), '.csv'])), index=False)
-else:
-    df_cited_publications = pd.read_csv(os.path.join(DATA_DIR, ''.join(['cited_publications_', str(YEAR), '.csv'])))
-
-dimcli.logout()
-
-# Check if any of the cited references are in the Retraction Watch/Crossref and
-# get the institution's citing outputs
-df_problematic_publications = df_cited_publications[df_cited_publications['doi'].isin(retractions['original_paper_doi'])]
-df_problematic_publications = df_problematic_publications[df_problematic_publications['doi'].notnull()]
-df_problematic_publications = df_problematic_publications.rename(columns={'id': 'reference_ids'})
-
-df_problematic_publications = pd.merge(
-    df_references,
-    df_problematic_publications,
-    on='reference_ids',
-    how='left'
-)
+    return retracted_research
+
+
+def get_references(records: list) -> ReferenceTable:
+    '''Get the references cited by an institution's outputs from the DSL records.'''
+    return ReferenceTable.from_records(records)
+
+
+def write_cited_publications(index: IdIndex, references: ReferenceTable, path: str):
+    '''Write the id and DOI of the cited references to a CSV file a chunk at a time.'''
+    pd.DataFrame(columns=['id', 'doi']).to_csv(path + '.tmp', index=False)
+    for chunk in references.iter_reference_ids():
+        index.lookup_ids(chunk).filter(['id', 'doi']).to_csv(path + '.tmp', mode='a', header=False, index=False)
+    os.replace(path + '.tmp', path)
+
+
+def get_retracted_citations(references: ReferenceTable, cited_publications,
+                            retractions: RetractionStore) -> pd.DataFrame:
+    '''
+    Check if any of the cited references are in the Retraction Watch/Crossref
+    database, and get the pub_id, reference_ids and doi of every citation of
+    one of them.
+
+    cited_publications is an iterable of data frames of the id and doi of the
+    cited references, so that they can be read in chunks.
+    '''
+    # Files written by earlier versions of the script hold the DOIs as returned
+    # by Dimensions, so they are normalized as the Retraction Watch DOIs are
+    cited_publications = (df_cited_publications.assign(doi=normalize_dois(df_cited_publications['doi']))
+                          for df_cited_publications in cited_publications)
+    df_problematic_publications = pd.concat([pd.DataFrame(columns=['id', 'doi'])] + [
+        df_cited_publications[retractions.contains(df_cited_publications['doi'])]
+        for df_cited_publications in cited_publications
+    ])
+    df_problematic_publications = df_problematic_publications[df_problematic_publications['doi'].notnull()]
+    df_problematic_publications = df_problematic_publications.rename(columns={'id': 'reference_ids'})
+
+    # Only the citation links to retracted references are decoded to strings
+    return pd.merge(
+        references.links(df_problematic_publications['reference_ids']),
+        df_problematic_publications,
+        on='reference_ids',
+        how='inner'
+    )
 
-df_problematic_publications = df_problematic_publications.rename(columns={'doi': 'original_paper_doi'})
-df_problematic_publications = df_problematic_publications[df_problematic_publications['original_paper_doi'].notnull()]
-df_problematic_publications = df_problematic_publications.drop_duplicates()
 
-df_problematic_publications = pd.merge(
-    df_problematic_publications,
-    retractions,
-    on='original_paper_doi',
-    how='left'
-)
-
-df_problematic_publications = (
-    df_problematic_publications
-    .rename(columns={'id': 'pub_id', 
-                     'reason': 'retraction_reason', 
-                     'record_id': 'rw_record_id', 
-                     'original_paper_doi': 'retracted_paper_doi'})
-)
-
-df_problematic_publications = pd.merge(
-    df_publications,
-    df_problematic_publications,
-    on='pub_id',
-    how='inner'
-)
+def flagged_publications(df_publications: pd.DataFrame, df_retracted_citations: pd.DataFrame,
+                         retractions: RetractionStore) -> list:
+    '''Get the ids of the publications that have been retracted or cite retracted research.'''
+    retracted = df_publications.loc[retractions.contains(df_publications['doi']), 'pub_id']
+    return pd.unique(pd.concat([retracted, df_retracted_citations['pub_id']])).tolist()
 
-df_problematic_publications = pd.merge(
-    df_affiliations,
-    df_problematic_publications,
-    on='pub_id',
-    how='left'
-)
-
-df_problematic_publications = df_problematic_publications.rename(columns={'reference_ids_y': 'retracted_pub_id'}).drop(columns=['reference_ids_x'])
-df_problematic_publications['date'] = pd.to_datetime(df_problematic_publications['date'])
-df_problematic_publications['cited_after_retraction'] = df_problematic_publications.apply(lambda df: True if df['retraction_date'] < df['date'] else False, axis=1)
-
-excluded_cols = ['researcher_id', 'full_name']
-df_problematic_publications = (
-    df_problematic_publications
-    .groupby([col for col in df_problematic_publications.columns if col not in excluded_cols]).agg({'researcher_id': list, 'full_name': list})
-    .reset_index()
-)
-
-# Relocating columns is so much easier in dplyr
-df_problematic_publications = df_problematic_publications[['researcher_id', 'full_name'] + [col for col in df_problematic_publications.columns if col not in excluded_cols]]
-title, pub_id = df_problematic_publications.pop('title'), df_problematic_publications.pop('pub_id')
-df_problematic_publications.insert(5, 'pub_id', pub_id)
-df_problematic_publications.insert(9, 'title', title)
-df_problematic_publications = df_problematic_publications.assign(rw_record_id = lambda df: df['rw_record_id'].astype(int))
-
-df_problematic_publications.to_csv(os.path.join(DATA_DIR, ''.join(['problematic_publications_', str(YEAR), '.csv'])), index=False)
\ No newline at end of file
+
+def get_problematic_publications(df_publications: pd.DataFrame, df_affiliations: pd.DataFrame,
+                                 df_retracted_citations: pd.DataFrame, retractions: RetractionStore) -> pd.DataFrame:
+    '''
+    Get the institution's outputs citing research in the Retraction Watch/Crossref
+    database, from the citations found by get_retracted_citations().
+    '''
+    df_problematic_publications = df_retracted_citations.rename(columns={'doi': 'original_paper_doi'})
+    df_problematic_publications = df_problematic_publications.drop_duplicates()
+
+    df_problematic_publications = pd.merge(
+        df_problematic_publications,
+        retractions.lookup(df_problematic_publications['original_paper_doi']),
+        on='original_paper_doi',
+        how='left'
+    )
+
+    df_problematic_publications = (
+        df_problematic_publications
+        .rename(columns={'id': 'pub_id', 
+                         'reason': 'retraction_reason', 
+                         'record_id': 'rw_record_id', 
+                         'original_paper_doi': 'retracted_paper_doi'})
+    )
+
+    df_problematic_publications = pd.merge(
+        df_publications,
+        df_problematic_publications,
+        on='pub_id',
+        how='inner'
+    )
+
+    df_problematic_publications = pd.merge(
+        df_affiliations,
+        df_problematic_publications,
+        on='pub_id',
+        how='left'
+    )
+
+    df_problematic_publications = df_problematic_publications.rename(columns={'reference_ids': 'retracted_pub_id'})
+    df_problematic_publications['date'] = pd.to_datetime(df_problematic_publications['date'])
+    df_problematic_publications['cited_after_retraction'] = df_problematic_publications['retraction_date'] < df_problematic_publications['date']
+
+    excluded_cols = ['researcher_id', 'full_name']
+    df_problematic_publications = (
+        df_problematic_publications
+        .groupby([col for col in df_problematic_publications.columns if col not in excluded_cols]).agg({'researcher_id': list, 'full_name': list})
+        .reset_index()
+    )
+
+    # Relocating columns is so much easier in dplyr
+    df_problematic_publications = df_problematic_publications[['researcher_id', 'full_name'] + [col for col in df_problematic_publications.columns if col not in excluded_cols]]
+    title, pub_id = df_problematic_publications.pop('title'), df_problematic_publications.pop('pub_id')
+    df_problematic_publications.insert(5, 'pub_id', pub_id)
+    df_problematic_publications.insert(9, 'title', title)
+    df_problematic_publications = df_problematic_publications.assign(rw_record_id = lambda df: df['rw_record_id'].astype(int))
+
+    return df_problematic_publications
+
+
+if __name__ == '__main__':
+    # Housekeeping
+    if not os.path.isdir(DATA_DIR):
+        os.mkdir(DATA_DIR)
+        print('Created folder : ', DATA_DIR)
+    else:
+        print('Data folder already exists.')
+
+    # Connect to the Dimensions API or a local export
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
+
+    # Get the data for all publications from an institution published in a given year
+    with stage('publications'):
+        df_publications, references = get_publications(dsl, GRIDID, YEAR)
+
+    # Access the Retraction Watch/Crossref database
+    '''
+    A compact snapshot of the database is kept in data/retraction_watch and is only
+    downloaded again from the URL when the database has changed. If the database
+    cannot be downloaded, you can download the file to the current working 
+    directory as retractions.csv and it will be used instead.
+    '''
+    with stage('retractions'):
+        retractions = RetractionStore(email=EMAIL)
+        retractions.refresh()
+
+    '''
+    Publications aren't going to suddenly cite new publications after they have 
+    been published, so we only need to get this data once and store it in the 
+    working directory. We can then reload the list of cited references and check
+    that against the updated Retraction Watch/Crossref database.
+
+    An exception to this rule is the current year of publication, where new
+    outputs from an institution will have to be checked and new references added
+    to the list.
+     
+     To re-collect the data for a particular year of publication, delete the 
+     relevant cited_publications_*.csv file from the current working directory 
+     prior to running this code.
+    '''
+    cited_publications_file: str = os.path.join(DATA_DIR, ''.join(['cited_publications_', str(YEAR), '.csv']))
+    if not os.path.exists(cited_publications_file):
+        with stage('references'):
+            resolve_references(dsl, index, references.unique_reference_ids(),
+                               os.path.join(DATA_DIR, 'harvests', ''.join(['cited_publications_', str(YEAR)])))
+            write_cited_publications(index, references, cited_publications_file)
+
+    # Read the cited publications in chunks
+    with stage('retracted_citations'):
+        df_retracted_citations = get_retracted_citations(
+            references,
+            pd.read_csv(cited_publications_file, chunksize=100000),
+            retractions
+        )
+
+    # Only the authors of retracted publications and publications citing
+    # retracted research are needed
+    with stage('affiliations'):
+        df_affiliations = get_affiliations(dsl, flagged_publications(df_publications, df_retracted_citations, retractions),
+                                           GRIDID)
+
+    disconnect(dsl)
+
+    with stage('retracted_research'):
+        retracted_research = get_retracted_research(df_publications, df_affiliations, retractions)
+    if not retracted_research.empty:
+        retracted_research.to_csv(os.path.join(DATA_DIR, ''.join(['retracted_research_', str(YEAR), '.csv'])), index=False, encoding = 'utf-8')
+
+    with stage('problematic_publications'):
+        df_problematic_publications = get_problematic_publications(
+            df_publications,
+            df_affiliations,
+            df_retracted_citations,
+            retractions
+        )
+
+    df_problematic_publications.to_csv(os.path.join(DATA_DIR, ''.join(['problematic_publications_', str(YEAR), '.csv'])), index=False)
@@ -0,0 +1,99 @@
+'''
+feet_of_clay_batch.py runs the feet_of_clay.py checks for a matrix of
+institutions and years in a single run.
+
+Institutions cite heavily overlapping literature, so rather than resolving the
+cited references separately for every institution and year, the batch first
+collects the reference ids cited by every institution in every year and
+resolves the union of them once, querying the API only for references that
+have never been seen before. The local index of publication ids and DOIs in
+data/id_index.sqlite is the shared store of cited references, so the number
+of queries grows with the number of distinct references rather than with the
+total number of citations, and later batches only need to resolve references
+that are new.
+
+The outputs for each institution and year are written to the data folder as
+
+- retracted_research_<GRIDID>_<YEAR>.csv
+- cited_publications_<GRIDID>_<YEAR>.csv
+- problematic_publications_<GRIDID>_<YEAR>.csv
+'''
+from dotenv import load_dotenv
+import pandas as pd
+
+import itertools
+import os
+
+from backends import connect, disconnect
+from feet_of_clay import (DATA_DIR, flagged_publications, get_affiliations, get_problematic_publications,
+                          get_publications, get_retracted_citations, get_retracted_research,
+                          write_cited_publications)
+from id_index import IdIndex, resolve_references
+from instrumentation import stage
+from retractions import RetractionStore
+
+load_dotenv()
+
+# Set search parameters
+# Crossref asks you to be polite by providing an email when making API requests
+EMAIL: str = os.getenv('EMAIL')
+GRIDIDS: list[str] = ['grid.6268.a']
+YEARS: list[int] = [2021, 2022, 2023, 2024, 2025]
+
+
+def output_file(name: str, grid_id: str, year: int) -> str:
+    return os.path.join(DATA_DIR, ''.join([name, '_', grid_id, '_', str(year), '.csv']))
+
+
+if __name__ == '__main__':
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    # Connect to the Dimensions API or a local export
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
+
+    with stage('retractions'):
+        retractions = RetractionStore(email=EMAIL)
+        retractions.refresh()
+
+    # Collect the union of the references cited by every institution in every
+    # year. Only the reference ids are kept, since the publications are read
+    # back from the query cache in the second pass.
+    reference_ids = set()
+    with stage('publications'):
+        for grid_id, year in itertools.product(GRIDIDS, YEARS):
+            _, references = get_publications(dsl, grid_id, year)
+            reference_ids.update(references.unique_reference_ids())
+    print(f'{len(reference_ids)} distinct references cited, {len(index.unresolved_ids(list(reference_ids)))} not yet resolved')
+
+    with stage('references'):
+        resolve_references(dsl, index, list(reference_ids), os.path.join(DATA_DIR, 'harvests', 'cited_references'))
+
+    # Produce the outputs for every institution and year from the shared store
+    with stage('outputs'):
+        for grid_id, year in itertools.product(GRIDIDS, YEARS):
+            df_publications, references = get_publications(dsl, grid_id, year)
+            write_cited_publications(index, references, output_file('cited_publications', grid_id, year))
+            df_retracted_citations = get_retracted_citations(
+                references,
+                pd.read_csv(output_file('cited_publications', grid_id, year), chunksize=100000),
+                retractions
+            )
+
+            # Authors are only fetched for the publications that are flagged
+            df_affiliations = get_affiliations(
+                dsl, flagged_publications(df_publications, df_retracted_citations, retractions), grid_id)
+
+            retracted_research = get_retracted_research(df_publications, df_affiliations, retractions)
+            if not retracted_research.empty:
+                retracted_research.to_csv(output_file('retracted_research', grid_id, year), index=False, encoding = 'utf-8')
+
+            df_problematic_publications = get_problematic_publications(
+                df_publications,
+                df_affiliations,
+                df_retracted_citations,
+                retractions
+            )
+            df_problematic_publications.to_csv(output_file('problematic_publications', grid_id, year), index=False)
+
+    disconnect(dsl)
@@ -0,0 +1,124 @@
+'''
+funding_matcher.py finds the talent programs named in the funding sections
+of publications.
+
+The aliases of the listed programs are compiled into a trie-shaped regular
+expression (so that, like Aho-Corasick, aliases sharing a prefix are matched
+together rather than tried one by one) and combined with a generic pattern for
+programs that are not listed. The resulting case-insensitive regular
+expression is run over the whole funding_section column in one vectorized pass
+with Series.str.extractall(). Every match in a funding statement is returned,
+not just the first, and aliases are mapped back to the name of the program.
+
+Usage:
+
+    talent_plans = match_funding(df_publications)
+'''
+import pandas as pd
+
+import re
+
+# Talent programs and the names they are given in funding statements. Matches
+# are returned under the key of the program.
+TALENT_PROGRAMS: dict = {
+    'Thousand Talents Program': [
+        'Thousand Talents Program', 'Thousand Talents Plan', '1000 Talents Program', '1000 Talents Plan',
+        'Recruitment Program of Global Experts', 'Recruitment Program of Foreign Experts'
+    ],
+    'Young Thousand Talents Program': [
+        'Young Thousand Talents Program', 'Youth Thousand Talents Program', 'Thousand Young Talents Program',
+        'Young 1000 Talents Program', 'Recruitment Program for Young Professionals',
+        'Recruitment Program of Global Youth Experts'
+    ],
+    'Ten Thousand Talents Program': [
+        'Ten Thousand Talents Program', 'Ten Thousand Talent Program', '10000 Talents Program',
+        'National High-level Talents Special Support Program', 'Special Support Program for High-level Talents'
+    ],
+    'Hundred Talents Program': [
+        'Hundred Talents Program', 'One Hundred Talents Program', '100 Talents Program', 'Hundred Talent Program'
+    ],
+    'Changjiang Scholars Program': [
+        'Changjiang Scholars Program', 'Chang Jiang Scholars Program', 'Cheung Kong Scholars Program',
+        'Changjiang Scholar', 'Chang Jiang Scholar'
+    ],
+    'Pearl River Talents Program': [
+        'Pearl River Talents Program', 'Pearl River Talent Recruitment Program', 'Pearl River Talent Plan'
+    ],
+    'Taishan Scholars Program': ['Taishan Scholars Program', 'Taishan Scholar Program', 'Taishan Scholar'],
+}
+
+# Any other program named in a comma-separated funding statement
+GENERIC_PATTERN: str = r',\s*(?P<other>[^,]*Talents Program)(?=\s*,)'
+
+
+def trie_pattern(words: list) -> str:
+    '''
+    Build a regular expression matching any of a list of words from a trie of
+    their characters, so that words sharing a prefix share its match.
+    '''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # Regular expression quantifiers are greedy, so the longest alias wins
+        return '(?:' + body + ')?' if '' in node else body
+
+    return build(trie)
+
+
+def alias_names(programs: dict = TALENT_PROGRAMS) -> dict:
+    '''Map the lower case alias of each program to its name.'''
+    return {alias.lower(): name for name, aliases in programs.items() for alias in aliases}
+
+
+def compile_programs(programs: dict = TALENT_PROGRAMS, generic: str | None = GENERIC_PATTERN) -> re.Pattern:
+    '''Compile the program aliases and a generic pattern into a single regular expression.'''
+    pattern = '(?P<alias>\\b' + trie_pattern(sorted(alias_names(programs))) + '\\b)'
+    if generic:
+        pattern += '|' + generic
+    return re.compile(pattern, flags=re.I)
+
+
+def match_funding(df: pd.DataFrame, programs: dict = TALENT_PROGRAMS, generic: str | None = GENERIC_PATTERN,
+                  id_col: str = 'id', text_col: str = 'funding_section') -> pd.DataFrame:
+    '''
+    Find every talent program named in the funding statements of a data frame
+    of publications.
+
+    Returns one row per publication (pub_id) and talent program (talent_plan).
+    '''
+    names = alias_names(programs)
+    text = df.set_index(id_col)[text_col].dropna()
+    matches = text.str.extractall(compile_programs(programs, generic))
+    if matches.empty:
+        return pd.DataFrame(columns=['pub_id', 'talent_plan'])
+
+    talent_plan = matches['alias'].str.lower().map(names)
+
+    if 'other' in matches.columns:
+        # Programs found by the generic pattern that are aliases of a listed program take its name
+        other = matches['other'].str.strip()
+        named = compile_programs(programs, None)
+        canonical = {}
+        for value in other.dropna().unique():
+            match = named.search(value)
+            canonical[value] = names[match.group('alias').lower()] if match else value
+        talent_plan = talent_plan.fillna(other.map(canonical))
+
+    talent_plans = (
+        talent_plan
+        .rename('talent_plan')
+        .reset_index(level='match', drop=True)
+        .rename_axis('pub_id')
+        .reset_index()
+        .drop_duplicates()
+    )
+    return talent_plans.reset_index(drop=True)
@@ -0,0 +1,134 @@
+'''
+harvest_planner.py fetches the publications of a scope, such as an
+institution's output in a year, once for several analyses, rather than each
+analysis harvesting an overlapping set of publications with its own fields.
+
+Each Analysis declares the fields it needs of the publications in the scope,
+the fields it needs of the publications they cite, if any, and a function
+that runs it on the shared Harvest:
+
+    planner = HarvestPlanner([feet_of_clay, talent_programs])
+    harvest = planner.harvest(dsl, index, Scope('grid.6268.a', 2025), DATA_DIR)
+    planner.run(harvest)
+
+The planner takes the union of the fields of every analysis and sends a
+single query for the scope. Its results are held in memory, with the
+reference lists integer-encoded in a ReferenceTable (see reference_table.py),
+and the cited publications are harvested once into a ChunkStore on disk. If
+the analyses only need the DOIs of the cited publications, only those not
+already in the IdIndex are requested. Each analysis then runs as a stage of
+its own over the same data.
+'''
+from dataclasses import dataclass, field
+import os
+
+from chunk_store import ChunkStore
+from id_index import IdIndex, resolve_references
+from instrumentation import stage
+from query_planner import IDS, QueryPlanner
+from reference_table import ReferenceTable
+
+# Fields of the cited publications that can be looked up in an IdIndex
+INDEXED_FIELDS: tuple = ('id', 'doi')
+
+
+def union(field_lists) -> list:
+    '''Combine lists of fields, keeping the first occurrence of each and id first.'''
+    return list(dict.fromkeys(['id'] + [f for fields in field_lists for f in fields]))
+
+
+def cited_query(fields: list) -> str:
+    '''Query template for the cited publications, for QueryPlanner.'''
+    return f'search publications where id in {IDS} return publications[{"+".join(fields)}]'
+
+
+@dataclass
+class Scope:
+    '''The publications of an institution, given by its GRID ID, in a year.'''
+    grid_id: str
+    year: int
+
+    @property
+    def name(self) -> str:
+        return f'{self.grid_id}_{self.year}'
+
+    def query(self, fields: list) -> str:
+        return f"""search publications where research_orgs = "{self.grid_id}"
+                   and year = "{self.year}"
+                   return publications[{'+'.join(fields)}]"""
+
+
+@dataclass
+class Analysis:
+    '''
+    An analysis run on a Harvest. run is called with the harvest and writes
+    the outputs of the analysis.
+    '''
+    name: str
+    fields: tuple
+    run: object
+    reference_fields: tuple = field(default_factory=tuple)
+
+
+class Harvest:
+    '''The publications of a scope, and the publications they cite, shared between analyses.'''
+
+    def __init__(self, scope: Scope, results, references: ReferenceTable, dsl, index: IdIndex,
+                 planner: QueryPlanner, data_dir: str, cited: ChunkStore | None = None):
+        self.scope = scope
+        self.results = results
+        self.references = references
+        self.dsl = dsl
+        self.index = index
+        self.planner = planner
+        self.data_dir = data_dir
+        self.cited = cited
+        # Built once, without the reference lists, which are in references
+        self.publications = results.as_dataframe().drop(columns='reference_ids', errors='ignore')
+
+    def output_file(self, name: str) -> str:
+        return os.path.join(self.data_dir, f'{name}_{self.scope.name}.csv')
+
+
+class HarvestPlanner:
+    '''Plans a single harvest of a scope for a set of analyses and fans it out to them.'''
+
+    def __init__(self, analyses: list, planner: QueryPlanner | None = None):
+        self.analyses = list(analyses)
+        self.planner = planner if planner is not None else QueryPlanner()
+
+    @property
+    def fields(self) -> list:
+        return union(analysis.fields for analysis in self.analyses)
+
+    @property
+    def reference_fields(self) -> list:
+        needed = [analysis.reference_fields for analysis in self.analyses if analysis.reference_fields]
+        return union(needed) if needed else []
+
+    def harvest(self, dsl, index: IdIndex, scope: Scope, data_dir: str) -> Harvest:
+        '''Fetch the publications of a scope, and the publications they cite, once.'''
+        with stage('publications'):
+            results = dsl.query_iterative(scope.query(self.fields))
+            records = results.json.get('publications', [])
+            references = ReferenceTable.from_records(records) if 'reference_ids' in self.fields else None
+            print(f'{len(records)} publications in {scope.name} harvested for '
+                  + ', '.join(analysis.name for analysis in self.analyses))
+
+        cited = None
+        fields = self.reference_fields
+        if fields and references is not None:
+            store_path = os.path.join(data_dir, 'harvests', f'cited_publications_{scope.name}')
+            with stage('references'):
+                if set(fields) <= set(INDEXED_FIELDS):
+                    resolve_references(dsl, index, references.unique_reference_ids(), store_path, self.planner)
+                else:
+                    cited = self.planner.harvest(ChunkStore(store_path), dsl, cited_query(fields),
+                                                 references.unique_reference_ids())
+        return Harvest(scope, results, references, dsl, index, self.planner, data_dir, cited)
+
+    def run(self, harvest: Harvest):
+        '''Run every analysis on the harvest, each as a stage.'''
+        for analysis in self.analyses:
+            with stage(analysis.name):
+                analysis.run(harvest)
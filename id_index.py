@@ -0,0 +1,164 @@
+'''
+id_index.py keeps a persistent, bidirectional index of Dimensions publication
+IDs and DOIs, together with the year and date of publication, that is shared
+by all the scripts in this repository.
+
+The index is filled in as a side effect of every query sent through CachedDsl
+that returns publication IDs, and the scripts check it before sending queries
+so that only identifiers that have never been seen before go to the API.
+
+The index is held in memory as a pair of dictionaries, so bulk lookups cost
+O(1) per key, and is written through to a SQLite database so that it persists
+between runs.
+
+Usage:
+
+    index = IdIndex()
+    dsl = CachedDsl(RateLimitedDsl(dimcli.Dsl()), listeners=[index.record_result])
+    unresolved = index.unresolved_dois(dois)
+
+resolve_references() gets the DOIs of cited references in this way, only
+harvesting those not already in the index.
+'''
+import pandas as pd
+
+import os
+import re
+import sqlite3
+import threading
+
+from chunk_store import ChunkStore
+from dsl_cache import returned_fields
+from query_planner import QueryPlanner
+
+INDEX_PATH: str = os.path.join(os.getcwd(), 'data', 'id_index.sqlite')
+
+# Publications are recorded with an empty string as their DOI when the DOI was
+# requested from Dimensions but the publication does not have one
+NO_DOI: str = ''
+
+# Query template for the DOIs of cited references, for QueryPlanner
+REFERENCES_QUERY: str = 'search publications where id in {ids} return publications[id+doi]'
+
+DOI_PREFIX = re.compile(r'^\s*(?:https?://(?:dx\.)?doi\.org/|doi:\s*)', flags=re.I)
+
+
+def normalize_doi(doi) -> str | None:
+    '''Normalize a DOI to lower case without a doi.org or doi: prefix.'''
+    if not isinstance(doi, str):
+        return None
+    doi = DOI_PREFIX.sub('', doi).strip().lower()
+    return doi or None
+
+
+def normalize_dois(dois: pd.Series) -> pd.Series:
+    '''Vectorized normalize_doi() for a series of DOIs.'''
+    return (
+        dois
+        .astype('string')
+        .str.replace(DOI_PREFIX, '', regex=True)
+        .str.strip()
+        .str.lower()
+        .replace('', pd.NA)
+    )
+
+
+class IdIndex:
+    '''Persistent DOI <-> publication ID index with year and date.'''
+
+    def __init__(self, path: str = INDEX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS publications (
+                                pub_id TEXT PRIMARY KEY,
+                                doi TEXT,
+                                year INTEGER,
+                                date TEXT)''')
+        self._db.commit()
+        self.by_id = {}
+        self.by_doi = {}
+        for pub_id, doi, year, date in self._db.execute('SELECT pub_id, doi, year, date FROM publications'):
+            self.by_id[pub_id] = (doi, year, date)
+            if doi:
+                self.by_doi[doi] = pub_id
+
+    def record(self, records: list, fields: list):
+        '''
+        Record publications from DSL JSON records, where fields are the fields
+        that were requested for them.
+        '''
+        rows = []
+        for record in records:
+            pub_id = record.get('id')
+            if not pub_id:
+                continue
+            doi = normalize_doi(record.get('doi')) or (NO_DOI if 'doi' in fields else None)
+            row = (doi, record.get('year'), record.get('date'))
+            known = self.by_id.get(pub_id)
+            # Already recorded, e.g. from a result served by the query cache
+            if known is not None and all(new is None or new == old for new, old in zip(row, known)):
+                continue
+            rows.append((pub_id,) + row)
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany('''INSERT INTO publications VALUES (?, ?, ?, ?)
+                                    ON CONFLICT (pub_id) DO UPDATE SET
+                                        doi = COALESCE(excluded.doi, doi),
+                                        year = COALESCE(excluded.year, year),
+                                        date = COALESCE(excluded.date, date)''', rows)
+            self._db.commit()
+            for pub_id, doi, year, date in rows:
+                old_doi, old_year, old_date = self.by_id.get(pub_id, (None, None, None))
+                doi = doi if doi is not None else old_doi
+                self.by_id[pub_id] = (doi, year if year is not None else old_year, date if date is not None else old_date)
+                if doi:
+                    self.by_doi[doi] = pub_id
+
+    def record_result(self, q: str, data: dict):
+        '''Record the publications in the JSON data returned by a DSL query.'''
+        if 'id' in returned_fields(q):
+            self.record(data.get('publications', []), returned_fields(q))
+
+    def unresolved_ids(self, ids, field: str = 'doi') -> list:
+        '''Get the publication IDs for which a field has not been recorded.'''
+        column = ('doi', 'year', 'date').index(field)
+        return [pub_id for pub_id in pd.unique(pd.Series(ids).dropna())
+                if self.by_id.get(pub_id, (None, None, None))[column] is None]
+
+    def unresolved_dois(self, dois) -> list:
+        '''Get the normalized DOIs that have not been resolved to a publication ID.'''
+        return [doi for doi in pd.unique(normalize_dois(pd.Series(dois)).dropna()) if doi not in self.by_doi]
+
+    def lookup_ids(self, ids) -> pd.DataFrame:
+        '''Get the DOI, year and date of known publication IDs.'''
+        rows = [(pub_id,) + self.by_id[pub_id] for pub_id in pd.unique(pd.Series(ids).dropna()) if pub_id in self.by_id]
+        df = pd.DataFrame(rows, columns=['id', 'doi', 'year', 'date'])
+        df['doi'] = df['doi'].replace(NO_DOI, None)
+        return df
+
+    def lookup_dois(self, dois) -> pd.DataFrame:
+        '''Get the publication ID, year and date of known DOIs.'''
+        pub_ids = [self.by_doi[doi] for doi in pd.unique(normalize_dois(pd.Series(dois)).dropna()) if doi in self.by_doi]
+        return self.lookup_ids(pub_ids)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+
+def resolve_references(dsl, index: IdIndex, reference_ids, store_path: str,
+                       planner: QueryPlanner | None = None):
+    '''
+    Get the DOIs of cited references, only querying the API for references
+    whose DOI is not already in the local index.
+
+    The cited publications are harvested chunk by chunk into store_path, so if
+    the harvest is interrupted it resumes from the last completed chunk.
+    '''
+    unresolved: list = index.unresolved_ids(reference_ids, 'doi')
+    if unresolved:
+        planner = planner if planner is not None else QueryPlanner()
+        planner.harvest(ChunkStore(store_path), dsl, REFERENCES_QUERY, unresolved)
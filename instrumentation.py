@@ -0,0 +1,186 @@
+'''
+instrumentation.py records where the time goes in a run of one of the scripts.
+
+Every request sent by RateLimitedDsl is recorded with its latency, the time
+spent decoding the JSON response, the number of records and bytes returned,
+the number of retries, and the time spent waiting for the rate limiter or
+backing off after an error. Results answered by the query cache are recorded
+too. The main steps of each script are wrapped in stages, which record their
+wall and CPU time:
+
+    with stage('cohorts'):
+        df_co_cites = fetch_cohorts(dsl, df_target_pubs['id'])
+
+Queries are attributed to the stage they were sent in. Every record is
+written to a JSON lines trace in data/traces as it happens, and a summary
+table with one row per stage is printed when the script exits.
+
+Stages can also be profiled, by listing them in the PROFILE_STAGES environment
+variable (e.g. PROFILE_STAGES=cohorts,rank). The profile is written next to
+the trace, as a cProfile .prof file or, if PROFILER=pyinstrument and
+pyinstrument is installed, as an HTML report. cProfile only profiles the
+thread the stage runs in, not the threads sending queries.
+
+Set DIMENSIONS_TRACE=0 to turn the trace and summary off.
+'''
+import pandas as pd
+
+import atexit
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_DIR: str = os.path.join(os.getcwd(), 'data', 'traces')
+TRACE: bool = os.getenv('DIMENSIONS_TRACE', '1') != '0'
+PROFILE_STAGES: list = [name.strip() for name in os.getenv('PROFILE_STAGES', '').split(',') if name.strip()]
+PROFILER: str = os.getenv('PROFILER', 'cprofile')
+
+# Only the start of each query is written to the trace
+QUERY_LENGTH: int = 200
+
+# Per-query measures summed in the summary table
+QUERY_TOTALS: list = ['latency', 'decode', 'throttle', 'backoff', 'retries', 'records', 'bytes']
+NO_STAGE: str = '(none)'
+
+
+class Tracer:
+    '''Records queries and stages to a JSON lines trace and summarises them at exit.'''
+
+    def __init__(self, trace_dir: str = TRACE_DIR, enabled: bool = TRACE):
+        self.trace_dir = trace_dir
+        self.enabled = enabled
+        self.name = os.path.splitext(os.path.basename(sys.argv[0] or ''))[0] or 'python'
+        self.started = time.perf_counter()
+        self.path = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._stages = []
+        self._order = []
+        self._totals = {}
+
+    def _write(self, record: dict):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.trace_dir, exist_ok=True)
+                stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+                self.path = os.path.join(self.trace_dir, f'{self.name}-{stamp}-{os.getpid()}.jsonl')
+                self._file = open(self.path, 'a', buffering=1)
+                atexit.register(self.close)
+            self._file.write(json.dumps(record) + '\n')
+
+    def _add(self, stage: str, **values):
+        with self._lock:
+            if stage not in self._totals:
+                self._order.append(stage)
+                self._totals[stage] = {}
+            totals = self._totals[stage]
+            for key, value in values.items():
+                totals[key] = totals.get(key, 0) + value
+
+    @property
+    def current_stage(self) -> str:
+        return self._stages[-1] if self._stages else NO_STAGE
+
+    def query(self, q: str, cached: bool = False, **metrics):
+        '''Record a query sent to the API (or answered from the cache).'''
+        stage = self.current_stage
+        self._add(stage, **{'queries': int(not cached), 'cached': int(cached)},
+                  **{key: metrics.get(key, 0) or 0 for key in QUERY_TOTALS})
+        self._write({'event': 'query', 'time': time.time(), 'stage': stage, 'cached': cached,
+                     'query': ' '.join(q.split())[:QUERY_LENGTH], **metrics})
+
+    def event(self, event: str, **values):
+        '''Record any other measurement, e.g. the time taken to convert a result.'''
+        stage = self.current_stage
+        self._add(stage, **{key: value for key, value in values.items() if isinstance(value, (int, float))})
+        self._write({'event': event, 'time': time.time(), 'stage': stage, **values})
+
+    @contextmanager
+    def stage(self, name: str, profile: bool | None = None):
+        '''Time a stage of a script, optionally profiling it.'''
+        if profile is None:
+            profile = name in PROFILE_STAGES
+        profiler = self._start_profiler() if profile else None
+        self._stages.append(name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._stages.pop()
+            self._add(name, wall=wall, cpu=cpu)
+            record = {'event': 'stage', 'time': time.time(), 'stage': name, 'wall': wall, 'cpu': cpu}
+            if profiler is not None:
+                record['profile'] = self._stop_profiler(profiler, name)
+            self._write(record)
+
+    def _start_profiler(self):
+        if PROFILER == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                print('pyinstrument is not installed, using cProfile instead')
+            else:
+                profiler = Profiler()
+                profiler.start()
+                return profiler
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, profiler, name: str) -> str:
+        os.makedirs(self.trace_dir, exist_ok=True)
+        base = os.path.join(self.trace_dir, f'{self.name}-{os.getpid()}-{name}')
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(base + '.prof')
+            return base + '.prof'
+        profiler.stop()
+        with open(base + '.html', 'w') as f:
+            f.write(profiler.output_html())
+        return base + '.html'
+
+    def summary(self) -> pd.DataFrame:
+        '''One row per stage, with a total row, of the time and queries it took.'''
+        columns = ['wall', 'cpu', 'queries', 'cached', 'retries', 'latency', 'decode', 'throttle', 'backoff',
+                   'convert', 'write', 'records', 'bytes']
+        with self._lock:
+            df = pd.DataFrame.from_dict(self._totals, orient='index').reindex(index=self._order, columns=columns)
+        df = df.fillna(0)
+        total = df.sum()
+        # Stage times overlap when stages are nested, so the total is the run time
+        total['wall'] = time.perf_counter() - self.started
+        total['cpu'] = time.process_time()
+        df.loc['total'] = total
+        df['mb'] = df.pop('bytes') / 1024**2
+        int_columns = ['queries', 'cached', 'retries', 'records']
+        df[int_columns] = df[int_columns].astype(int)
+        return df.round(2).rename_axis('stage')
+
+    def close(self):
+        if self._file is None:
+            return
+        summary = self.summary()
+        self._write({'event': 'summary', 'time': time.time(),
+                     'stages': summary.reset_index().to_dict('records')})
+        print(f'\nRun profile (trace written to {self.path}):')
+        print(summary.to_string())
+        total = summary.loc['total']
+        if total['queries']:
+            queries = int(total['queries'])
+            print(f"{queries} queries sent at {round(60 * queries / total['wall'], 1)} per minute, "
+                  f"{total['throttle']}s waiting for the rate limit")
+        with self._lock:
+            self._file.close()
+            self._file = None
+
+
+tracer = Tracer()
+stage = tracer.stage
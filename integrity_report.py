@@ -0,0 +1,121 @@
+'''
+integrity_report.py produces an annual research integrity report for an
+institution, running the checks of feet_of_clay.py, talent_program_checker.py
+and author_self_citation.py on the institution's publications in a year from
+a single harvest, rather than with three separate passes over the Dimensions
+API (see harvest_planner.py).
+
+Set the institution (GRIDID), the year (YEAR) and the analyses to run
+(ANALYSES) below. The outputs are written to the data folder as
+
+- retracted_research_<GRIDID>_<YEAR>.csv, cited_publications_<GRIDID>_<YEAR>.csv
+  and problematic_publications_<GRIDID>_<YEAR>.csv, as written by feet_of_clay.py
+- talent_plans_<GRIDID>_<YEAR>.csv, the talent programs named in the funding
+  sections of the publications, as written by talent_program_checker.py
+- self_citation_<GRIDID>_<YEAR>.csv, the self citation metrics of every
+  researcher named on the publications, as written by author_self_citation.py,
+  counting the references in these publications to other work by the same
+  researcher
+'''
+from dotenv import load_dotenv
+import pandas as pd
+
+import os
+
+from author_self_citation import get_authorship, self_citation_metrics
+from backends import connect, disconnect
+from feet_of_clay import (DATA_DIR, flagged_publications, get_affiliations, get_problematic_publications,
+                          get_retracted_citations, get_retracted_research, publications_frame,
+                          write_cited_publications)
+from funding_matcher import match_funding
+from harvest_planner import Analysis, Harvest, HarvestPlanner, Scope
+from id_index import IdIndex
+from retractions import RetractionStore
+
+load_dotenv()
+
+# Set search parameters
+# Crossref asks you to be polite by providing an email when making API requests
+EMAIL: str = os.getenv('EMAIL')
+GRIDID: str = 'grid.6268.a'
+YEAR: int = 2025
+ANALYSES: list[str] = ['feet_of_clay', 'talent_programs', 'self_citation']
+
+
+def feet_of_clay(harvest: Harvest):
+    '''Check the publications and the research they cite against the Retraction Watch/Crossref database.'''
+    df_publications = publications_frame(harvest.publications)
+    retractions = RetractionStore(email=EMAIL)
+    retractions.refresh()
+
+    cited_publications_file = harvest.output_file('cited_publications')
+    write_cited_publications(harvest.index, harvest.references, cited_publications_file)
+    df_retracted_citations = get_retracted_citations(
+        harvest.references,
+        pd.read_csv(cited_publications_file, chunksize=100000),
+        retractions
+    )
+
+    # Authors are only fetched for the publications that are flagged
+    df_affiliations = get_affiliations(harvest.dsl, flagged_publications(df_publications, df_retracted_citations, retractions),
+                                       harvest.scope.grid_id, harvest.planner)
+
+    retracted_research = get_retracted_research(df_publications, df_affiliations, retractions)
+    if not retracted_research.empty:
+        retracted_research.to_csv(harvest.output_file('retracted_research'), index=False, encoding = 'utf-8')
+    df_problematic_publications = get_problematic_publications(df_publications, df_affiliations,
+                                                               df_retracted_citations, retractions)
+    df_problematic_publications.to_csv(harvest.output_file('problematic_publications'), index=False)
+
+
+def talent_programs(harvest: Harvest):
+    '''Find every talent program named in the funding sections of the publications.'''
+    df_publications = harvest.publications.reindex(columns=['id', 'funding_section'])
+    talent_plans = match_funding(df_publications[df_publications['funding_section'].notnull()])
+    talent_plans.to_csv(harvest.output_file('talent_plans'), index=False)
+
+
+def self_citation(harvest: Harvest):
+    '''Calculate how often each researcher named on the publications cites their own work in them.'''
+    records = harvest.results.json.get('publications', [])
+    researcher_ids = list(dict.fromkeys(researcher['id'] for record in records
+                                        for researcher in record.get('researchers', [])))
+    authorship = get_authorship(records, set(researcher_ids))
+
+    cited = harvest.cited.read(columns=['id', 'researchers']).explode('researchers').dropna()
+    cited_authorship = pd.DataFrame({'id': cited['id'].to_numpy(),
+                                     'researcher_id': cited['researchers'].str.get('id').to_numpy()})
+    cited_authorship = cited_authorship[cited_authorship['researcher_id'].isin(researcher_ids)]
+
+    # Only the citation links to work by the same researchers are decoded to strings
+    links = harvest.references.links(cited_authorship['id'].unique())
+    publications = harvest.publications.reindex(columns=['id', 'times_cited'])
+    publications['reference_ids'] = publications['id'].map(links.groupby('pub_id')['reference_ids'].agg(list))
+
+    df_self_citation = self_citation_metrics(publications, authorship, researcher_ids, cited_authorship)
+    df_self_citation.to_csv(harvest.output_file('self_citation'), index=False)
+
+
+# The fields each analysis needs of the publications, and of the publications they cite
+REGISTRY: dict = {analysis.name: analysis for analysis in [
+    Analysis('feet_of_clay', ('id', 'doi', 'date', 'title', 'source_title', 'publisher', 'reference_ids'),
+             feet_of_clay, reference_fields=('id', 'doi')),
+    Analysis('talent_programs', ('id', 'funding_section', 'funders'), talent_programs),
+    Analysis('self_citation', ('id', 'times_cited', 'reference_ids', 'researchers'), self_citation,
+             reference_fields=('id', 'researchers')),
+]}
+
+
+if __name__ == '__main__':
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    # Connect to the Dimensions API or a local export
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
+
+    # Harvest the publications once and run every analysis on them
+    planner = HarvestPlanner([REGISTRY[name] for name in ANALYSES])
+    harvest = planner.harvest(dsl, index, Scope(GRIDID, YEAR), DATA_DIR)
+    planner.run(harvest)
+
+    disconnect(dsl)
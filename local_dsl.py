@@ -0,0 +1,244 @@
+'''
+local_dsl.py answers the queries of the scripts from a local Dimensions bulk
+export, so that the analyses can run offline over a full snapshot of the data
+without an API key or any quota.
+
+The export is a folder (or a single file) of publication records, either as
+JSON lines (.jsonl or .jsonl.gz) with one record per line in the format the
+API returns, or as Parquet files (.parquet) with a column for each field and
+nested records as lists of structs.
+
+LocalDsl has the same query() and query_iterative() methods as dimcli.Dsl and
+the wrappers in dsl_executor.py and dsl_cache.py, and understands the subset
+of the DSL parsed by dsl_subset.py. Every query is a scan of the export:
+
+- Parquet files are read with column pushdown, so only the columns a query
+  filters on or returns are read, and with predicate pushdown of conditions
+  on top-level fields such as id, doi and year, so that row groups whose
+  statistics rule them out are skipped. Conditions on lists and nested
+  fields, such as reference_ids, research_orgs and researchers.id, are
+  evaluated with Arrow compute kernels over each batch of rows, and only the
+  rows that match are converted to Python records.
+- JSON lines files are scanned in parallel by SCAN_WORKERS processes, one
+  file at a time. A line is only decoded if it contains one of the values
+  looked for by an = or in condition.
+
+There is no limit on the records a query returns or on the length of a list
+filter, so QueryPlanner sends all the identifiers of a fetch in one query,
+and so in one scan of the export, rather than in batches.
+'''
+import dimcli
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import gzip
+import json
+import os
+import time
+
+from dsl_subset import DslSyntaxError, Query, matcher, parse, project
+from instrumentation import tracer
+
+EXPORT_PATH: str = os.path.join(os.getcwd(), 'data', 'dimensions_export')
+SCAN_WORKERS: int = os.cpu_count() or 1
+
+# Rows of a Parquet file read at a time
+BATCH_ROWS: int = 65536
+
+# Lines are only pre-filtered by the values of conditions with at most this many values
+MAX_PREFILTER_VALUES: int = 256
+
+# Fields compared without regard to case, as by the API
+CASE_INSENSITIVE_FIELDS: tuple = ('doi',)
+
+# Records returned by query() when the query has no limit, as by the API
+DEFAULT_LIMIT: int = 20
+
+
+def export_files(path: str) -> tuple:
+    '''Find the Parquet and JSON lines files of an export.'''
+    paths = [path] if os.path.isfile(path) else sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True))
+    parquet = [p for p in paths if p.endswith('.parquet')]
+    jsonl = [p for p in paths if p.endswith(('.jsonl', '.jsonl.gz', '.json.gz'))]
+    return parquet, jsonl
+
+
+def _is_nested(data_type) -> bool:
+    return pa.types.is_list(data_type) or pa.types.is_large_list(data_type) or pa.types.is_struct(data_type)
+
+
+def _value_set(condition, data_type) -> pa.Array:
+    values = [str(value).lower() if condition.field in CASE_INSENSITIVE_FIELDS else value
+              for value in condition.values]
+    if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+        return pa.array([str(value) for value in values], type=data_type)
+    return pc.cast(pa.array([str(value) for value in values]), data_type)
+
+
+def _pushdown(condition, data_type) -> ds.Expression:
+    '''Translate a condition on a top-level scalar column into a dataset filter.'''
+    column = ds.field(condition.field)
+    if condition.field in CASE_INSENSITIVE_FIELDS:
+        column = pc.utf8_lower(column)
+    values = _value_set(condition, data_type)
+    if condition.op in ('=', 'in'):
+        return column.isin(values)
+    bound = values[0]
+    return {'>': column > bound, '>=': column >= bound, '<': column < bound, '<=': column <= bound}[condition.op]
+
+
+def _leaf_values(batch: pa.RecordBatch, path: str) -> tuple:
+    '''
+    Get every value of a (possibly nested) field of a batch as a flat array,
+    with the row each value came from, or (None, None) if the batch has no
+    such field.
+    '''
+    first, *rest = path.split('.')
+    if first not in batch.schema.names:
+        return None, None
+    array, rows = batch.column(first), np.arange(batch.num_rows)
+    for key in rest + [None]:
+        while pa.types.is_list(array.type) or pa.types.is_large_list(array.type):
+            rows = rows[pc.list_parent_indices(array).to_numpy()]
+            array = pc.list_flatten(array)
+        if key is None:
+            break
+        if not pa.types.is_struct(array.type) or array.type.get_field_index(key) < 0:
+            return None, None
+        array = pc.struct_field(array, key)
+    if pa.types.is_struct(array.type):
+        # Nested records match on their id, e.g. research_orgs = "grid.6268.a"
+        if array.type.get_field_index('id') < 0:
+            return None, None
+        array = pc.struct_field(array, 'id')
+    return array, rows
+
+
+def _row_mask(batch: pa.RecordBatch, condition) -> np.ndarray:
+    '''Find the rows of a batch with any value of a list or nested field meeting a condition.'''
+    mask = np.zeros(batch.num_rows, dtype=bool)
+    values, rows = _leaf_values(batch, condition.field)
+    if values is None or not len(values):
+        return mask
+    if condition.field in CASE_INSENSITIVE_FIELDS:
+        values = pc.utf8_lower(values)
+    value_set = _value_set(condition, values.type)
+    if condition.op in ('=', 'in'):
+        hits = pc.is_in(values, value_set=value_set)
+    else:
+        compare = {'>': pc.greater, '>=': pc.greater_equal, '<': pc.less, '<=': pc.less_equal}[condition.op]
+        hits = compare(values, value_set[0])
+    mask[rows[hits.fill_null(False).to_numpy(zero_copy_only=False)]] = True
+    return mask
+
+
+def _drop_missing(record: dict) -> dict:
+    # Parquet has a value for every column, where the API leaves missing fields out
+    return {key: value for key, value in record.items() if value is not None}
+
+
+def scan_parquet(files: list, query: Query) -> list:
+    '''Find the records of Parquet files matching a query.'''
+    dataset = ds.dataset(files, format='parquet')
+    schema = dataset.schema
+    wanted = set(query.fields or schema.names) | {condition.field.split('.')[0] for condition in query.conditions}
+    columns = [name for name in schema.names if name in wanted]
+
+    pushdown, residual = None, []
+    for condition in query.conditions:
+        name = condition.field.split('.')[0]
+        if name not in schema.names:
+            # No record has the field, so none can match
+            return []
+        if condition.field == name and not _is_nested(schema.field(name).type):
+            expression = _pushdown(condition, schema.field(name).type)
+            pushdown = expression if pushdown is None else pushdown & expression
+        else:
+            residual.append(condition)
+
+    records = []
+    for batch in dataset.to_batches(columns=columns, filter=pushdown, batch_size=BATCH_ROWS):
+        mask = np.ones(batch.num_rows, dtype=bool)
+        for condition in residual:
+            mask &= _row_mask(batch, condition)
+        if mask.any():
+            records += [project(_drop_missing(record), query.fields)
+                        for record in batch.filter(pa.array(mask)).to_pylist()]
+    return records
+
+
+def scan_jsonl(path: str, q: str) -> list:
+    '''Find the records of a JSON lines file matching a query.'''
+    query = parse(q)
+    tests = [matcher(condition) for condition in query.conditions]
+    # Every matching line contains one of the values of each pre-filter
+    prefilters = [[str(value) for value in condition.values] for condition in query.conditions
+                  if condition.op in ('=', 'in') and condition.field not in CASE_INSENSITIVE_FIELDS
+                  and len(condition.values) <= MAX_PREFILTER_VALUES]
+    records = []
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not all(any(value in line for value in values) for values in prefilters):
+                continue
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if all(test(record) for test in tests):
+                records.append(project(record, query.fields))
+    return records
+
+
+class LocalDsl:
+    '''Answers DSL queries by scanning a local bulk export.'''
+
+    # QueryPlanner sends every identifier in one query
+    unlimited: bool = True
+
+    def __init__(self, path: str | None = None, listeners: list = (), workers: int = SCAN_WORKERS):
+        self.path = path or os.getenv('DIMENSIONS_EXPORT', EXPORT_PATH)
+        self.parquet, self.jsonl = export_files(self.path)
+        if not self.parquet and not self.jsonl:
+            raise FileNotFoundError(f'No .parquet or .jsonl(.gz) files found in {self.path}')
+        self.listeners = list(listeners)
+        self.workers = workers
+
+    def _scan(self, q: str, query: Query) -> list:
+        records = scan_parquet(self.parquet, query) if self.parquet else []
+        if self.jsonl:
+            if self.workers > 1 and len(self.jsonl) > 1:
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(self.jsonl))) as pool:
+                    for found in pool.map(scan_jsonl, self.jsonl, [q] * len(self.jsonl)):
+                        records += found
+            else:
+                for path in self.jsonl:
+                    records += scan_jsonl(path, q)
+        return records
+
+    def _search(self, q: str, default_limit: int | None):
+        start = time.perf_counter()
+        try:
+            query = parse(q)
+            if query.source != 'publications':
+                raise DslSyntaxError('Only publications can be searched in a local export')
+        except DslSyntaxError as e:
+            print(f'DSL error in {q[:200]!r}: {e}')
+            return dimcli.DslDataset({'errors': {'query': {'header': str(e)}}})
+        records = self._scan(q, query)
+        limit = query.limit if query.limit is not None else default_limit
+        page = records[query.skip:] if limit is None else records[query.skip:query.skip + limit]
+        data = {'_stats': {'total_count': len(records)}, query.source: page}
+        tracer.query(q, latency=time.perf_counter() - start, records=len(page))
+        for listener in self.listeners:
+            listener(q, data)
+        return dimcli.DslDataset(data)
+
+    def query(self, q: str, **kwargs):
+        return self._search(q, DEFAULT_LIMIT)
+
+    def query_iterative(self, q: str, **kwargs):
+        '''Return every matching record, without the 50,000 record limit of the API.'''
+        return self._search(q, None)
@@ -0,0 +1,291 @@
+'''
+query_planner.py decides how to split a list of identifiers between DSL
+queries, replacing fixed chunk sizes.
+
+A query is written as a template with {ids} where the list of identifiers
+goes:
+
+    planner = QueryPlanner()
+    results = planner.fetch(dsl, 'search publications where id in {ids} return publications[id+doi]', ids)
+
+The identifiers are packed into as few queries as possible, each limited by
+the length of the query text, the number of items allowed in a list filter
+and the number of records the query is expected to return, which must stay
+under the 50,000 record limit of an iterative query. Every query is paged to
+completion. A query that still returns more than 50,000 records, or that
+the API rejects (e.g. as too long), is split in half and sent again, so
+results are never truncated. Other failures, which RateLimitedDsl has already
+retried, are raised, as is a rejected query for a single identifier.
+
+The planner learns from every query it sends. The number of records returned
+per identifier, the time taken per page and the largest list that has
+succeeded are kept for each source and filter field (e.g.
+publications:reference_ids) in data/query_planner.json, and used to size the
+queries of later runs. Lists are shrunk after rejected or truncated queries
+and slow requests, and grown again while requests succeed quickly.
+
+A source with no such limits, such as a LocalDsl reading a bulk export (see
+local_dsl.py), has an unlimited attribute, and is sent every identifier in
+one query.
+
+estimate() uses the same statistics to predict the number of requests a fetch
+will take, counting every page, before anything is sent (see scheduler.py).
+
+harvest() writes the results to a ChunkStore. The sizes of the batches are
+recorded in the store's manifest, so an interrupted harvest resumes with the
+same batches even if the planner has learned more since it started.
+'''
+import dimcli
+import numpy as np
+import pandas as pd
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from dsl_cache import filtered_fields
+from dsl_executor import MAX_RECORDS, MAX_WORKERS, PAGE_SIZE, RETURN_SOURCE, DslError
+
+PLANNER_PATH: str = os.path.join(os.getcwd(), 'data', 'query_planner.json')
+IDS: str = '{ids}'
+
+# Limits on a single query. Lists of more than 512 items are rejected by the
+# API, and long queries are slow to parse.
+MAX_QUERY_LENGTH: int = 16000
+MAX_LIST_ITEMS: int = 512
+
+# Aim for queries expected to return at most this share of MAX_RECORDS
+TARGET_FILL: float = 0.8
+
+# Requests slower than this many seconds per page make the lists shorter
+LATENCY_TARGET: float = 20.0
+
+# Weight given to each new observation of the records per identifier
+ALPHA: float = 0.3
+
+# Records per identifier assumed before anything has been observed
+DEFAULT_RESULTS_PER_ID: dict = {'id': 1, 'doi': 1, 'reference_ids': 25, 'researchers.id': 50}
+
+# Characters per identifier assumed when estimating the cost of a fetch, as
+# for Dimensions ids such as pub.1234567890
+ESTIMATED_ID_LENGTH: int = 14
+
+TEMPLATE_PATTERN = re.compile(r'search\s+(?P<source>\w+)\s+where\s+.*?(?P<field>[\w.]+)\s+in\s+\{ids\}', flags=re.S)
+
+
+def template_key(template: str) -> str:
+    '''
+    Key the planner's statistics by the source and field of the list filter,
+    e.g. publications:doi, followed by any other fields filtered on, e.g.
+    publications:reference_ids+date_inserted.
+    '''
+    match = TEMPLATE_PATTERN.search(template)
+    if not match:
+        raise ValueError(f'Query template must filter on a list with "in {IDS}": {template}')
+    others = [field for field in filtered_fields(template) if field != match.group('field')]
+    return f"{match.group('source')}:" + '+'.join([match.group('field')] + others)
+
+
+def rejected(error: requests.HTTPError) -> bool:
+    '''Check whether a query failed for its size or syntax, rather than a passing fault of the API.'''
+    return isinstance(error, DslError) or (error.response is not None and error.response.status_code in (400, 413))
+
+
+def unique_ids(ids) -> list:
+    '''Drop missing and repeated identifiers, keeping the first occurrence of each.'''
+    return [str(i) for i in pd.unique(pd.Series(list(ids), dtype=object).dropna())]
+
+
+class QueryPlanner:
+    '''Packs identifiers into DSL queries and tunes the packing from feedback.'''
+
+    def __init__(self, path: str = PLANNER_PATH, max_length: int = MAX_QUERY_LENGTH,
+                 max_items: int = MAX_LIST_ITEMS, max_records: int = MAX_RECORDS):
+        self.path = path
+        self.max_length = max_length
+        self.max_items = max_items
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        self.stats = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stats = json.load(f)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.stats, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    @staticmethod
+    def query(template: str, batch: list) -> str:
+        return template.replace(IDS, json.dumps(list(batch)))
+
+    def results_per_id(self, key: str) -> float:
+        field = key.split(':', 1)[1].split('+')[0]
+        return self.stats.get(key, {}).get('results_per_id', DEFAULT_RESULTS_PER_ID.get(field, 1))
+
+    def batches(self, template: str, ids, unlimited: bool = False) -> list:
+        '''Pack identifiers into batches for the query template.'''
+        if unlimited:
+            ids = unique_ids(ids)
+            return [ids] if ids else []
+        key = template_key(template)
+        per_id = max(self.results_per_id(key), 1e-6)
+        max_items = min(self.max_items, self.stats.get(key, {}).get('max_items', self.max_items))
+        max_ids_by_results = max(1, int(TARGET_FILL * self.max_records / per_id))
+        room = self.max_length - len(template) + len(IDS)
+
+        batches, batch, length = [], [], 2
+        for i in unique_ids(ids):
+            item = len(json.dumps(i)) + 2
+            if batch and (len(batch) >= max_items or len(batch) >= max_ids_by_results or length + item > room):
+                batches.append(batch)
+                batch, length = [], 2
+            batch.append(i)
+            length += item
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def estimate(self, template: str, n_ids: int, id_length: int = ESTIMATED_ID_LENGTH) -> int:
+        '''
+        Estimate the number of requests, counting every page, needed to fetch
+        n_ids identifiers of about id_length characters with the query template.
+        '''
+        if n_ids <= 0:
+            return 0
+        key = template_key(template)
+        per_id = max(self.results_per_id(key), 1e-6)
+        max_items = min(self.max_items, self.stats.get(key, {}).get('max_items', self.max_items))
+        max_ids_by_results = max(1, int(TARGET_FILL * self.max_records / per_id))
+        max_ids_by_length = max(1, (self.max_length - len(template) + len(IDS) - 2) // (id_length + 4))
+        size = min(max_items, max_ids_by_results, max_ids_by_length)
+
+        def pages(n: int) -> int:
+            return max(1, int(np.ceil(min(n * per_id, self.max_records) / PAGE_SIZE)))
+
+        full, rest = divmod(int(n_ids), size)
+        return full * pages(size) + (pages(rest) if rest else 0)
+
+    def observe(self, key: str, n_ids: int, total: int | None, pages: int, seconds: float, too_big: bool):
+        '''
+        Update the statistics for a query template from one query, where
+        too_big means the query was rejected or its results truncated.
+        '''
+        with self._lock:
+            stats = self.stats.setdefault(key, {})
+            cap = stats.get('max_items', self.max_items)
+            if too_big:
+                stats['max_items'] = max(1, min(cap, n_ids) // 2)
+            if total is None:
+                return
+            if n_ids:
+                rate = total / n_ids
+                stats['results_per_id'] = (rate if 'results_per_id' not in stats
+                                           else (1 - ALPHA) * stats['results_per_id'] + ALPHA * rate)
+            per_page = seconds / max(pages, 1)
+            stats['seconds_per_page'] = (per_page if 'seconds_per_page' not in stats
+                                         else (1 - ALPHA) * stats['seconds_per_page'] + ALPHA * per_page)
+            if not too_big and per_page > LATENCY_TARGET:
+                stats['max_items'] = max(1, int(min(cap, n_ids) * 0.75))
+            elif not too_big and n_ids >= cap and cap < self.max_items:
+                stats['max_items'] = min(self.max_items, cap + max(1, cap // 10))
+            stats['queries'] = stats.get('queries', 0) + 1
+
+    def split(self, dsl, template: str, batch: list):
+        middle = len(batch) // 2
+        return merge_results([self.fetch_batch(dsl, template, batch[:middle]),
+                              self.fetch_batch(dsl, template, batch[middle:])],
+                             RETURN_SOURCE.search(template).group(1))
+
+    def fetch_batch(self, dsl, template: str, batch: list):
+        '''
+        Page a query for one batch to completion, splitting the batch and
+        merging the results if it is truncated or rejected by the API. A
+        single identifier whose query is rejected raises a DslError, and any
+        other failure, which RateLimitedDsl has already retried, is raised.
+        '''
+        key = template_key(template)
+        start = time.perf_counter()
+        try:
+            results = dsl.query_iterative(self.query(template, batch))
+            if results.json.get('errors'):
+                # As returned by a LocalDsl
+                raise DslError(f'DSL error {results.json["errors"]} for {batch[:3]}')
+        except requests.HTTPError as e:
+            if not rejected(e):
+                raise
+            self.observe(key, len(batch), None, 0, time.perf_counter() - start, too_big=True)
+            if len(batch) == 1:
+                raise
+            return self.split(dsl, template, batch)
+
+        total = results.json.get('_stats', {}).get('total_count', 0)
+        pages = int(np.ceil(min(total, self.max_records) / PAGE_SIZE)) or 1
+        returned = len(results.json.get(RETURN_SOURCE.search(template).group(1), []))
+        truncated = total > returned
+        self.observe(key, len(batch), total, pages, time.perf_counter() - start, too_big=truncated)
+        if truncated and len(batch) > 1:
+            return self.split(dsl, template, batch)
+        if truncated:
+            print(f'Results for {batch[0]} truncated to {returned} of {total}')
+        return results
+
+    def iter_fetch(self, dsl, template: str, ids, max_workers: int = MAX_WORKERS):
+        '''Fetch every batch concurrently, yielding (batch, results) pairs in order.'''
+        batches = self.batches(template, ids, getattr(dsl, 'unlimited', False))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [(batch, pool.submit(self.fetch_batch, dsl, template, batch)) for batch in batches]
+            for batch, future in futures:
+                yield batch, future.result()
+        self.save()
+
+    def fetch(self, dsl, template: str, ids, max_workers: int = MAX_WORKERS) -> list:
+        '''Fetch every batch concurrently and return the results in order.'''
+        return [results for _, results in self.iter_fetch(dsl, template, ids, max_workers)]
+
+    def harvest(self, store, dsl, template: str, ids, to_frames=None, max_workers: int = MAX_WORKERS):
+        '''Fetch every batch into a ChunkStore, resuming an interrupted harvest.'''
+        ids = unique_ids(ids)
+        key = hashlib.sha256(json.dumps([template] + ids).encode('utf-8')).hexdigest()
+        plan = store.manifest.get('plan') or {}
+        if plan.get('key') == key:
+            # Resume with the batches the harvest was started with
+            bounds = np.cumsum([0] + plan['sizes'])
+            batches = [ids[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+        else:
+            batches = self.batches(template, ids, getattr(dsl, 'unlimited', False))
+        queries = [self.query(template, batch) for batch in batches]
+        store.prepare(queries, plan={'key': key, 'sizes': [len(batch) for batch in batches]})
+        store.harvest(PlannedDsl(self, dsl, template, batches), queries, to_frames=to_frames,
+                      max_workers=max_workers)
+        self.save()
+        return store
+
+
+class PlannedDsl:
+    '''Sends the queries of a plan through QueryPlanner.fetch_batch(), for ChunkStore.harvest().'''
+
+    def __init__(self, planner: QueryPlanner, dsl, template: str, batches: list):
+        self.planner = planner
+        self.dsl = dsl
+        self.template = template
+        self.batches = {planner.query(template, batch): batch for batch in batches}
+
+    def query_iterative(self, q: str, **kwargs):
+        return self.planner.fetch_batch(self.dsl, self.template, self.batches[q])
+
+    query = query_iterative
+
+
+def merge_results(parts: list, source: str):
+    '''Combine the results of the halves of a split query.'''
+    records = [record for part in parts for record in part.json.get(source, [])]
+    return dimcli.DslDataset({'_stats': {'total_count': len(records)}, source: records})
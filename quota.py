@@ -0,0 +1,155 @@
+'''
+quota.py shares the request quota of a Dimensions subscription between
+every script running on a machine, rather than each process keeping to the
+quota on its own.
+
+QuotaBudget has the same acquire() method as the TokenBucket of
+dsl_executor.py, so it can be given to a RateLimitedDsl in its place:
+
+    dsl = RateLimitedDsl(dimcli.Dsl(), bucket=QuotaBudget(job='feet_of_clay', weight=2))
+
+Every request granted is logged in a SQLite database, by default
+data/quota.sqlite, that all the processes share. A request is granted when
+
+- fewer than per_day requests have been made since midnight UTC, when the
+  daily quota of the subscription resets, if there is a daily quota,
+- fewer than per_minute requests have been made in the last minute, and at
+  least 60 / per_minute seconds have passed since the last one, so requests
+  are spread evenly through the minute, and
+- no other job waiting for a request has used less of the last minute in
+  proportion to its weight.
+
+The last condition shares the quota between jobs in proportion to their
+weights while they compete for it, and lets a job use all of it when the
+others are busy with something else. A job that has used up the daily quota
+sleeps until it resets, and carries on where it stopped.
+
+backends.connect() uses a QuotaBudget for every process started with
+DIMENSIONS_QUOTA or DIMENSIONS_JOB set, as the jobs started by scheduler.py
+are.
+'''
+import os
+import sqlite3
+import threading
+import time
+
+from dsl_executor import RATE_PER_MINUTE
+
+QUOTA_PATH: str = os.getenv('DIMENSIONS_QUOTA', os.path.join(os.getcwd(), 'data', 'quota.sqlite'))
+
+# Requests allowed per day by the subscription, 0 for no daily quota
+RATE_PER_DAY: int = int(os.getenv('DIMENSIONS_RATE_PER_DAY', 0))
+
+MINUTE: int = 60
+DAY: int = 86400
+
+# Longest time a waiting request sleeps before checking the budget again,
+# and how long a waiter that stops checking keeps its claim to a request
+POLL_SECONDS: float = 5.0
+WAIT_TIMEOUT: float = 30.0
+
+
+def day_start(now: float) -> float:
+    '''Get the time the daily quota last reset, at midnight UTC.'''
+    return now - now % DAY
+
+
+class QuotaBudget:
+    '''
+    Per-minute and per-day request budget shared through SQLite by every
+    process, and divided between jobs by weight.
+    '''
+
+    def __init__(self, path: str = QUOTA_PATH, per_minute: float = RATE_PER_MINUTE, per_day: int = RATE_PER_DAY,
+                 job: str | None = None, weight: float = 1.0):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.job = job if job is not None else f'pid {os.getpid()}'
+        self.weight = weight
+        self._lock = threading.Lock()
+        # Transactions are begun explicitly, so that only one process at a time checks the budget
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS requests (
+                                time REAL,
+                                job TEXT)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS requests_time ON requests (time)')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS waiting (
+                                waiter TEXT PRIMARY KEY,
+                                job TEXT,
+                                weight REAL,
+                                seen REAL)''')
+
+    def acquire(self) -> float:
+        '''Block until the budget allows a request and return the time spent waiting.'''
+        waiter = f'{os.getpid()}:{threading.get_ident()}'
+        waited = 0.0
+        while True:
+            delay = self._request(waiter)
+            if delay <= 0:
+                return waited
+            # Wake up regularly to keep a claim on the next request
+            delay = min(delay, POLL_SECONDS)
+            time.sleep(delay)
+            waited += delay
+
+    def _request(self, waiter: str) -> float:
+        '''Grant a request and return 0, or return the time to wait before asking again.'''
+        now = time.time()
+        today = day_start(now)
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM requests WHERE time < ?', (min(today, now - MINUTE),))
+                self._db.execute('DELETE FROM waiting WHERE seen < ?', (now - WAIT_TIMEOUT,))
+                self._db.execute('INSERT OR REPLACE INTO waiting VALUES (?, ?, ?, ?)',
+                                 (waiter, self.job, self.weight, now))
+                delay = self._delay(waiter, now, today)
+                if delay <= 0:
+                    self._db.execute('INSERT INTO requests VALUES (?, ?)', (now, self.job))
+                    self._db.execute('DELETE FROM waiting WHERE waiter = ?', (waiter,))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return delay
+
+    def _delay(self, waiter: str, now: float, today: float) -> float:
+        if self.per_day:
+            (used,) = self._db.execute('SELECT COUNT(*) FROM requests WHERE time >= ?', (today,)).fetchone()
+            if used >= self.per_day:
+                # Sleep until the daily quota resets
+                return today + DAY - now
+        recent = [row[0] for row in self._db.execute('SELECT time FROM requests WHERE time > ? ORDER BY time',
+                                                     (now - MINUTE,))]
+        if recent and recent[-1] + MINUTE / self.per_minute > now:
+            return recent[-1] + MINUTE / self.per_minute - now
+        if len(recent) >= self.per_minute:
+            return recent[-int(self.per_minute)] + MINUTE - now
+
+        # Give way to any waiting job that has used less of its share of the last minute
+        usage = dict(self._db.execute('SELECT job, COUNT(*) FROM requests WHERE time > ? GROUP BY job',
+                                      (now - MINUTE,)).fetchall())
+        share = usage.get(self.job, 0) / self.weight
+        for job, weight in self._db.execute('SELECT job, weight FROM waiting WHERE waiter != ? AND job != ?',
+                                            (waiter, self.job)):
+            if usage.get(job, 0) / weight < share:
+                return MINUTE / self.per_minute
+        return 0.0
+
+    def used_today(self, now: float | None = None) -> int:
+        '''Count the requests made since the daily quota last reset.'''
+        now = time.time() if now is None else now
+        with self._lock:
+            (used,) = self._db.execute('SELECT COUNT(*) FROM requests WHERE time >= ?', (day_start(now),)).fetchone()
+        return used
+
+    def exhausted(self) -> bool:
+        '''Check whether the daily quota has been used up.'''
+        return bool(self.per_day) and self.used_today() >= self.per_day
+
+    def __str__(self) -> str:
+        daily = f' and {self.used_today()}/{self.per_day} today' if self.per_day else ''
+        return f'Quota budget: {self.per_minute:g} requests per minute{daily} ({self.path})'
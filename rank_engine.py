@@ -0,0 +1,204 @@
+'''
+rank_engine.py ranks target publications by citation rate within their
+co-citation cohorts, without ranking every member of every cohort.
+
+The percentile rank of a target is the share of the members of its cohort
+whose citation rate is no higher than its own, as given by pandas
+rank(pct=True, method='max'). Only the rank of the target is needed, so rather
+than sorting and ranking every member, each member's rate is compared with the
+rate of its target and the results are counted per cohort with np.bincount.
+This is a single pass over the cohort members, in chunks of CHUNK_ROWS, that
+holds integer codes and rates rather than a merged data frame of strings:
+
+    engine = RankEngine(target_ids, target_rates)
+    engine.add(member_target_ids, member_rates)
+    df_ranks = engine.result()
+
+The result also has the size of each cohort and the QUANTILES of the citation
+rates in it, e.g. rate_p50 for the median.
+
+With method='digest', the rates of each cohort are summarised in a TDigest
+instead, a sketch of at most a few hundred weighted centroids, and the rank
+and quantiles are estimated from it. Memory then stays bounded however large
+the cohorts grow, at the cost of ranks that may be a point or so out in the
+middle of very large cohorts. Ranks in the tails, where a rank of 99 or 1
+matters most, stay accurate.
+'''
+import numpy as np
+import pandas as pd
+
+# Quantiles of the citation rates of each cohort to report
+QUANTILES: tuple = (0.25, 0.5, 0.75, 0.9)
+
+# Cohort members compared at a time
+CHUNK_ROWS: int = 1000000
+
+# Centroids kept by a TDigest: more are more accurate and use more memory
+COMPRESSION: int = 200
+
+METHODS: tuple = ('exact', 'digest')
+
+
+def quantile_column(q: float) -> str:
+    return f'rate_p{round(q * 100):g}'
+
+
+def percentrank(share) -> np.ndarray:
+    '''Express shares of cohorts as whole percentages, as rounded by earlier versions of the script.'''
+    return (np.round(np.asarray(share, dtype=float), 2) * 100).astype(int)
+
+
+class TDigest:
+    '''
+    Mergeable sketch of a distribution for approximate ranks and quantiles in
+    bounded memory (Dunning & Ertl, 2019).
+    '''
+
+    def __init__(self, compression: int = COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def __len__(self) -> int:
+        return int(self.weights.sum())
+
+    def update(self, values, weights=None):
+        '''Add values, with optional weights, and compress the centroids again.'''
+        values = np.asarray(values, dtype=float)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float)
+        keep = ~np.isnan(values)
+        values, weights = values[keep], weights[keep]
+        if not len(values):
+            return
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        means = np.concatenate([self.means, values])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        # The k1 scale function makes clusters small in the tails, so extreme
+        # ranks stay accurate, and lets them grow in the middle
+        q = (cumulative - weights / 2) / cumulative[-1]
+        clusters = np.floor(self.compression * (np.arcsin(2 * q - 1) / np.pi + 0.5))
+        starts = np.flatnonzero(np.r_[True, np.diff(clusters) > 0])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def merge(self, other: 'TDigest'):
+        if len(other):
+            self.update(other.means, other.weights)
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+
+    def _midpoints(self) -> np.ndarray:
+        return np.cumsum(self.weights) - self.weights / 2
+
+    def cdf(self, x: float) -> float:
+        '''Estimate the share of values no greater than x.'''
+        if not len(self.weights) or np.isnan(x):
+            return np.nan
+        if x < self.min:
+            return 0.0
+        if x >= self.max:
+            return 1.0
+        total, midpoints = self.weights.sum(), self._midpoints()
+        ties = np.flatnonzero(self.means == x)
+        if len(ties):
+            # Count every value equal to x, as rank(method='max') does
+            return (midpoints[ties[-1]] + self.weights[ties[-1]] / 2) / total
+        return np.interp(x, np.r_[self.min, self.means, self.max], np.r_[0, midpoints, total]) / total
+
+    def quantile(self, q: float) -> float:
+        if not len(self.weights):
+            return np.nan
+        total = self.weights.sum()
+        return float(np.interp(q * total, np.r_[0, self._midpoints(), total], np.r_[self.min, self.means, self.max]))
+
+
+class RankEngine:
+    '''
+    Ranks each target by citation rate within its cohort from per-cohort
+    counts, fed one chunk of cohort members at a time.
+    '''
+
+    def __init__(self, target_ids, target_rates, quantiles: tuple = QUANTILES, method: str = 'exact',
+                 compression: int = COMPRESSION):
+        if method not in METHODS:
+            raise ValueError(f'Unknown rank method {method!r}, expected one of {", ".join(METHODS)}')
+        # Looked up as objects, so a column of Arrow strings is only converted once
+        self.targets = pd.Index(np.asarray(target_ids, dtype=object))
+        self.target_rates = np.asarray(target_rates, dtype=float)
+        self.quantiles = tuple(quantiles)
+        self.method = method
+        n = len(self.targets)
+        self.sizes = np.zeros(n, dtype=np.int64)
+        self.at_or_below = np.zeros(n, dtype=np.int64)
+        self.digests = [TDigest(compression) for _ in range(n)] if method == 'digest' else None
+        self._codes, self._rates = [], []
+
+    def add(self, target_ids, rates):
+        '''Add a chunk of cohort members, given the target of each cohort and the member's rate.'''
+        codes = self.targets.get_indexer(target_ids)
+        rates = np.asarray(rates, dtype=float)
+        # Members without a rate are not ranked, as by rank()
+        keep = (codes >= 0) & ~np.isnan(rates)
+        codes, rates = codes[keep], rates[keep]
+        n = len(self.targets)
+        self.sizes += np.bincount(codes, minlength=n)
+        if self.method == 'exact':
+            self.at_or_below += np.bincount(codes[rates <= self.target_rates[codes]], minlength=n)
+            if self.quantiles:
+                self._codes.append(codes.astype(np.int32))
+                self._rates.append(rates)
+            return
+        if not len(codes):
+            return
+        order = np.argsort(codes, kind='stable')
+        codes, rates = codes[order], rates[order]
+        bounds = np.flatnonzero(np.r_[True, np.diff(codes) > 0, True])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            self.digests[codes[start]].update(rates[start:end])
+
+    def _exact_quantiles(self) -> np.ndarray:
+        table = np.full((len(self.targets), len(self.quantiles)), np.nan)
+        if not self._codes:
+            return table
+        # Counting sort: each cohort's rates are written into its own slice of
+        # one array, from offsets given by the cohort sizes, a chunk at a time
+        bounds = np.r_[0, np.cumsum(self.sizes)]
+        cursor = bounds[:-1].copy()
+        rates = np.empty(bounds[-1])
+        for codes, chunk_rates in zip(self._codes, self._rates):
+            order = np.argsort(codes, kind='stable')
+            codes = codes[order]
+            starts = np.flatnonzero(np.r_[True, np.diff(codes) > 0])
+            counts = np.diff(np.r_[starts, len(codes)])
+            # Position of each member among the members of its cohort in the chunk
+            within = np.arange(len(codes)) - np.repeat(starts, counts)
+            rates[cursor[codes] + within] = chunk_rates[order]
+            cursor[codes[starts]] += counts
+        for code in np.flatnonzero(self.sizes):
+            table[code] = np.quantile(rates[bounds[code]:bounds[code + 1]], self.quantiles)
+        return table
+
+    def result(self) -> pd.DataFrame:
+        '''Get the percentrank, cohort_size and rate quantiles of every target.'''
+        if self.method == 'exact':
+            share = np.divide(self.at_or_below, self.sizes, out=np.full(len(self.sizes), np.nan),
+                              where=self.sizes > 0)
+            table = self._exact_quantiles() if self.quantiles else np.empty((len(self.targets), 0))
+        else:
+            share = np.array([digest.cdf(rate) for digest, rate in zip(self.digests, self.target_rates)])
+            table = np.array([[digest.quantile(q) for q in self.quantiles] for digest in self.digests])
+            table = table.reshape(len(self.targets), len(self.quantiles))
+        ranked = ~np.isnan(share) & ~np.isnan(self.target_rates)
+        df_ranks = pd.DataFrame({
+            'target_id': self.targets[ranked],
+            'percentrank': percentrank(share[ranked]),
+            'cohort_size': self.sizes[ranked],
+        })
+        for column, q in enumerate(self.quantiles):
+            df_ranks[quantile_column(q)] = table[ranked, column].round(2)
+        return df_ranks
@@ -0,0 +1,98 @@
+'''
+reference_table.py holds the references cited by a set of publications as
+integer-encoded citation links, rather than as a data frame with one Python
+string per link.
+
+The publication ids and the distinct reference ids are each stored once, in
+Arrow string arrays, and each citation link is a pair of int32 positions in
+those arrays, so millions of links take tens of megabytes. The links to a
+set of references, e.g. those that have been retracted, are found by integer
+lookups in chunks of CHUNK_LINKS links, and only the links found are turned
+back into a data frame of strings:
+
+    references = ReferenceTable.from_records(results.json['publications'])
+    df_links = references.links(retracted_ids)
+'''
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Number of citation links examined at a time
+CHUNK_LINKS: int = 1000000
+
+
+class ReferenceTable:
+    '''Integer-encoded citation links from publications to the references they cite.'''
+
+    def __init__(self, pub_ids: pa.Array, reference_ids: pa.Array, citing: np.ndarray, cited: np.ndarray):
+        self.pub_ids = pub_ids
+        self.reference_ids = reference_ids
+        self.citing = citing
+        self.cited = cited
+
+    @classmethod
+    def from_lists(cls, pub_ids: list, reference_lists: list) -> 'ReferenceTable':
+        '''Build the table from a list of publication ids and a list of their reference lists.'''
+        lists = pa.array([refs if isinstance(refs, list) else [] for refs in reference_lists],
+                         type=pa.list_(pa.string()))
+        encoded = pc.dictionary_encode(pc.list_flatten(lists))
+        return cls(
+            pa.array(pub_ids, type=pa.string()),
+            encoded.dictionary,
+            pc.list_parent_indices(lists).to_numpy().astype(np.int32),
+            encoded.indices.to_numpy(zero_copy_only=False).astype(np.int32),
+        )
+
+    @classmethod
+    def concat(cls, tables: list) -> 'ReferenceTable':
+        '''
+        Combine tables built from separate pages of publications, encoding
+        the distinct reference ids of all of them once.
+        '''
+        if not tables:
+            return cls.from_lists([], [])
+        encoded = pc.dictionary_encode(pa.concat_arrays([table.reference_ids for table in tables]))
+        codes = encoded.indices.to_numpy(zero_copy_only=False).astype(np.int32)
+        # The codes of each table's references in the combined dictionary
+        starts = np.cumsum([0] + [len(table.reference_ids) for table in tables])
+        publications = np.cumsum([0] + [len(table.pub_ids) for table in tables])
+        return cls(
+            pa.concat_arrays([table.pub_ids for table in tables]),
+            encoded.dictionary,
+            np.concatenate([table.citing + offset for table, offset in zip(tables, publications)]),
+            np.concatenate([codes[start:][table.cited] for table, start in zip(tables, starts)]),
+        )
+
+    @classmethod
+    def from_records(cls, records: list) -> 'ReferenceTable':
+        '''
+        Build the table from DSL publication records. The records are not
+        changed, as they may be shared with the query cache, so their
+        reference_ids are only freed when the caller drops the records.
+        '''
+        return cls.from_lists([record.get('id') for record in records],
+                              [record.get('reference_ids') for record in records])
+
+    def __len__(self) -> int:
+        return len(self.cited)
+
+    def unique_reference_ids(self) -> list:
+        return self.reference_ids.to_pylist()
+
+    def iter_reference_ids(self, chunk_size: int = CHUNK_LINKS):
+        '''Yield the distinct reference ids in lists of at most chunk_size.'''
+        for start in range(0, len(self.reference_ids), chunk_size):
+            yield self.reference_ids.slice(start, chunk_size).to_pylist()
+
+    def links(self, reference_ids) -> pd.DataFrame:
+        '''Get the pub_id and reference_ids of every link to one of a set of references.'''
+        wanted = pc.is_in(self.reference_ids, value_set=pa.array(list(reference_ids), type=pa.string()))
+        wanted = wanted.to_numpy(zero_copy_only=False)
+        rows = [np.flatnonzero(wanted[self.cited[start:start + CHUNK_LINKS]]) + start
+                for start in range(0, len(self.cited), CHUNK_LINKS)]
+        rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        return pd.DataFrame({
+            'pub_id': self.pub_ids.take(pa.array(self.citing[rows])).to_numpy(zero_copy_only=False),
+            'reference_ids': self.reference_ids.take(pa.array(self.cited[rows])).to_numpy(zero_copy_only=False),
+        })
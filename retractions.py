@@ -0,0 +1,189 @@
+'''
+retractions.py keeps a compact local snapshot of the Retraction Watch/Crossref
+database for checking DOIs against.
+
+The full database is a CSV file of more than 50MB. Rather than downloading and
+parsing it on every run, RetractionStore keeps the handful of columns the
+scripts use in a Parquet file, along with a sorted array of hashes of the
+normalized original paper DOIs that is memory-mapped for lookups.
+
+The snapshot is refreshed with a conditional request (If-None-Match and
+If-Modified-Since), so the database is only downloaded again when it has
+changed, and at most once every REFRESH_INTERVAL seconds. If the database
+cannot be downloaded, the existing snapshot is used, or failing that a copy
+of the database downloaded to a local file.
+
+Usage:
+
+    store = RetractionStore(email=EMAIL)
+    store.refresh()
+    retracted = store.lookup(df_publications['doi'])
+'''
+import numpy as np
+import pandas as pd
+import requests
+
+import json
+import os
+import time
+
+from id_index import normalize_dois
+
+RETRACTION_WATCH_URL: str = os.getenv('RETRACTION_WATCH_URL', 'https://api.labs.crossref.org/data/retractionwatch')
+STORE_DIR: str = os.path.join(os.getcwd(), 'data', 'retraction_watch')
+REFRESH_INTERVAL: int = 86400
+
+# The columns of the Retraction Watch database kept in the snapshot, after
+# they have been converted to snake case
+COLUMNS: list = ['record_id', 'retraction_date', 'retraction_doi', 'original_paper_doi',
+                 'retraction_nature', 'reason']
+
+
+def clean_retractions(retractions: pd.DataFrame) -> pd.DataFrame:
+    '''Convert the raw Retraction Watch database to the compact snapshot format.'''
+    retractions.columns = (
+        retractions.columns
+        .str.replace('(?<=[a-z])(?=[A-Z])', '_', regex=True)
+        .str.replace(' ', '_')
+        .str.lower()
+    )
+    retractions = (
+        retractions
+        .filter(COLUMNS)
+        .assign(retraction_date = lambda df: pd.to_datetime(df['retraction_date'].str.split(' ').str[0]),
+                original_paper_doi = lambda df: normalize_dois(df['original_paper_doi']))
+    )
+    return retractions[retractions['original_paper_doi'].notnull()]
+
+
+def hash_dois(dois) -> np.ndarray:
+    return pd.util.hash_array(np.asarray(dois, dtype=object))
+
+
+class RetractionStore:
+    '''Local snapshot of the Retraction Watch database with a hashed DOI index.'''
+
+    def __init__(self, path: str = STORE_DIR, url: str = RETRACTION_WATCH_URL, email: str | None = None,
+                 local_file: str = 'retractions.csv'):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        # Crossref asks you to be polite by providing an email when making API requests
+        self.url = url + '?' + email if email else url
+        self.local_file = local_file
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.table_path = os.path.join(path, 'retractions.parquet')
+        self.hash_path = os.path.join(path, 'doi_hash.npy')
+        self._table = None
+        self._hashes = None
+
+    def _meta(self) -> dict:
+        if not os.path.exists(self.meta_path):
+            return {}
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def refresh(self, force: bool = False) -> bool:
+        '''
+        Update the snapshot if the database has changed since it was taken.
+
+        Returns True if the snapshot was rebuilt.
+        '''
+        meta = self._meta()
+        has_snapshot = os.path.exists(self.table_path) and os.path.exists(self.hash_path)
+        if has_snapshot and not force and time.time() - meta.get('checked', 0) < REFRESH_INTERVAL:
+            return False
+
+        headers = {}
+        if has_snapshot and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if has_snapshot and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        download = os.path.join(self.path, 'retraction_watch.csv.tmp')
+        try:
+            with requests.get(self.url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 304:
+                    self._save_meta(dict(meta, checked=time.time()))
+                    return False
+                response.raise_for_status()
+                with open(download, 'wb') as f:
+                    for block in response.iter_content(chunk_size=1 << 20):
+                        f.write(block)
+                meta = {'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'source': self.url}
+        except requests.RequestException as error:
+            if has_snapshot:
+                print('Could not refresh the Retraction Watch database, using the existing snapshot:', error)
+                return False
+            if not os.path.exists(self.local_file):
+                raise
+            print('Could not download the Retraction Watch database, using', self.local_file)
+            download = self.local_file
+            meta = {'source': os.path.abspath(self.local_file)}
+
+        # You MUST make sure the encoding is set or Pandas will report an error
+        self.build(pd.read_csv(download, encoding='ISO-8859-1'))
+        if download != self.local_file:
+            os.remove(download)
+        self._save_meta(dict(meta, checked=time.time()))
+        return True
+
+    def _save_meta(self, meta: dict):
+        with open(self.meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def build(self, retractions: pd.DataFrame):
+        '''Build the snapshot and DOI index from the raw Retraction Watch database.'''
+        retractions = clean_retractions(retractions)
+        hashes = hash_dois(retractions['original_paper_doi'])
+        order = np.argsort(hashes, kind='stable')
+        retractions.iloc[order].to_parquet(self.table_path + '.tmp', index=False)
+        np.save(self.hash_path + '.tmp.npy', hashes[order])
+        os.replace(self.table_path + '.tmp', self.table_path)
+        os.replace(self.hash_path + '.tmp.npy', self.hash_path)
+        self._table = None
+        self._hashes = None
+
+    @property
+    def table(self) -> pd.DataFrame:
+        if self._table is None:
+            self._table = pd.read_parquet(self.table_path, memory_map=True)
+        return self._table
+
+    @property
+    def hashes(self) -> np.ndarray:
+        if self._hashes is None:
+            self._hashes = np.load(self.hash_path, mmap_mode='r')
+        return self._hashes
+
+    def _match(self, dois) -> tuple:
+        '''Get the positions of the queried DOIs and the snapshot rows they match.'''
+        dois = normalize_dois(pd.Series(dois, dtype=object)).dropna().unique()
+        dois = np.asarray(dois, dtype=object)
+        if len(dois) == 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.intp), dois
+        query = hash_dois(dois)
+        left = np.searchsorted(self.hashes, query, side='left')
+        right = np.searchsorted(self.hashes, query, side='right')
+        counts = right - left
+        # Expand each [left, right) range into the row positions it covers
+        queried = np.repeat(np.arange(len(dois)), counts)
+        rows = np.repeat(left, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        # Check the DOIs themselves in case of a hash collision
+        same = self.table['original_paper_doi'].to_numpy(dtype=object)[rows] == dois[queried]
+        return queried[same], rows[same], dois
+
+    def lookup(self, dois) -> pd.DataFrame:
+        '''Get the Retraction Watch records for any of a list of DOIs.'''
+        _, rows, _ = self._match(dois)
+        return self.table.iloc[rows].reset_index(drop=True)
+
+    def contains(self, dois) -> np.ndarray:
+        '''Vectorized check of whether each of a list of DOIs is in the database.'''
+        normalized = normalize_dois(pd.Series(dois, dtype=object))
+        queried, rows, unique_dois = self._match(normalized)
+        return normalized.isin(unique_dois[queried]).to_numpy()
+
+    def __len__(self) -> int:
+        return len(self.hashes)
@@ -0,0 +1,435 @@
+'''
+scheduler.py queues runs of the analysis scripts and runs them under a shared
+request budget, so that a large job cannot starve the others of the quota of
+a Dimensions subscription.
+
+    python scheduler.py submit feet_of_clay --cwd reports/ucl --priority 2 --param publications=20000
+    python scheduler.py submit co_citation_percentile_rank --cwd reports/cocite
+    python scheduler.py dry-run
+    python scheduler.py run
+
+Each job is a script, the folder it runs in (where it finds its inputs and
+writes its data folder), a priority, and any environment variables to set for
+it. Jobs are kept in a SQLite database, by default data/scheduler.sqlite, so
+the queue survives restarts of the scheduler.
+
+When a job is submitted, the number of requests it will make, counting every
+page, is estimated from the size of its inputs and the statistics the
+QueryPlanner has learned in its folder (see query_planner.py):
+
+- co_citation_percentile_rank: the DOIs in data/publications.csv not yet in
+  the IdIndex, the publications citing them and the members of their
+  co-citation cohorts, using the cohort sizes of the last report in the
+  folder if there is one
+- feet_of_clay and integrity_report: the publications of the institution in
+  the year, given by the publications parameter, and the references they cite
+- author_self_citation: the researchers in publications.csv
+- aif: the researchers in RESEARCHER_IDS and the publications citing them
+- talent_program_checker: the publications in data/aggregated_publications.csv
+
+The estimates are upper bounds, since queries answered from the query cache
+or references already in the IdIndex cost nothing. dry-run prints them with
+the time each queued job should finish under the per-minute and per-day quota.
+
+run starts the queued jobs in order of priority, up to MAX_JOBS at once, and
+each job's requests are granted by a QuotaBudget shared by every job (see
+quota.py), in proportion to its priority while others are waiting. A job that
+runs out of daily quota sleeps until it resets. If the scheduler is stopped,
+the jobs it was running are queued again when it is restarted, and resume
+from their harvests and the query cache.
+'''
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+
+import argparse
+from dataclasses import dataclass, field
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from aif import RESEARCHER_IDS
+from author_self_citation import researcher_query
+from chunk_store import ChunkStore
+from co_citation_percentile_rank import DOI_QUERY
+from cohorts import COHORT_DATA_QUERY, citing_query
+from dsl_executor import MAX_RECORDS, PAGE_SIZE
+from feet_of_clay import AFFILIATIONS_QUERY
+from harvest_planner import INDEXED_FIELDS, HarvestPlanner, cited_query
+from id_index import REFERENCES_QUERY, IdIndex, normalize_dois
+from integrity_report import ANALYSES, REGISTRY
+from query_planner import QueryPlanner, template_key
+from quota import DAY, MINUTE, QuotaBudget, day_start
+from talent_program_checker import PUBLICATIONS_FILE, TALENT_QUERY
+
+SCHEDULER_PATH: str = os.path.join(os.getcwd(), 'data', 'scheduler.sqlite')
+LOG_DIR: str = os.path.join(os.getcwd(), 'data', 'scheduler_logs')
+SCRIPT_DIR: str = os.path.dirname(os.path.abspath(__file__))
+
+# Jobs run at once, and how often the scheduler checks on them in seconds
+MAX_JOBS: int = int(os.getenv('SCHEDULER_MAX_JOBS', 2))
+POLL_SECONDS: float = 10.0
+
+DEFAULT_PRIORITY: int = 1
+
+# Assumed when estimating the cost of a job without better information
+REFERENCES_PER_PUBLICATION: int = 40
+INSTITUTION_PUBLICATIONS: int = 5000
+
+
+STATUSES: tuple = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+
+@dataclass
+class Job:
+    '''A run of a script in a folder.'''
+    id: int
+    script: str
+    cwd: str
+    priority: int = DEFAULT_PRIORITY
+    params: dict = field(default_factory=dict)
+    env: dict = field(default_factory=dict)
+    status: str = 'queued'
+    estimate: int | None = None
+    submitted: float | None = None
+    started: float | None = None
+    finished: float | None = None
+    returncode: int | None = None
+
+
+def pages(n_records: int) -> int:
+    '''Count the requests to page through the records of a search.'''
+    return max(1, int(np.ceil(min(n_records, MAX_RECORDS) / PAGE_SIZE)))
+
+
+def unique_values(path: str, column: str) -> pd.Series:
+    return pd.read_csv(path, usecols=[column])[column].dropna().drop_duplicates()
+
+
+def co_citation_cost(job: Job, planner: QueryPlanner, index: IdIndex | None) -> dict:
+    dois = pd.Series(normalize_dois(unique_values(os.path.join(job.cwd, 'data', 'publications.csv'), 'doi'))
+                     .dropna().unique())
+    unresolved = index.unresolved_dois(dois) if index is not None else dois
+    id_length = int(dois.str.len().mean()) if len(dois) else 0
+    # The cohorts of the last report in the folder, if any, are the best guide to their size. Cohorts
+    # share members, so the members fetched per target for that report are used if they are fewer.
+    members = planner.results_per_id(template_key(citing_query())) * REFERENCES_PER_PUBLICATION
+    report = os.path.join(job.cwd, 'co_citation_percentile_rank.csv')
+    if os.path.exists(report) and 'cohort_size' in pd.read_csv(report, nrows=0).columns:
+        cohort_sizes = pd.read_csv(report, usecols=['cohort_size'])['cohort_size']
+        store_path = os.path.join(job.cwd, 'data', 'harvests', 'co_citation_cohort_data')
+        plan = ChunkStore(store_path).manifest.get('plan') if os.path.isdir(store_path) else None
+        members = cohort_sizes.mean()
+        if plan and len(cohort_sizes):
+            members = min(members, sum(plan['sizes']) / len(cohort_sizes))
+    return {
+        'resolve_dois': planner.estimate(DOI_QUERY, len(unresolved), id_length=id_length),
+        'cohorts': planner.estimate(citing_query(), len(dois)),
+        'cohort_data': planner.estimate(COHORT_DATA_QUERY, int(len(dois) * np.nan_to_num(members))),
+    }
+
+
+def feet_of_clay_cost(job: Job, planner: QueryPlanner, index: IdIndex | None) -> dict:
+    n_publications = int(job.params.get('publications', INSTITUTION_PUBLICATIONS))
+    return {
+        'publications': pages(n_publications),
+        'references': planner.estimate(REFERENCES_QUERY, n_publications * REFERENCES_PER_PUBLICATION),
+        # At most, since only the flagged publications are fetched
+        'affiliations': planner.estimate(AFFILIATIONS_QUERY, n_publications),
+    }
+
+
+def integrity_report_cost(job: Job, planner: QueryPlanner, index: IdIndex | None) -> dict:
+    n_publications = int(job.params.get('publications', INSTITUTION_PUBLICATIONS))
+    fields = HarvestPlanner([REGISTRY[name] for name in ANALYSES]).reference_fields
+    template = REFERENCES_QUERY if set(fields) <= set(INDEXED_FIELDS) else cited_query(fields)
+    return {
+        'publications': pages(n_publications),
+        'references': planner.estimate(template, n_publications * REFERENCES_PER_PUBLICATION) if fields else 0,
+        'affiliations': planner.estimate(AFFILIATIONS_QUERY, n_publications) if 'feet_of_clay' in ANALYSES else 0,
+    }
+
+
+def self_citation_cost(job: Job, planner: QueryPlanner, index: IdIndex | None) -> dict:
+    researchers = unique_values(os.path.join(job.cwd, 'publications.csv'), 'researcher_id')
+    return {'publications': planner.estimate(researcher_query('id+year+reference_ids+times_cited+researchers'),
+                                             len(researchers))}
+
+
+def aif_cost(job: Job, planner: QueryPlanner, index: IdIndex | None) -> dict:
+    template = researcher_query('id+year+researchers')
+    n_publications = len(RESEARCHER_IDS) * planner.results_per_id(template_key(template))
+    return {
+        'publications': planner.estimate(template, len(RESEARCHER_IDS)),
+        'citing': planner.estimate(citing_query('id+year+reference_ids'), int(n_publications)),
+    }
+
+
+def talent_programs_cost(job: Job, planner: QueryPlanner, index: IdIndex | None) -> dict:
+    ids = unique_values(os.path.join(job.cwd, PUBLICATIONS_FILE), 'publication_id')
+    return {'publications': planner.estimate(TALENT_QUERY, len(ids))}
+
+
+# How to estimate the requests of a job for each script that can be scheduled
+ESTIMATORS: dict = {
+    'co_citation_percentile_rank': co_citation_cost,
+    'feet_of_clay': feet_of_clay_cost,
+    'integrity_report': integrity_report_cost,
+    'author_self_citation': self_citation_cost,
+    'aif': aif_cost,
+    'talent_program_checker': talent_programs_cost,
+}
+
+
+def estimate(job: Job) -> dict:
+    '''Estimate the requests each stage of a job will make, from its inputs and what its folder has learned.'''
+    planner = QueryPlanner(os.path.join(job.cwd, 'data', 'query_planner.json'))
+    index_path = os.path.join(job.cwd, 'data', 'id_index.sqlite')
+    index = IdIndex(index_path) if os.path.exists(index_path) else None
+    return ESTIMATORS[job.script](job, planner, index)
+
+
+class JobQueue:
+    '''SQLite-backed queue of jobs, kept across restarts of the scheduler.'''
+
+    def __init__(self, path: str = SCHEDULER_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                script TEXT,
+                                cwd TEXT,
+                                priority INTEGER,
+                                params TEXT,
+                                env TEXT,
+                                status TEXT,
+                                estimate INTEGER,
+                                submitted REAL,
+                                started REAL,
+                                finished REAL,
+                                returncode INTEGER)''')
+        self._db.commit()
+
+    def _update(self, sql: str, args: tuple):
+        with self._lock:
+            self._db.execute(sql, args)
+            self._db.commit()
+
+    def submit(self, script: str, cwd: str, priority: int = DEFAULT_PRIORITY, params: dict | None = None,
+               env: dict | None = None) -> Job:
+        '''Queue a run of a script in a folder, with an estimate of the requests it will make.'''
+        if script not in ESTIMATORS:
+            raise ValueError(f'Unknown script {script!r}, expected one of {", ".join(ESTIMATORS)}')
+        if priority < 1:
+            raise ValueError('The priority of a job must be at least 1')
+        job = Job(None, script, os.path.abspath(cwd), priority, dict(params or {}), dict(env or {}))
+        job.estimate = sum(estimate(job).values())
+        job.submitted = time.time()
+        with self._lock:
+            cursor = self._db.execute('''INSERT INTO jobs (script, cwd, priority, params, env, status, estimate,
+                                                           submitted)
+                                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                      (job.script, job.cwd, job.priority, json.dumps(job.params),
+                                       json.dumps(job.env), job.status, job.estimate, job.submitted))
+            self._db.commit()
+        job.id = cursor.lastrowid
+        return job
+
+    def jobs(self, statuses: tuple = STATUSES) -> list:
+        '''Get the jobs with the given statuses, highest priority first, then in the order submitted.'''
+        with self._lock:
+            rows = self._db.execute(f'''SELECT id, script, cwd, priority, params, env, status, estimate, submitted,
+                                               started, finished, returncode
+                                        FROM jobs WHERE status IN ({", ".join("?" * len(statuses))})
+                                        ORDER BY priority DESC, id''', statuses).fetchall()
+        return [Job(*row[:4], json.loads(row[4]), json.loads(row[5]), *row[6:]) for row in rows]
+
+    def next_job(self) -> Job | None:
+        queued = self.jobs(('queued',))
+        return queued[0] if queued else None
+
+    def start(self, job_id: int):
+        self._update('UPDATE jobs SET status = ?, started = ? WHERE id = ?', ('running', time.time(), job_id))
+
+    def finish(self, job_id: int, returncode: int):
+        self._update('UPDATE jobs SET status = ?, finished = ?, returncode = ? WHERE id = ?',
+                     ('done' if returncode == 0 else 'failed', time.time(), returncode, job_id))
+
+    def cancel(self, job_id: int):
+        '''Cancel a queued job. A running job is left to finish.'''
+        self._update("UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status = 'queued'", (job_id,))
+
+    def requeue_running(self) -> int:
+        '''Queue the jobs left running by a scheduler that was stopped again.'''
+        with self._lock:
+            count = self._db.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'").rowcount
+            self._db.commit()
+        return count
+
+
+def schedule(jobs: list, costs: dict, max_jobs: int = MAX_JOBS) -> dict:
+    '''
+    Work out how many requests will have been made in all when each job
+    finishes, with up to max_jobs running at once and sharing the budget in
+    proportion to their priorities, as QuotaBudget does.
+    '''
+    remaining = {job.id: costs[job.id] for job in jobs}
+    waiting = [job for job in jobs if job.status == 'queued']
+    running = [job for job in jobs if job.status == 'running']
+    finished, made = {}, 0.0
+    while running or waiting:
+        while waiting and len(running) < max_jobs:
+            running.append(waiting.pop(0))
+        weight = sum(job.priority for job in running)
+        # The next job to finish is the one with the fewest requests left for its share
+        first = min(running, key=lambda job: remaining[job.id] / job.priority)
+        step = remaining[first.id] * weight / first.priority
+        for job in running:
+            remaining[job.id] -= step * job.priority / weight
+        made += step
+        finished[first.id] = made
+        running.remove(first)
+    return finished
+
+
+def duration(requests: float, per_minute: float, per_day: int = 0, used_today: int = 0,
+             now: float | None = None) -> float:
+    '''Get the seconds taken to make a number of requests under a per-minute and per-day quota.'''
+    now = time.time() if now is None else now
+    if not per_day:
+        return requests * MINUTE / per_minute
+    t, left = now, requests
+    allowance, reset = max(0, per_day - used_today), day_start(now) + DAY
+    while True:
+        made = min(left, allowance, (reset - t) * per_minute / MINUTE)
+        t += made * MINUTE / per_minute
+        left -= made
+        if left <= 0:
+            return t - now
+        # The rest waits for the quota to reset
+        t, allowance, reset = reset, per_day, reset + DAY
+
+
+def dry_run(queue: JobQueue, budget: QuotaBudget, max_jobs: int = MAX_JOBS) -> pd.DataFrame:
+    '''Estimate the requests of every queued or running job and when it should finish.'''
+    jobs = queue.jobs(('running', 'queued'))
+    stages, costs = {}, {}
+    for job in jobs:
+        try:
+            stages[job.id] = estimate(job)
+            costs[job.id] = sum(stages[job.id].values())
+        except (OSError, ValueError, KeyError) as e:
+            # Inputs that have moved since the job was submitted
+            print(f'Job {job.id}: {e}, using the estimate made when it was submitted')
+            stages[job.id], costs[job.id] = {}, job.estimate or 0
+    finished = schedule(jobs, costs, max_jobs)
+    now, used_today = time.time(), budget.used_today()
+    return pd.DataFrame({
+        'id': [job.id for job in jobs],
+        'script': [job.script for job in jobs],
+        'cwd': [job.cwd for job in jobs],
+        'priority': [job.priority for job in jobs],
+        'status': [job.status for job in jobs],
+        'requests': [costs[job.id] for job in jobs],
+        'stages': [', '.join(f'{stage} {n}' for stage, n in stages[job.id].items()) for job in jobs],
+        'finishes': [pd.Timestamp(now + duration(finished[job.id], budget.per_minute, budget.per_day, used_today,
+                                                 now), unit='s').floor('min') for job in jobs],
+    })
+
+
+def start_job(job: Job, budget: QuotaBudget, log_dir: str = LOG_DIR) -> subprocess.Popen:
+    '''Start a job's script in its folder, drawing its requests from the shared budget.'''
+    os.makedirs(log_dir, exist_ok=True)
+    env = dict(os.environ, **job.env, DIMENSIONS_JOB=f'job {job.id}', DIMENSIONS_JOB_WEIGHT=str(job.priority),
+               DIMENSIONS_QUOTA=os.path.abspath(budget.path))
+    with open(os.path.join(log_dir, f'{job.id}_{job.script}.log'), 'a') as log:
+        return subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, f'{job.script}.py')], cwd=job.cwd,
+                                env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def run(queue: JobQueue, budget: QuotaBudget, max_jobs: int = MAX_JOBS, log_dir: str = LOG_DIR):
+    '''Run the queued jobs in order of priority until the queue is empty.'''
+    requeued = queue.requeue_running()
+    if requeued:
+        print(f'{requeued} jobs left running by the last scheduler queued again')
+    processes, paused = {}, False
+    while True:
+        for job_id, process in list(processes.items()):
+            if process.poll() is not None:
+                queue.finish(job_id, process.returncode)
+                print(f'Job {job_id} finished with exit code {process.returncode}')
+                del processes[job_id]
+        # No job is started while the daily quota is used up, as it could only wait for it to reset
+        exhausted = budget.exhausted()
+        if exhausted and not paused:
+            print(f'Daily quota used up, waiting for it to reset at '
+                  f'{pd.Timestamp(day_start(time.time()) + DAY, unit="s")} UTC')
+        paused = exhausted
+        while not exhausted and len(processes) < max_jobs:
+            job = queue.next_job()
+            if job is None:
+                break
+            processes[job.id] = start_job(job, budget, log_dir)
+            queue.start(job.id)
+            print(f'Job {job.id} started: {job.script} in {job.cwd}, about {job.estimate} requests')
+        if not processes and queue.next_job() is None:
+            break
+        time.sleep(POLL_SECONDS)
+
+
+def key_values(pairs: list) -> dict:
+    return dict(pair.split('=', 1) for pair in pairs or [])
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    submit = commands.add_parser('submit', help='queue a run of a script')
+    submit.add_argument('script', choices=list(ESTIMATORS))
+    submit.add_argument('--cwd', default=os.getcwd(), help='folder to run the script in')
+    submit.add_argument('--priority', type=int, default=DEFAULT_PRIORITY)
+    submit.add_argument('--param', nargs='*', metavar='KEY=VALUE', help='inputs for the estimate, e.g. publications=20000')
+    submit.add_argument('--env', nargs='*', metavar='KEY=VALUE', help='environment variables for the script')
+    commands.add_parser('list', help='list every job')
+    cancel = commands.add_parser('cancel', help='cancel a queued job')
+    cancel.add_argument('id', type=int)
+    for name, description in [('dry-run', 'estimate the requests and finishing time of the queued jobs'),
+                              ('run', 'run the queued jobs')]:
+        command = commands.add_parser(name, help=description)
+        command.add_argument('--max-jobs', type=int, default=MAX_JOBS)
+    args = parser.parse_args()
+
+    queue = JobQueue()
+    budget = QuotaBudget()
+    if args.command == 'submit':
+        job = queue.submit(args.script, args.cwd, args.priority, key_values(args.param), key_values(args.env))
+        print(f'Job {job.id} queued: {job.script} in {job.cwd}, about {job.estimate} requests')
+    elif args.command == 'list':
+        df_jobs = pd.DataFrame([vars(job) for job in queue.jobs()])
+        if df_jobs.empty:
+            print('No jobs')
+        else:
+            for column in ['submitted', 'started', 'finished']:
+                df_jobs[column] = pd.to_datetime(df_jobs[column], unit='s').dt.floor('s')
+            print(df_jobs.drop(columns=['params', 'env']).to_string(index=False))
+    elif args.command == 'cancel':
+        queue.cancel(args.id)
+    elif args.command == 'dry-run':
+        df_plan = dry_run(queue, budget, args.max_jobs)
+        if df_plan.empty:
+            print('No jobs queued')
+        else:
+            print(df_plan.to_string(index=False))
+            total = df_plan['requests'].sum()
+            print(f'{total} requests in all, taking about '
+                  f'{duration(total, budget.per_minute, budget.per_day, budget.used_today()) / 3600:.1f} hours. {budget}')
+    else:
+        run(queue, budget, args.max_jobs)
@@ -7,64 +7,49 @@ list of publication ids in the Dimensions database.
 
 The output of the code is a new CSV file called "talent_plans.csv" that contains 
 two columns: "pub_id" (the publication ID) and "talent_plan" (the name of the 
-talent program associated with that publication).
+talent program associated with that publication). A publication that names 
+more than one talent program has one row for each of them.
 '''
-import dimcli
 from dotenv import load_dotenv
-import numpy as np
 import pandas as pd
 
-import json
 import os
-import re
 
-publications = pd.read_csv('data/aggregated_publications.csv')
-publications = publications.filter(['publication_id']).drop_duplicates(['publication_id'])
+from backends import connect, disconnect
+from chunk_store import ChunkStore
+from funding_matcher import match_funding
+from id_index import IdIndex
+from instrumentation import stage
+from query_planner import QueryPlanner
 
-split = int(np.ceil(publications.shape[0]/512))
-dat_split = np.array_split(publications, split)
+PUBLICATIONS_FILE: str = os.path.join('data', 'aggregated_publications.csv')
 
-# Log into Dimensions
-load_dotenv()
-API_KEY = os.getenv('API_KEY')
-dimcli.login(key=API_KEY, endpoint='https://app.dimensions.ai/api/dsl/v2')
-dsl = dimcli.Dsl()
+# Query template for the funding of the publications, for QueryPlanner
+TALENT_QUERY: str = 'search publications where id in {ids} return publications[id+funding_section+funders]'
 
-df_publications = pd.DataFrame()
-df_authors = pd.DataFrame()
-df_affiliations = pd.DataFrame()
-for i in range(len(dat_split)):
-    pubs = dat_split[i]['publication_id'] 
-    results = dsl.query(f'''search publications
-                    where id in {json.dumps(list(pubs))}
-                    return publications[id+funding_section+funders]
-                    limit 1000 skip 0
-                    '''
-    )
-    
-    df_pubs_temp = results.as_dataframe()
-    df_authors_temp = results.as_dataframe_authors()
-    df_affiliations_temp = results.as_dataframe_authors_affiliations()
-    
-    df_publications = pd.concat([df_publications, df_pubs_temp])
-    df_authors = pd.concat([df_authors, df_authors_temp])
-    df_affiliations = pd.concat([df_affiliations, df_affiliations_temp])
-    
-dimcli.logout()
 
-df_publications_filtered = df_publications[df_publications['funding_section'].notnull()]
-talents_programs = df_publications_filtered[df_publications_filtered['funding_section'].str.contains('talents program', case=False)]
+if __name__ == '__main__':
+    load_dotenv()
 
-talent_plans = pd.DataFrame()
+    publications = pd.read_csv(PUBLICATIONS_FILE)
+    publications = publications.filter(['publication_id']).drop_duplicates(['publication_id'])
 
-for i in range(talents_programs.shape[0]):
-    match = re.search(r',([^,]*Talents Program),', talents_programs['funding_section'].iloc[i])
-    if match:
-        result = match.group(1).strip()
-        df_temp = pd.DataFrame({'talent_plan': result}, index=[0])
-        df_temp['pub_id'] = talents_programs['id'].iloc[i]
-    
-    talent_plans = pd.concat([talent_plans, df_temp])
+    # Connect to the Dimensions API or a local export
+    index = IdIndex()
+    dsl = connect(listeners=[index.record_result])
 
-talent_plans = talent_plans[['pub_id'] + ['talent_plan']]
-talent_plans.to_csv('talent_plans.csv', index=False)
\ No newline at end of file
+    with stage('publications'):
+        store = QueryPlanner().harvest(
+            ChunkStore(os.path.join('data', 'harvests', 'talent_programs')), dsl, TALENT_QUERY,
+            publications['publication_id'], to_frames=lambda results: {'publications': results.as_dataframe()})
+
+        df_publications = store.read(table='publications')
+
+    disconnect(dsl)
+
+    # Find every talent program named in the funding section of each publication.
+    # The programs and their aliases are listed in TALENT_PROGRAMS in funding_matcher.py
+    with stage('talent_programs'):
+        df_publications_filtered = df_publications[df_publications['funding_section'].notnull()]
+        talent_plans = match_funding(df_publications_filtered)
+    talent_plans.to_csv('talent_plans.csv', index=False)
@@ -0,0 +1,20 @@
+import pandas as pd
+
+from aif import author_impact_factor, citation_links
+
+
+def test_co_authored_publication_in_two_batches_is_counted_once():
+    # pub.1 by both researchers is returned by the batch of each of them
+    authorship = pd.DataFrame({'id': ['pub.1', 'pub.1', 'pub.1', 'pub.1'],
+                               'researcher_id': ['ur.1', 'ur.2', 'ur.1', 'ur.2']})
+    publications = pd.DataFrame({'id': ['pub.1', 'pub.1'], 'year': [2020, 2020]})
+    citing = pd.DataFrame({'id': ['pub.2'], 'year': [2021], 'reference_ids': [['pub.1']]})
+
+    links = citation_links(authorship, publications, citing)
+    df_aif = author_impact_factor(authorship, publications, links, ['ur.1', 'ur.2'], [2])
+
+    row = df_aif[(df_aif['year'] == 2021) & (df_aif['delta'] == 2)].set_index('researcher_id')
+    assert row.loc['ur.1', 'publications'] == 1
+    assert row.loc['ur.1', 'citations'] == 1
+    assert row.loc['ur.1', 'aif'] == 1.0
+    assert row.loc['ur.2', 'aif'] == 1.0
@@ -0,0 +1,27 @@
+import json
+import threading
+from urllib.request import urlopen
+
+from co_citation_service import CoCitationServer, CoCitationService
+from id_index import IdIndex
+
+
+class NoResultsPlanner:
+    '''Planner for a Dimensions API that knows none of the identifiers asked for.'''
+
+    def fetch(self, dsl, template, ids):
+        return []
+
+
+def test_unknown_doi_is_not_found(tmp_path):
+    service = CoCitationService(None, IdIndex(str(tmp_path / 'id_index.sqlite')), NoResultsPlanner())
+    server = CoCitationServer(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with urlopen(f'http://127.0.0.1:{server.server_address[1]}/rank?doi=10.1234/Unknown') as response:
+            assert response.status == 200
+            data = json.load(response)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert data == {'results': [], 'not_found': ['10.1234/unknown']}
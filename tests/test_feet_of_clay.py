@@ -0,0 +1,32 @@
+import pandas as pd
+
+from feet_of_clay import get_problematic_publications, get_retracted_citations
+from reference_table import ReferenceTable
+from retractions import RetractionStore
+
+
+def test_retracted_reference_found_from_unnormalized_csv_doi(tmp_path):
+    local_file = tmp_path / 'retractions.csv'
+    pd.DataFrame({'Record ID': [1], 'RetractionDate': ['1/2/2020 0:00'], 'RetractionDOI': ['10.1/retraction'],
+                  'OriginalPaperDOI': ['10.1/abc'], 'RetractionNature': ['Retraction'],
+                  'Reason': ['+Fake data;']}).to_csv(local_file, index=False)
+    retractions = RetractionStore(str(tmp_path / 'store'), url='http://127.0.0.1:9/', local_file=str(local_file))
+    retractions.refresh()
+
+    # As written to cited_publications_*.csv by the original script
+    cited_publications = tmp_path / 'cited_publications.csv'
+    pd.DataFrame({'id': ['pub.2'], 'doi': ['https://doi.org/10.1/ABC']}).to_csv(cited_publications, index=False)
+    references = ReferenceTable.from_records([{'id': 'pub.1', 'reference_ids': ['pub.2', 'pub.3']}])
+
+    df_retracted_citations = get_retracted_citations(references, pd.read_csv(cited_publications, chunksize=1),
+                                                     retractions)
+    df_publications = pd.DataFrame({'pub_id': ['pub.1'], 'doi': ['10.1/citing'], 'date': ['2021-01-01'],
+                                    'publisher': ['P'], 'title': ['T'], 'source_title': ['S']})
+    df_affiliations = pd.DataFrame({'pub_id': ['pub.1'], 'aff_id': ['grid.1'], 'aff_name': ['A'],
+                                    'aff_raw_affiliation': ['A'], 'researcher_id': ['ur.1'], 'full_name': ['R']})
+    df_problematic = get_problematic_publications(df_publications, df_affiliations, df_retracted_citations,
+                                                  retractions)
+
+    assert df_problematic['retracted_paper_doi'].tolist() == ['10.1/abc']
+    assert df_problematic['rw_record_id'].tolist() == [1]
+    assert df_problematic['cited_after_retraction'].tolist() == [True]